@@ -7,15 +7,25 @@ Generates character image packs for Strip Club Wars 2 using Stable Diffusion Web
 """
 
 import argparse
+import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+from PIL import Image
+
 # Add src to path
 sys.path.insert(0, str(Path(__file__).parent / "src"))
 
 from src.generator import CharacterImageGenerator
 from src.character_loader import CharacterLoader
 from src.config import Config
+from src.planner import JobFilter, estimate_run, parse_job_filter
+from src.character_ids import CharacterIdRegistry
+from src.matting import benchmark as benchmark_matting
+from src.image_processor import ImageProcessor
+from src.png_encoder import optimize_file
+from src.timing_history import TimingHistory
 
 def main():
     """Main entry point"""
@@ -27,6 +37,12 @@ Examples:
   %(prog)s --test                              # Generate sample characters
   %(prog)s --config configs/character_config.json  # Generate from config
   %(prog)s --config configs/character_config.mini.json  # Quick test
+  %(prog)s --config configs/character_config.json --plan  # Estimate a run without rendering
+  %(prog)s --config configs/character_config.json --shard 2/4  # Second quarter of the pack
+  %(prog)s --config configs/character_config.json --poses uw --reveal 3-4  # Re-render a subset
+  %(prog)s --resume custom_20250101_120000      # Finish an interrupted session
+  %(prog)s --queue /mnt/packs/pack1 --config configs/character_config.json  # Enqueue and render
+  %(prog)s --queue /mnt/packs/pack1             # Join as another render node
         """
     )
     
@@ -57,6 +73,117 @@ Examples:
         type=str,
         help="Mod key for file naming"
     )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        help=f"Number of txt2img requests kept queued per WebUI (default: {Config.MAX_IN_FLIGHT}, 1 = serial)"
+    )
+    parser.add_argument(
+        "--webui-urls",
+        type=str,
+        help="Comma-separated WebUI URLs to load balance across (one per GPU)"
+    )
+    parser.add_argument(
+        "--multi-prompt",
+        action="store_true",
+        help="Pack prompts with shared settings into one request via the prompts-from-file script"
+    )
+    parser.add_argument(
+        "--stall-timeout",
+        type=float,
+        help=f"Interrupt a generation after this many seconds without step progress "
+             f"(default: {Config.STALL_TIMEOUT}, 0 = don't watch progress)"
+    )
+    parser.add_argument(
+        "--postprocess-workers",
+        type=int,
+        help=f"Processes for background removal and encoding (default: {Config.POSTPROCESS_WORKERS})"
+    )
+    parser.add_argument(
+        "--checkpoint",
+        type=str,
+        help="Checkpoint title, name or hash to pin every job to (default: the loaded model)"
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Render everything again instead of reusing cached renders with identical inputs"
+    )
+    parser.add_argument(
+        "--palette-headshots",
+        action="store_true",
+        help="Save headshots as palette PNGs when they pass PNG_PALETTE_MIN_PSNR (lossy; "
+             "also applies to --optimize-pack)"
+    )
+    parser.add_argument(
+        "--resume",
+        type=str,
+        metavar="SESSION",
+        help="Resume an interrupted session (directory name in the output dir, or a path); "
+             "only images that are still missing are generated"
+    )
+    parser.add_argument(
+        "--queue",
+        type=str,
+        metavar="DIR",
+        help="Render from a work queue shared by several nodes (a pack directory on a shared "
+             "filesystem); with --config/--test the characters are enqueued first, "
+             "from one node only"
+    )
+    parser.add_argument(
+        "--shard",
+        type=str,
+        metavar="K/N",
+        help="Render only part K of N of the jobs (stable hash split; run K=1..N on N machines)"
+    )
+    parser.add_argument(
+        "--poses",
+        type=str,
+        help="Comma-separated poses to render (aliases allowed), e.g. cas,uw"
+    )
+    parser.add_argument(
+        "--reveal",
+        type=str,
+        help="Reveal levels to render, e.g. 0,3-5"
+    )
+    parser.add_argument(
+        "--characters",
+        type=str,
+        help="Comma-separated preset names or character IDs to render"
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Only print the jobs the run would render, with estimated GPU time and disk use"
+    )
+    parser.add_argument(
+        "--benchmark-matting",
+        type=str,
+        metavar="DIR",
+        help="Time background-removal models, threads and batch sizes on PNGs from DIR "
+             "(e.g. the render cache) and compare their masks to the reference model"
+    )
+    parser.add_argument(
+        "--check-postprocess",
+        type=str,
+        metavar="DIR",
+        help="Run raw renders from DIR (e.g. the render cache) through the pil and numpy "
+             "post-processing modes and report any pixel differences"
+    )
+    parser.add_argument(
+        "--optimize-pack",
+        type=str,
+        metavar="DIR",
+        help="Re-encode the PNGs of a pack directory with the PNG search settings, in parallel, "
+             "keeping PNG_BYTE_BUDGET / PACK_BYTE_BUDGET, and report the savings"
+    )
+    parser.add_argument(
+        "--check-keying",
+        type=str,
+        metavar="DIR",
+        help="Report which body renders in DIR the solid-background key handles, and how "
+             "its masks compare to the matting model's"
+    )
     parser.add_argument(
         "--list-configs",
         action="store_true",
@@ -64,9 +191,15 @@ Examples:
     )
     
     args = parser.parse_args()
+    try:
+        job_filter = parse_job_filter(args.shard, args.poses, args.reveal, args.characters)
+    except ValueError as e:
+        parser.error(str(e))
     
     # Initialize components
     config = Config()
+    if args.palette_headshots:
+        config.PNG_PALETTE_HEADSHOTS = True
     character_loader = CharacterLoader()
     
     # List configs if requested
@@ -80,12 +213,65 @@ Examples:
             print("  No configuration files found in configs/ directory")
         return
     
+    if args.benchmark_matting:
+        run_matting_benchmark(Path(args.benchmark_matting), config)
+        return
+    
+    if args.check_postprocess:
+        check_postprocess_parity(Path(args.check_postprocess), config)
+        return
+    
+    if args.optimize_pack:
+        optimize_pack(Path(args.optimize_pack), config)
+        return
+    
+    if args.check_keying:
+        check_keying(Path(args.check_keying), config)
+        return
+    
+    # Dry run: estimate from the timing history of earlier runs, no WebUI needed
+    if args.plan:
+        if args.config:
+            characters = character_loader.load_from_config(args.config)
+        elif args.test:
+            characters = character_loader.load_test_characters(args.test_type)
+        else:
+            print("❌ --plan needs --config or --test")
+            return
+        urls = args.webui_urls.split(",") if args.webui_urls else config.WEBUI_URLS
+        print_plan(characters, config, args.output_dir or config.DEFAULT_OUTPUT_DIR,
+                   len([url for url in urls if url.strip()]), job_filter)
+        return
+    
     # Create generator
-    generator = CharacterImageGenerator(
-        output_dir=args.output_dir,
-        modkey=args.modkey
-    )
+    try:
+        generator = CharacterImageGenerator(
+            output_dir=args.output_dir,
+            modkey=args.modkey,
+            max_in_flight=args.max_in_flight,
+            webui_urls=[url.strip() for url in args.webui_urls.split(",") if url.strip()] if args.webui_urls else None,
+            multi_prompt=args.multi_prompt or None,
+            stall_timeout=args.stall_timeout,
+            checkpoint=args.checkpoint,
+            postprocess_workers=args.postprocess_workers,
+            resume_session=args.resume,
+            render_cache=False if args.no_cache else None,
+            palette_headshots=args.palette_headshots or None,
+            work_queue=args.queue,
+            job_filter=job_filter
+        )
+    except FileNotFoundError as e:
+        print(f"❌ {e}")
+        return
     
+    # Every path from here on closes the pipeline, writer thread and job store
+    try:
+        run_generation(generator, character_loader, args)
+    finally:
+        generator.close()
+
+def run_generation(generator: CharacterImageGenerator, character_loader: CharacterLoader, args):
+    """Check the WebUI, load characters and run the plan (or join the shared queue)"""
     # Check WebUI connection
     if not generator.check_webui_connection():
         return
@@ -93,7 +279,12 @@ Examples:
     # Load characters
     characters = []
     
-    if args.config:
+    if args.queue:
+        run_queue_worker(generator, character_loader, args)
+        return
+    elif args.resume:
+        characters = generator.load_session_characters()
+    elif args.config:
         characters = character_loader.load_from_config(args.config)
     elif args.test:
         print(f"🧪 Test mode: {args.test_type} characters")
@@ -102,6 +293,8 @@ Examples:
         print("Use one of the options:")
         print("  --test                          - generate sample characters")
         print("  --config configs/character_config.json  - load characters from file")
+        print("  --resume SESSION                - finish an interrupted session")
+        print("  --queue DIR                     - render from a queue shared by several nodes")
         print("  --list-configs                  - show available configs")
         return
     
@@ -110,34 +303,203 @@ Examples:
         return
     
     print(f"Starting generation for {len(characters)} characters...")
+    generator.register_characters(characters)
     
-    # Generate images for all characters
+    # Plan every job up front: required poses first, grouped by resolution
     successful = 0
     total_images = 0
     
-    for i, character in enumerate(characters, 1):
-        print(f"\nGenerating character {i}/{len(characters)}")
+    try:
+        plan = generator.plan_run(characters)
+        results = generator.run_plan(plan)
         
-        try:
-            results = generator.generate_character_images(character)
-            
-            # Count successful results
-            char_images = 0
-            for pose_results in results.values():
-                char_images += len([r for r in pose_results if r.success])
-            
+        # Count successful results
+        for char_results in results.values():
+            char_images = len([r for r in char_results if r.success])
             if char_images > 0:
                 successful += 1
                 total_images += char_images
-            
-        except KeyboardInterrupt:
-            print("\n⚠️ Generation interrupted by user")
-            break
-        except Exception as e:
-            print(f"❌ Error generating character {character.name}: {e}")
+        
+    except KeyboardInterrupt:
+        print("\n⚠️ Generation interrupted by user")
+    except Exception as e:
+        print(f"❌ Generation error: {e}")
     
     print(f"\nGeneration completed. Successfully created: {successful}/{len(characters)} characters")
     print(f"Total images generated: {total_images}")
+    generator.report_step_timings()
+    generator.report_pacing()
+    generator.report_cache()
+    generator.report_session()
+
+def print_plan(characters, config: Config, output_dir: str, backends: int,
+               job_filter: JobFilter = None):
+    """Print job counts, GPU time and output size of a run per resolution"""
+    history = TimingHistory(Path(output_dir) / config.TIMING_HISTORY)
+    registry = CharacterIdRegistry(Path(output_dir) / config.CHARACTER_ID_REGISTRY)
+    estimates = estimate_run(characters, config, history=history, job_filter=job_filter,
+                             registry=registry)
+    
+    print(f"🗺️ Plan for {len(characters)} characters "
+          f"({sum(c.gender == 'f' for c in characters)} female, "
+          f"{sum(c.gender != 'f' for c in characters)} male)")
+    for estimate in estimates:
+        source = "history" if estimate.from_history else "defaults"
+        print(f"   {estimate.width}x{estimate.height}@{estimate.steps}: {estimate.jobs} jobs, "
+              f"{estimate.gpu_seconds / 3600:.2f} GPU-h, "
+              f"{estimate.output_bytes / 1024 / 1024:.1f} MB ({source})")
+    
+    jobs = sum(e.jobs for e in estimates)
+    gpu_seconds = sum(e.gpu_seconds for e in estimates)
+    output_bytes = sum(e.output_bytes for e in estimates)
+    print(f"   Total: {jobs} jobs, {gpu_seconds / 3600:.2f} GPU-h "
+          f"(~{gpu_seconds / max(1, backends) / 3600:.2f} h on {backends} WebUI(s)), "
+          f"{output_bytes / 1024 / 1024:.1f} MB")
+    if not all(e.from_history for e in estimates):
+        print("   Sizes without history use rough defaults; they improve after a real run")
+
+def run_matting_benchmark(image_dir: Path, config: Config):
+    """Print images/sec and mask IoU of each background-removal option"""
+    paths = sorted(image_dir.rglob("*.png"))[:config.MATTING_BENCHMARK_IMAGES]
+    if not paths:
+        print(f"❌ No PNG images in {image_dir}")
+        return
+    images = [Image.open(path).convert("RGB") for path in paths]
+    
+    cores = os.cpu_count() or 1
+    thread_counts = sorted({1, max(1, cores // 2), cores})
+    batch_sizes = sorted({1, max(1, config.MATTING_BATCH_SIZE)})
+    print(f"⏱️ Benchmarking background removal on {len(images)} images "
+          f"(reference: {config.MATTING_BENCHMARK_REFERENCE})")
+    try:
+        results = benchmark_matting(images, config.MATTING_BENCHMARK_MODELS, thread_counts, batch_sizes,
+                            config.MATTING_BENCHMARK_REFERENCE, config.MATTING_PROVIDERS or None)
+    except Exception as e:
+        print(f"❌ Benchmark failed: {e}")
+        return
+    
+    print(f"   {'model':<18} {'provider':<26} {'threads':>7} {'batch':>5} {'img/s':>7} {'IoU':>6}")
+    for r in sorted(results, key=lambda r: -r.images_per_second):
+        print(f"   {r.model:<18} {r.provider:<26} {r.intra_op_threads:>7} {r.batch_size:>5} "
+              f"{r.images_per_second:>7.2f} {r.iou:>6.3f}")
+    print("   Set REMBG_MODEL / MATTING_INTRA_OP_THREADS / MATTING_BATCH_SIZE per node accordingly")
+
+def optimize_pack(pack_dir: Path, config: Config):
+    """Re-encode a pack's images in a process pool and print the savings"""
+    paths = sorted(pack_dir.glob("*.png"))
+    if not paths:
+        print(f"❌ No PNG images in {pack_dir}")
+        return
+    
+    sizes = [path.stat().st_size for path in paths]
+    total = sum(sizes)
+    if config.PNG_BYTE_BUDGET:
+        budgets = [config.PNG_BYTE_BUDGET] * len(paths)
+    elif config.PACK_BYTE_BUDGET and total > config.PACK_BYTE_BUDGET:
+        # Every image shrinks by the share the pack is over budget
+        budgets = [int(size * config.PACK_BYTE_BUDGET / total) for size in sizes]
+    else:
+        budgets = [0] * len(paths)
+    
+    print(f"🗜️ Re-encoding {len(paths)} images ({total / 1e6:.1f} MB) on {os.cpu_count() or 1} processes...")
+    kinds = {"head": [0, 0, 0], "body": [0, 0, 0]}  # before, after, palette images
+    over_budget = 0
+    with ProcessPoolExecutor() as executor:
+        results = executor.map(optimize_file, paths, [config] * len(paths), budgets)
+        for path, budget, (before, encoded) in zip(paths, budgets, results):
+            after = min(before, len(encoded.data))
+            kind = kinds["head" if path.name.endswith("-head.png") else "body"]
+            kind[0] += before
+            kind[1] += after
+            kind[2] += 1 if encoded.palette_colors and after < before else 0
+            over_budget += 1 if budget and after > budget else 0
+    
+    for name, (before, after, palettes) in kinds.items():
+        if before:
+            print(f"   {name:<5} {before / 1e6:8.2f} MB -> {after / 1e6:8.2f} MB "
+                  f"({100 * (before - after) / before:.1f}% saved, {palettes} palette images)")
+    saved_total = sum(after for _, after, _ in kinds.values())
+    print(f"✅ Pack: {total / 1e6:.2f} MB -> {saved_total / 1e6:.2f} MB "
+          f"({100 * (total - saved_total) / total:.1f}% saved)")
+    if over_budget:
+        print(f"⚠️ {over_budget} images still over their byte budget at PNG_PALETTE_MIN_PSNR")
+    if config.PACK_BYTE_BUDGET and saved_total > config.PACK_BYTE_BUDGET:
+        print(f"⚠️ Pack is {(saved_total - config.PACK_BYTE_BUDGET) / 1e6:.2f} MB over PACK_BYTE_BUDGET")
+
+def check_postprocess_parity(image_dir: Path, config: Config):
+    """Compare the pil and numpy post-processing paths on raw renders"""
+    paths = sorted(image_dir.rglob("*.png"))
+    if not paths:
+        print(f"❌ No PNG images in {image_dir}")
+        return
+    
+    processor = ImageProcessor(config)
+    mismatches = 0
+    alpha_checks = []
+    for path in paths:
+        image = Image.open(path).convert("RGB")
+        # Headshot renders are the smaller size; everything else is a body render
+        pose = "head" if image.size == tuple(config.HEAD_GENERATION_SIZE) else "body"
+        difference = processor.check_parity(image, pose)
+        if difference:
+            mismatches += 1
+            print(f"   ⚠️ {path.name} ({pose}): max pixel difference {difference}")
+        if config.MATTING_LOWRES and pose == "body":
+            alpha_checks.append(processor.check_lowres_alpha(image))
+    if mismatches:
+        print(f"❌ {mismatches}/{len(paths)} images differ between the pil and numpy paths")
+    else:
+        print(f"✅ pil and numpy paths produce identical pixels for {len(paths)} images")
+    if alpha_checks:
+        mean_difference = sum(difference for difference, _ in alpha_checks) / len(alpha_checks)
+        worst_iou = min(iou for _, iou in alpha_checks)
+        print(f"🔍 Low-res vs full-res alpha on {len(alpha_checks)} bodies: "
+              f"mean difference {mean_difference:.2f}/255, worst mask IoU {worst_iou:.4f}")
+
+def check_keying(image_dir: Path, config: Config):
+    """Run the solid-background key on body renders and compare it to the matting model"""
+    paths = [path for path in sorted(image_dir.rglob("*.png"))
+             if Image.open(path).size != tuple(config.HEAD_GENERATION_SIZE)]
+    if not paths:
+        print(f"❌ No body renders in {image_dir}")
+        return
+    
+    processor = ImageProcessor(config)
+    ious = []
+    for path in paths:
+        check, iou = processor.check_keying(Image.open(path).convert("RGB"))
+        if check.keyed:
+            ious.append(iou if iou is not None else 0.0)
+            print(f"   ✅ {path.name}: keyed, mask IoU {iou if iou is not None else 0.0:.4f}")
+        else:
+            print(f"   ↪️ {path.name}: matting model (border {check.border_agreement:.2f}, "
+                  f"coverage {check.coverage:.2f}, edges {check.edge_consistency:.2f}, "
+                  f"enclosed {check.enclosed:.3f})")
+    print(f"🔑 {len(ious)}/{len(paths)} body renders keyed" +
+          (f", mean mask IoU vs {config.REMBG_MODEL} {sum(ious) / len(ious):.4f}" if ious else ""))
+
+def run_queue_worker(generator: CharacterImageGenerator, character_loader: CharacterLoader, args):
+    """Enqueue characters if given, then render leased jobs until the queue is empty"""
+    try:
+        if args.config or args.test:
+            if args.config:
+                characters = character_loader.load_from_config(args.config)
+            else:
+                print(f"🧪 Test mode: {args.test_type} characters")
+                characters = character_loader.load_test_characters(args.test_type)
+            print(f"📥 Enqueueing {len(characters)} characters...")
+            generator.register_characters(characters)
+            generator.plan_run(characters)
+        generator.run_worker()
+    except KeyboardInterrupt:
+        print("\n⚠️ Worker interrupted by user; its leased jobs went back to the queue")
+    except Exception as e:
+        print(f"❌ Worker error: {e}")
+    
+    generator.report_step_timings()
+    generator.report_pacing()
+    generator.report_cache()
+    generator.report_session()
 
 if __name__ == "__main__":
     main()
@@ -7,6 +7,9 @@ Generates character image packs for Strip Club Wars 2
 
 Uses Stable Diffusion WebUI API to generate character images
 and post-processes them to meet game requirements.
+
+Needs the src package next to it (pacing, job selection, character IDs,
+keying and matting); run it from the repository root.
 """
 
 import os
@@ -22,8 +25,18 @@ from dataclasses import dataclass
 from pathlib import Path
 import time
 import random
+import numpy as np
 import datetime
 
+# Shared with main.py; the script is not standalone
+from src.models import GenerationSettings
+from src.scheduler import Pacer
+from src.planner import JobFilter, parse_job_filter, parse_ranges
+from src.character_ids import character_key
+from src.config import Config
+from src.keying import key_background
+from src.matting import apply_masks, rembg_session
+
 # Stable Diffusion WebUI configuration
 WEBUI_URL = "http://localhost:7860"
 WEBUI_API_URL = f"{WEBUI_URL}/sdapi/v1"
@@ -207,10 +220,20 @@ CLOTHING_STYLE_PROMPTS = {
 class SCWImageGenerator:
     """SCW image generator"""
     
-    def __init__(self, output_dir: str = "generated_characters", modkey: str = "custom"):
+    def __init__(self, output_dir: str = "generated_characters", modkey: str = "custom",
+                 job_filter: JobFilter = None):
         self.output_dir = Path(output_dir)
         self.modkey = modkey
         
+        # Poses and reveal levels to generate (shards are applied to the character list)
+        self.job_filter = job_filter or JobFilter()
+        
+        # Keying and matting settings (KEYING_*, REMBG_MODEL, MATTING_* threads)
+        self.config = Config()
+        
+        # rembg session, loaded on first use
+        self._rembg_session = None
+        
         # Create a new session directory based on timestamp and prefix with modkey
         session_timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
         self.session_dir = self.output_dir / f"{self.modkey}_{session_timestamp}"
@@ -218,6 +241,9 @@ class SCWImageGenerator:
         
         print(f"📁 Session: {self.session_dir.name}")
         
+        # Holds requests back only while the WebUI is saturated
+        self.pacer = Pacer()
+        
     def check_webui_connection(self) -> bool:
         """Check connection to Stable Diffusion WebUI"""
         try:
@@ -572,9 +598,15 @@ class SCWImageGenerator:
             "restore_faces": True,
         }
         
+        settings = GenerationSettings(steps=steps, cfg_scale=cfg_scale, seed=seed,
+                                      width=width, height=height)
+        self.pacer.wait(settings)
+        
         try:
+            started = time.monotonic()
             response = requests.post(f"{WEBUI_API_URL}/txt2img", json=payload)
             if response.status_code == 200:
+                self.pacer.record(settings, time.monotonic() - started)
                 result = response.json()
                 if result.get("images"):
                     # Decode base64 image
@@ -592,8 +624,17 @@ class SCWImageGenerator:
             if image.mode != "RGB":
                 image = image.convert("RGB")
             
-            # Remove background via rembg
-            output = remove(image)
+            # Solid backdrops are keyed; the rest go through rembg
+            if self.config.KEYING_ENABLED:
+                pixels = np.asarray(image)
+                alpha, _ = key_background(pixels, self.config)
+                if alpha is not None:
+                    return Image.fromarray(apply_masks(pixels[None], alpha[None])[0])
+            
+            # Remove background via rembg, reusing one model session
+            if self._rembg_session is None:
+                self._rembg_session = rembg_session(self.config)
+            output = remove(image, session=self._rembg_session)
             return output
         except Exception as e:
             print(f"Background removal error: {e}")
@@ -660,15 +701,23 @@ class SCWImageGenerator:
             # Skip female-only poses for male characters
             if POSES_CONFIG[pose].get("female_only", False) and character.gender == "m":
                 continue
+            
+            # Only poses and reveal levels selected on the command line
+            reveal_variants = [
+                (variant_idx, reveal_level)
+                for variant_idx, reveal_level in enumerate(POSES_CONFIG[pose].get("reveal_variants", [0]))
+                if self.job_filter.selects(char_id, POSE_ALIAS_MAP.get(pose, pose), reveal_level)
+            ]
+            if not reveal_variants:
+                continue
                 
             print(f"  Pose: {pose}")
             
-            # Reveal variants for this pose
-            reveal_variants = POSES_CONFIG[pose].get("reveal_variants", [0])
             pose_files = []
+            variant_count = len(POSES_CONFIG[pose].get("reveal_variants", [0]))
             
-            for variant_idx, reveal_level in enumerate(reveal_variants):
-                print(f"    Variant {variant_idx + 1}/{len(reveal_variants)} (reveal level: {reveal_level})")
+            for variant_idx, reveal_level in reveal_variants:
+                print(f"    Variant {variant_idx + 1}/{variant_count} (reveal level: {reveal_level})")
                 
                 # Build prompt for this pose and reveal level
                 full_prompt = self.build_pose_prompt(base_prompt, pose, reveal_level, variant_idx, character.gender)
@@ -701,9 +750,6 @@ class SCWImageGenerator:
                     pose_files.append(str(filepath))
                     
                     print(f"      Saved: {filename}")
-                    
-                    # Small delay between generations
-                    time.sleep(1)
                 else:
                     print(f"      Variant generation error {variant_idx + 1}")
             
@@ -809,10 +855,24 @@ def main():
                        help="Path to JSON config with characters")
     parser.add_argument("--count", type=int, default=None,
                        help="Number of characters to generate (with --config)")
+    parser.add_argument("--shard", type=str, metavar="K/N",
+                       help="Generate only the characters in part K of N (stable hash split)")
+    parser.add_argument("--poses", type=str,
+                       help="Comma-separated poses to generate, e.g. cas,uw")
+    parser.add_argument("--reveal", type=str,
+                       help="Reveal levels to generate, e.g. 0,3-5")
+    parser.add_argument("--positions", type=str,
+                       help="Positions of characters in the loaded list, e.g. 1,4-6 "
+                            "(presets here have no names and IDs are random per run)")
     
     args = parser.parse_args()
+    try:
+        job_filter = parse_job_filter(args.shard, args.poses, args.reveal)
+        positions = parse_ranges(args.positions) if args.positions else None
+    except ValueError as e:
+        parser.error(str(e))
     
-    generator = SCWImageGenerator(args.output_dir, args.modkey)
+    generator = SCWImageGenerator(args.output_dir, args.modkey, job_filter)
     
     # Check WebUI connection
     if not generator.check_webui_connection():
@@ -839,6 +899,14 @@ def main():
         print("  --config configs/character_config.json  - load characters from file")
         return
     
+    # Character IDs are random per run, so shards split whole characters; keys
+    # come from the full list so every machine hashes a preset the same way
+    occurrences: Dict[str, int] = {}
+    keyed = [(position, character_key(c, occurrences), c) for position, c in enumerate(characters, 1)]
+    characters = [c for position, key, c in keyed
+                  if (positions is None or position in positions) and job_filter.in_shard(key)]
+    job_filter.shard = None
+    
     if characters:
         print(f"Starting generation for {len(characters)} characters...")
         successful = 0
@@ -868,6 +936,7 @@ def main():
                 continue
         
         print(f"\nGeneration completed. Successfully created: {successful}/{len(characters)} characters")
+        print(f"🚦 Pacing: {generator.pacer.summary()}")
     else:
         print("No characters to generate")
 
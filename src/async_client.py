@@ -0,0 +1,211 @@
+"""
+Asyncio Stable Diffusion WebUI client and bounded generation loop
+"""
+import asyncio
+import functools
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Iterable, List, Optional
+from PIL import Image
+from .config import Config
+from .models import GenerationJob, GenerationResult, GenerationSettings
+from .sd_client import StableDiffusionClient
+from .scheduler import JobScheduler
+
+class AsyncStableDiffusionClient:
+    """Asyncio client for Stable Diffusion WebUI API
+
+    Wraps the blocking StableDiffusionClient: every call runs on a dedicated
+    thread pool sized to the number of requests allowed in flight, sharing one
+    pooled HTTP session.
+    """
+
+    def __init__(self, config: Config = None, max_in_flight: int = None,
+                 client: StableDiffusionClient = None):
+        self.config = config or Config()
+        self.max_in_flight = max(1, max_in_flight or self.config.MAX_IN_FLIGHT)
+        self.client = client or StableDiffusionClient(self.config)
+        self.client.set_pool_size(self.max_in_flight + 1)
+        # One spare worker so connection checks never wait behind generations
+        self._executor = ThreadPoolExecutor(max_workers=self.max_in_flight + 1,
+                                            thread_name_prefix="sd-client")
+
+    async def _call(self, func: Callable, *args):
+        """Run a blocking client call on the executor"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args))
+
+    async def check_connection(self) -> bool:
+        """Check if WebUI API is accessible"""
+        return await self._call(self.client.check_connection)
+
+    async def generate_image(self, prompt: str, negative_prompt: str,
+                             settings: GenerationSettings,
+                             timeout: float = None) -> Optional[Image.Image]:
+        """Generate image using txt2img API"""
+        return await self._call(self.client.generate_image, prompt, negative_prompt,
+                                settings, timeout)
+
+    async def generate_jobs(self, jobs: List[GenerationJob],
+                            timeout: float = None) -> List[Optional[Image.Image]]:
+        """Generate a group of jobs in one request"""
+        return await self._call(self.client.generate_jobs, jobs, timeout)
+
+    def retry_after(self) -> float:
+        """Seconds before the backend takes requests again (0 = go ahead)"""
+        return self.client.retry_after()
+
+    async def get_models(self) -> list:
+        """Get available models"""
+        return await self._call(self.client.get_models)
+
+    async def get_samplers(self) -> list:
+        """Get available samplers"""
+        return await self._call(self.client.get_samplers)
+
+    def close(self):
+        """Shut down worker threads"""
+        self._executor.shutdown(wait=True)
+
+    async def __aenter__(self) -> 'AsyncStableDiffusionClient':
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+class AsyncGenerationLoop:
+    """Keeps a bounded number of txt2img requests queued on the WebUI
+
+    Each of max_in_flight workers holds one request at a time, which may
+    render a batch of jobs. A worker moves on as soon as it has handed the
+    returned images to submit_image (typically ImagePipeline.submit), so the
+    next request is already being rendered while the previous images are
+    background-removed and saved. When the pipeline is full the hand-off
+    waits, which holds back new requests. Jobs that come back without an
+    image are requeued one by one with backoff by the JobScheduler policy
+    until they run out of retries.
+    """
+
+    def __init__(self, client: AsyncStableDiffusionClient,
+                 submit_image: Callable[[GenerationJob, Image.Image], Future],
+                 max_in_flight: int = None,
+                 batcher: Callable[[List[GenerationJob]], List[List[GenerationJob]]] = None,
+                 scheduler: JobScheduler = None):
+        self.client = client
+        self.submit_image = submit_image
+        self.batcher = batcher or (lambda jobs: [[job] for job in jobs])
+        self.max_in_flight = max(1, max_in_flight or client.max_in_flight)
+        self.scheduler = scheduler or JobScheduler(client.config)
+
+    async def run(self, jobs: Iterable[GenerationJob]) -> List[GenerationResult]:
+        """Run all jobs and return results in job order"""
+        jobs = list(jobs)
+        if not jobs:
+            return []
+
+        loop = asyncio.get_running_loop()
+        results: List[Optional[GenerationResult]] = [None] * len(jobs)
+        positions = {id(job): i for i, job in enumerate(jobs)}
+        queue: asyncio.Queue = asyncio.Queue()
+        done = asyncio.Event()
+        remaining = [len(jobs)]
+        in_flight = [0]
+        post_tasks = set()
+
+        for group in self.batcher(jobs):
+            queue.put_nowait((group, 0))
+
+        def resolve(job: GenerationJob, result: GenerationResult):
+            results[positions[id(job)]] = result
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                done.set()
+
+        # Hand-offs may block on a full pipeline; one thread per worker
+        with ThreadPoolExecutor(max_workers=self.max_in_flight,
+                                thread_name_prefix="pipeline-submit") as submit_executor:
+
+            async def finish_job(job: GenerationJob, pending: Future):
+                try:
+                    result = await asyncio.wrap_future(pending)
+                except Exception as e:
+                    result = GenerationResult.failed(job, str(e))
+                resolve(job, result)
+
+            def requeue(group: List[GenerationJob], attempt: int):
+                # One job per retry, so a prompt the WebUI rejects fails alone
+                for job in group:
+                    queue.put_nowait(([job], attempt))
+
+            async def worker():
+                while True:
+                    group, attempt = await queue.get()
+
+                    # Hold submissions while the backend's circuit breaker is open
+                    delay = self.client.retry_after()
+                    while delay > 0:
+                        await asyncio.sleep(delay)
+                        delay = self.client.retry_after()
+
+                    # Hold submissions while the backend is saturated
+                    settings = group[0].settings
+                    delay = self.scheduler.pacer.delay(settings)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                        self.scheduler.pacer.record_throttle(delay)
+
+                    timeout = self.scheduler.timeout_for(settings, len(group))
+                    in_flight[0] += 1
+                    queued = in_flight[0]
+                    started = time.monotonic()
+                    try:
+                        images = await self.client.generate_jobs(group, timeout)
+                    except Exception as e:
+                        print(f"❌ Generation error: {e}")
+                        images = [None] * len(group)
+                    finally:
+                        in_flight[0] -= 1
+
+                    failed = [job for job, image in zip(group, images) if image is None]
+                    if len(failed) < len(group):
+                        self.scheduler.record_success(settings, time.monotonic() - started,
+                                                      len(group) - len(failed), queued)
+
+                    for job, image in zip(group, images):
+                        if image is not None:
+                            try:
+                                pending = await loop.run_in_executor(
+                                    submit_executor, self.submit_image, job, image
+                                )
+                            except Exception as e:
+                                print(f"❌ Could not hand off {job.filename}: {e}")
+                                resolve(job, GenerationResult.failed(job, str(e)))
+                                continue
+                            task = asyncio.ensure_future(finish_job(job, pending))
+                            post_tasks.add(task)
+                            task.add_done_callback(post_tasks.discard)
+
+                    if not failed:
+                        continue
+                    if self.scheduler.should_retry(attempt):
+                        delay = self.scheduler.backoff(attempt + 1)
+                        self.scheduler.record_retry(len(failed))
+                        print(f"🔁 Requeueing {len(failed)} job(s) in {delay:.1f}s "
+                              f"(retry {attempt + 1}/{self.scheduler.max_retries})")
+                        loop.call_later(delay, requeue, failed, attempt + 1)
+                    else:
+                        self.scheduler.record_give_up(len(failed))
+                        for job in failed:
+                            resolve(job, GenerationResult.failed(
+                                job, f"Failed to generate image after {attempt + 1} attempts"
+                            ))
+
+            workers = [asyncio.ensure_future(worker()) for _ in range(self.max_in_flight)]
+            try:
+                await done.wait()
+            finally:
+                for task in workers:
+                    task.cancel()
+                await asyncio.gather(*workers, *post_tasks, return_exceptions=True)
+
+        return results
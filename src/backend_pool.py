@@ -0,0 +1,236 @@
+"""
+Load balancing across several Stable Diffusion WebUI instances
+"""
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+from PIL import Image
+from .config import Config
+from .models import GenerationSettings, GenerationJob, PreflightReport
+from .sd_client import StableDiffusionClient
+from .scheduler import CircuitBreaker
+
+@dataclass
+class Backend:
+    """A single WebUI instance and its load/health state"""
+    url: str
+    client: StableDiffusionClient
+    loaded_checkpoint: Optional[str] = None
+    capable: bool = True  # False when preflight found a missing checkpoint/sampler
+    in_flight: int = 0
+    last_check: float = 0.0
+    completed: int = 0
+    failed: int = 0
+    
+    @property
+    def breaker(self) -> CircuitBreaker:
+        """The client's breaker, fed by transport errors, timeouts and HTTP 5xx"""
+        return self.client.breaker
+    
+    @property
+    def healthy(self) -> bool:
+        """Whether the backend is in rotation (capable and breaker not open)"""
+        return self.capable and self.breaker.state != CircuitBreaker.OPEN
+
+class BackendPool:
+    """Sends each job to the least-loaded healthy WebUI backend
+
+    Exposes the same surface as StableDiffusionClient, so it can be used
+    anywhere a single client is expected (including AsyncStableDiffusionClient).
+    Each backend has a circuit breaker: it leaves rotation after
+    BACKEND_MAX_FAILURES consecutive transport errors, timeouts or HTTP 5xx
+    responses (not jobs that merely come back empty) or a failed ping, is pinged again
+    once the breaker's reset timeout (starting at BACKEND_RECHECK_INTERVAL)
+    elapses, and rejoins for a trial job when /internal/ping answers.
+    """
+
+    def __init__(self, urls: List[str] = None, config: Config = None):
+        self.config = config or Config()
+        urls = urls or self.config.WEBUI_URLS
+        self.backends = [Backend(url=url, client=StableDiffusionClient(self.config, url,
+                                                                       breaker=self._new_breaker()))
+                         for url in urls]
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.backends)
+
+    def check_health(self) -> List[Backend]:
+        """Ping every backend and return the healthy ones"""
+        for backend in self.backends:
+            self._ping(backend)
+        return [b for b in self.backends if b.healthy]
+
+    def check_connection(self) -> bool:
+        """Check if at least one backend is accessible"""
+        return bool(self.check_health())
+
+    def set_pool_size(self, pool_size: int):
+        """Size the HTTP connection pool of every backend"""
+        for backend in self.backends:
+            backend.client.set_pool_size(pool_size)
+
+    def preflight(self, checkpoint: str = None, sampler: str = None,
+                  overrides: Dict[str, str] = None) -> PreflightReport:
+        """Preflight every healthy backend; incapable ones leave rotation"""
+        report = PreflightReport()
+        for backend in self.backends:
+            if not backend.healthy:
+                continue
+            backend_report = backend.client.preflight(checkpoint, sampler, overrides)
+            backend.loaded_checkpoint = backend_report.loaded_checkpoint
+            if not backend_report.ok:
+                backend.capable = False
+                report.errors.extend(backend_report.errors)
+            elif report.checkpoint is None:
+                report.checkpoint = backend_report.checkpoint
+                report.checkpoint_hash = backend_report.checkpoint_hash
+                report.checkpoint_overrides = backend_report.checkpoint_overrides
+                report.checkpoint_hashes = backend_report.checkpoint_hashes
+                report.loaded_checkpoint = backend_report.loaded_checkpoint
+
+        if report.checkpoint is None and not report.errors:
+            report.errors.append("No healthy WebUI backend available")
+        elif report.checkpoint is not None:
+            # Some backends are usable; run on those
+            for error in report.errors:
+                print(f"⚠️ {error} (backend out of rotation)")
+            report.errors = []
+        return report
+
+    def acquire(self, checkpoint: str = None) -> Optional[Backend]:
+        """Reserve the least-loaded backend whose breaker lets a request through
+
+        Backends that already have the job's checkpoint loaded are preferred,
+        so a run spread over several GPUs doesn't make them swap models.
+        """
+        self._recheck_failed_backends()
+
+        def load_order(b: Backend):
+            swap = bool(checkpoint) and b.loaded_checkpoint not in (None, checkpoint)
+            return (swap, b.in_flight, b.completed)
+
+        with self._lock:
+            for backend in sorted(self.backends, key=load_order):
+                if backend.healthy and backend.breaker.allow():
+                    backend.in_flight += 1
+                    return backend
+            return None
+
+    def release(self, backend: Backend, success: bool, checkpoint: str = None):
+        """Return a backend to the pool and record the job outcome
+
+        The backend's breaker has already seen the request (the client feeds
+        it), so a job that only came back empty does not count against it.
+        """
+        with self._lock:
+            backend.in_flight -= 1
+            if success:
+                backend.completed += 1
+                if checkpoint:
+                    backend.loaded_checkpoint = checkpoint
+            else:
+                backend.failed += 1
+
+    def generate_image(self, prompt: str, negative_prompt: str,
+                       settings: GenerationSettings, timeout: float = None) -> Optional[Image.Image]:
+        """Generate image on the least-loaded backend"""
+        backend = self.acquire(settings.checkpoint)
+        if backend is None:
+            print("❌ No healthy WebUI backend available")
+            return None
+
+        image = None
+        try:
+            image = backend.client.generate_image(prompt, negative_prompt, settings, timeout)
+        finally:
+            self.release(backend, image is not None, settings.checkpoint)
+        return image
+
+    def generate_jobs(self, jobs: List[GenerationJob],
+                      timeout: float = None) -> List[Optional[Image.Image]]:
+        """Generate a group of jobs in one request on the least-loaded backend"""
+        checkpoint = jobs[0].settings.checkpoint
+        backend = self.acquire(checkpoint)
+        if backend is None:
+            print("❌ No healthy WebUI backend available")
+            return [None] * len(jobs)
+
+        images = []
+        try:
+            images = backend.client.generate_jobs(jobs, timeout)
+        finally:
+            self.release(backend, any(image is not None for image in images), checkpoint)
+        return images
+
+    def refine_image(self, image: Image.Image, prompt: str, negative_prompt: str,
+                     settings: GenerationSettings, denoising_strength: float,
+                     timeout: float = None) -> Optional[Image.Image]:
+        """img2img on the least-loaded backend"""
+        backend = self.acquire(settings.checkpoint)
+        if backend is None:
+            print("❌ No healthy WebUI backend available")
+            return None
+
+        refined = None
+        try:
+            refined = backend.client.refine_image(image, prompt, negative_prompt, settings,
+                                                  denoising_strength, timeout)
+        finally:
+            self.release(backend, refined is not None, settings.checkpoint)
+        return refined
+
+    def retry_after(self) -> float:
+        """Seconds until a backend may take a request again (0 = one is in rotation)"""
+        with self._lock:
+            capable = [b for b in self.backends if b.capable]
+            if not capable or any(b.healthy for b in capable):
+                return 0.0
+            return max(min(b.breaker.retry_after() for b in capable), 1.0)
+
+    def get_models(self) -> list:
+        """Get available models from the first healthy backend"""
+        for backend in self.backends:
+            if backend.healthy:
+                return backend.client.get_models()
+        return []
+
+    def get_samplers(self) -> list:
+        """Get available samplers from the first healthy backend"""
+        for backend in self.backends:
+            if backend.healthy:
+                return backend.client.get_samplers()
+        return []
+
+    def _new_breaker(self) -> CircuitBreaker:
+        return CircuitBreaker(self.config.BACKEND_MAX_FAILURES,
+                              self.config.BACKEND_RECHECK_INTERVAL,
+                              self.config.BREAKER_MAX_RESET_TIMEOUT)
+
+    def _recheck_failed_backends(self):
+        """Ping backends that are out of rotation once their breaker timeout elapsed"""
+        now = time.monotonic()
+        with self._lock:
+            due = [b for b in self.backends
+                   if b.capable and not b.healthy and b.breaker.retry_after() <= 0
+                   and now - b.last_check >= self.config.BACKEND_RECHECK_INTERVAL]
+            for backend in due:
+                backend.last_check = now
+
+        for backend in due:
+            self._ping(backend)
+
+    def _ping(self, backend: Backend) -> bool:
+        """Ping a backend and update its breaker"""
+        alive = backend.client.check_connection()
+        with self._lock:
+            backend.last_check = time.monotonic()
+            if alive and not backend.healthy:
+                print(f"✅ Backend {backend.url} back in rotation")
+                backend.breaker.half_open()
+            elif not alive:
+                if backend.healthy:
+                    print(f"⚠️ Backend {backend.url} not responding, out of rotation")
+                backend.breaker.trip()
+        return alive
@@ -0,0 +1,48 @@
+"""
+Grouping of generation jobs into multi-prompt txt2img requests
+
+A group is one HTTP request, not one GPU batch: the WebUI renders the
+script's lines one after another, so grouping saves round trips and
+per-request setup but not GPU time.
+"""
+from typing import Callable, Hashable, List, Tuple
+from .models import GenerationJob
+
+def settings_key(job: GenerationJob) -> Tuple:
+    """Settings that must match for jobs to share a multi-prompt request"""
+    settings = job.settings
+    return (settings.steps, settings.cfg_scale, settings.sampler, settings.width, settings.height,
+            settings.checkpoint)
+
+def variant_key(job: GenerationJob) -> Tuple:
+    """Reveal variants of one pose share this key: character, pose, seed and settings"""
+    return (job.char_id, job.pose, job.settings.seed) + settings_key(job)
+
+def group_pose_variants(jobs: List[GenerationJob], max_prompts: int) -> List[List[GenerationJob]]:
+    """Group consecutive reveal variants of a pose into one request
+
+    Variants share a seed but not a prompt, so they cannot be one
+    batch_size batch; they go out as lines of the prompts-from-file script,
+    each with its own prompt and seed, rendering exactly what one request
+    per variant would, in fewer requests. Job order is preserved.
+    """
+    return _group_consecutive(jobs, variant_key, max_prompts)
+
+def group_multi_prompt_jobs(jobs: List[GenerationJob], max_prompts: int) -> List[List[GenerationJob]]:
+    """Group consecutive jobs with shared settings into multi-prompt requests
+
+    Like group_pose_variants, but across poses and characters: any jobs
+    with the same size, steps, CFG, sampler and checkpoint are packed, at
+    most max_prompts prompt lines per request. Job order is preserved.
+    """
+    return _group_consecutive(jobs, settings_key, max_prompts)
+
+def _group_consecutive(jobs: List[GenerationJob], key: Callable[[GenerationJob], Hashable],
+                       max_size: int) -> List[List[GenerationJob]]:
+    groups: List[List[GenerationJob]] = []
+    for job in jobs:
+        if groups and len(groups[-1]) < max_size and key(groups[-1][0]) == key(job):
+            groups[-1].append(job)
+        else:
+            groups.append([job])
+    return groups
@@ -0,0 +1,125 @@
+"""
+Deterministic character ID allocation
+"""
+import hashlib
+import json
+import os
+import re
+from dataclasses import asdict
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from .models import CharacterAttributes
+
+# <modkey>-<id>-... as used by both headshot and body filenames
+_FILENAME_ID = re.compile(r"^[^-]+-(\d{5})-")
+
+# ID ranges per gender: (first ID, number of IDs)
+_ID_RANGES = {
+    "f": (0, 50000),
+    "m": (10000, 10000),
+}
+
+def character_key(character: CharacterAttributes, occurrences: Dict[str, int]) -> str:
+    """Stable key of a preset within a run (name + attributes + occurrence number)
+
+    occurrences counts presets seen so far, so identical presets listed
+    twice get distinct keys.
+    """
+    digest = hashlib.sha1(
+        json.dumps(asdict(character), sort_keys=True).encode()
+    ).hexdigest()[:16]
+    occurrences[digest] = occurrences.get(digest, 0) + 1
+    return f"{digest}-{occurrences[digest]}"
+
+def preset_ids(keyed: List[Tuple[str, CharacterAttributes]]) -> Dict[str, str]:
+    """IDs for a whole preset list that depend on nothing but the list
+
+    Each preset gets its hash-derived ID, or the next one in its gender's
+    range not already given to an earlier preset of the list. Every machine
+    handed the same list (whatever subset it renders) gets the same IDs,
+    which is what --shard needs; IDs on disk are not consulted.
+    """
+    ids: Dict[str, str] = {}
+    taken: Set[str] = set()
+    for key, character in keyed:
+        ids[key] = _free_id(key, character, taken)
+        taken.add(ids[key])
+    return ids
+
+def _free_id(key: str, character: CharacterAttributes, taken: Set[str]) -> str:
+    """First ID from the key's hash-derived position in its gender's range not in taken"""
+    first, count = _ID_RANGES["f" if character.gender == "f" else "m"]
+    start = int(hashlib.sha1(key.encode()).hexdigest(), 16) % count
+    for offset in range(count):
+        candidate = f"{first + (start + offset) % count:05d}"
+        if candidate not in taken:
+            return candidate
+    raise RuntimeError(f"No free character IDs left for gender '{character.gender}'")
+
+class CharacterIdRegistry:
+    """Assigns each preset a stable 5-digit character ID
+
+    The first choice is derived from a hash of the preset key. If that ID is
+    already taken, the next free ID in the gender's range is used. Taken
+    means assigned to another preset in the registry, or used by any image
+    in the output tree or game folder. Assignments are saved to the registry
+    file, so a preset keeps its ID (and seed) across runs. All lookups use
+    in-memory sets and dicts; the image folders are scanned once.
+    """
+
+    def __init__(self, registry_path: Path, scan_dirs: Iterable[Path] = ()):
+        self.registry_path = Path(registry_path)
+        self._ids: Dict[str, str] = {}
+        if self.registry_path.is_file():
+            with open(self.registry_path, 'r', encoding='utf-8') as f:
+                self._ids = json.load(f)
+        self._taken: Set[str] = set(self._ids.values())
+        self._on_disk: Set[str] = set()
+        for directory in scan_dirs:
+            self._on_disk.update(self._scan(Path(directory)))
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def get(self, key: str) -> Optional[str]:
+        """ID already assigned to a preset key"""
+        return self._ids.get(key)
+
+    def allocate(self, key: str, character: CharacterAttributes) -> str:
+        """ID for a preset, assigning and saving a new one if needed"""
+        char_id = self._ids.get(key)
+        if char_id is not None:
+            return char_id
+
+        return self.assign(key, _free_id(key, character, self._taken | self._on_disk))
+
+    def assign(self, key: str, char_id: str) -> str:
+        """Record an ID decided elsewhere (see preset_ids) for a preset key"""
+        if self._ids.get(key) != char_id:
+            if char_id in self._taken or char_id in self._on_disk:
+                print(f"⚠️ Character ID {char_id} is already used by another preset or image")
+            self._ids[key] = char_id
+            self._taken.add(char_id)
+            self._save()
+        return char_id
+
+    def _save(self):
+        """Write the registry atomically"""
+        self.registry_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.registry_path.with_name(self.registry_path.name + ".tmp")
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._ids, f, indent=2, sort_keys=True)
+        os.replace(temp_path, self.registry_path)
+
+    @staticmethod
+    def _scan(directory: Path) -> Tuple[str, ...]:
+        """IDs used by image filenames anywhere below a directory"""
+        if not directory.is_dir():
+            return ()
+        ids = []
+        for _, _, filenames in os.walk(directory):
+            for filename in filenames:
+                match = _FILENAME_ID.match(filename)
+                if match and filename.endswith(".png"):
+                    ids.append(match.group(1))
+        return tuple(ids)
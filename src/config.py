@@ -11,6 +11,10 @@ class Config:
     # API Configuration
     WEBUI_URL = os.getenv("WEBUI_URL", "http://localhost:7860")
     WEBUI_API_URL = f"{WEBUI_URL}/sdapi/v1"
+    # Comma-separated list of WebUI instances (one per GPU); defaults to WEBUI_URL
+    WEBUI_URLS = [url.strip() for url in os.getenv("WEBUI_URLS", WEBUI_URL).split(",") if url.strip()]
+    BACKEND_MAX_FAILURES = 3  # Consecutive failures before a backend leaves rotation
+    BACKEND_RECHECK_INTERVAL = 30  # Seconds between health checks of failed backends
     
     # Image Generation Settings
     DEFAULT_STEPS = 30
@@ -19,19 +23,134 @@ class Config:
     HEADSHOT_STEPS = 40
     HEADSHOT_CFG_SCALE = 8.0
     
+    # Run Planning
+    POSE_PRIORITY: Dict[str, int] = {}  # Tier per pose (lower first); default: required 0, others 1
+    
+    # Run Estimates (--plan; used until earlier runs have recorded real timings)
+    TIMING_HISTORY = "timing_history.json"  # Per-resolution GPU time and file size, in the output dir
+    ESTIMATE_SECONDS_PER_MPX_STEP = 0.3  # GPU seconds per megapixel per sampling step
+    ESTIMATE_BYTES_PER_PIXEL = 1.5  # Saved RGBA PNG bytes per target-size pixel
+    
+    # Checkpoint Settings
+    SD_MODEL_CHECKPOINT = os.getenv("SD_MODEL_CHECKPOINT", "")  # Title, name or hash ("" = loaded model)
+    PIN_CHECKPOINT = True  # Pin every job to the checkpoint via override_settings
+    CHECKPOINT_OVERRIDES: Dict[str, str] = {}  # Per-pose checkpoints, e.g. {"head": "portrait_v2"}
+    
     # Image Sizes
     BODY_GENERATION_SIZE = (640, 1024)
     BODY_TARGET_SIZE = (512, 800)
     HEAD_GENERATION_SIZE = (360, 480)
     HEAD_TARGET_SIZE = (120, 160)
     
+    # Headshots From Body Renders
+    HEADSHOT_MODE = os.getenv("HEADSHOT_MODE", "txt2img")  # "txt2img" (own render at HEAD_GENERATION_SIZE) or "body" (cropped from a body render)
+    HEADSHOT_SOURCE_POSE = "cas"  # Body pose whose reveal level 0 render headshots are cropped from (same tier as "head")
+    HEADSHOT_HEAD_FRACTION = 0.13  # Head length as a share of the subject's height (about 1/7.5)
+    HEADSHOT_CROP_HEADS = 2.0  # Crop height in head lengths (head, neck and shoulders)
+    HEADSHOT_CROP_MARGIN = 0.25  # Space left above the head, in head lengths
+    HEADSHOT_REFINE = False  # Low-denoise img2img pass over each crop at HEAD_GENERATION_SIZE
+    HEADSHOT_REFINE_DENOISE = 0.3  # img2img denoising strength of the refinement pass
+    HEADSHOT_REFINE_STEPS = 20  # Sampling steps of the refinement pass
+    
     # File Settings
     DEFAULT_MODKEY = "custom"
     DEFAULT_OUTPUT_DIR = "generated_characters"
+    SESSION_DB_NAME = "jobs.sqlite3"  # Job state kept in each session directory for --resume
+    CHARACTER_ID_REGISTRY = "character_ids.json"  # Preset -> character ID, in the output dir
+    GAME_CHARACTER_DIR = os.getenv("SCW_GAME_CHARACTER_DIR", "")  # IDs used here are never assigned
+    
+    # Shared Work Queue (--queue, several render nodes on one pack directory)
+    QUEUE_DB_NAME = "queue.sqlite3"
+    QUEUE_LEASE_SECONDS = 300  # A dead node's jobs are handed out again after this
+    QUEUE_LEASE_BATCH = 8  # Jobs leased per round trip to the queue
+    QUEUE_MAX_ATTEMPTS = 3  # Failed jobs are retried by any node until this many failures
+    QUEUE_POLL_INTERVAL = 15  # Seconds between checks while other nodes hold the last jobs
     
     # Generation Settings
-    DELAY_BETWEEN_GENERATIONS = 2
     MAX_RETRIES = 3
+    RETRY_BACKOFF_BASE = 2.0  # Seconds before the first retry, doubled per attempt
+    RETRY_BACKOFF_MAX = 60.0
+    
+    # Timeouts (learned per resolution/steps once enough latency samples exist)
+    REQUEST_TIMEOUT = 300  # Used until latency has been observed
+    MIN_REQUEST_TIMEOUT = 30
+    TIMEOUT_FACTOR = 3.0  # Timeout = factor x high-percentile latency per image
+    LATENCY_EWMA_ALPHA = 0.2
+    LATENCY_MIN_SAMPLES = 3
+    
+    # Progress Watching
+    WATCH_PROGRESS = True  # Poll /progress while requests run and interrupt stalls
+    PROGRESS_POLL_INTERVAL = 2.0
+    STALL_TIMEOUT = 90  # Seconds without step progress before interrupting
+    
+    # Pacing (submissions wait only while the WebUI is saturated)
+    PACER_WINDOW = 5  # Recent requests considered per resolution/steps
+    PACER_LATENCY_FACTOR = 2.0  # Saturated when typical latency exceeds this x the best seen
+    PACER_MAX_DELAY = 30.0
+    
+    # Circuit Breaker
+    BREAKER_FAILURE_THRESHOLD = 5  # Consecutive transport errors, timeouts or HTTP 5xx before the WebUI pauses
+    BREAKER_RESET_TIMEOUT = 30  # Seconds before a trial request is let through
+    BREAKER_MAX_RESET_TIMEOUT = 300
+    
+    # Concurrency Settings
+    MAX_IN_FLIGHT = int(os.getenv("MAX_IN_FLIGHT", "2"))  # Queued txt2img requests per backend (1 = serial)
+    POSTPROCESS_WORKERS = 2  # Background removal/encode workers
+    POSTPROCESS_PROCESSES = True  # Run post-processing in worker processes (False = threads)
+    PIPELINE_QUEUE_SIZE = 8  # Images between generation and disk before new requests wait
+    POSTPROCESS_MODE = "numpy"  # "numpy" (array path, reused canvases) or "pil" (image per step)
+    
+    # Background Removal
+    REMBG_MODEL = os.getenv("REMBG_MODEL", "u2net")  # u2net, u2netp, silueta, isnet-general-use, ...
+    MATTING_ENGINE = "rembg"  # "rembg" (one image per call) or "batch" (onnxruntime on stacked batches)
+    MATTING_BATCH_SIZE = 4  # Body images per model run with the batch engine
+    MATTING_BATCH_WAIT = 2.0  # Seconds a partial batch waits for more images
+    MATTING_MODEL_PATH = os.getenv("MATTING_MODEL_PATH", "")  # "" = rembg's copy of REMBG_MODEL
+    MATTING_LOWRES = False  # Shrink bodies first, infer the mask small, guided-filter it to target size
+    MATTING_GUIDED_RADIUS = 4  # Guided filter window radius in target-size pixels
+    MATTING_GUIDED_EPS = 1e-3  # Guided filter regularization (higher = smoother alpha)
+    MATTING_INTRA_OP_THREADS = int(os.getenv("MATTING_INTRA_OP_THREADS", "0"))  # 0 = cores / POSTPROCESS_WORKERS
+    MATTING_INTER_OP_THREADS = 0  # 0 = onnxruntime default
+    MATTING_PROVIDERS: List[str] = []  # onnxruntime execution providers ([] = all available)
+    MATTING_BENCHMARK_MODELS = ["u2net", "u2netp", "silueta", "isnet-general-use"]
+    MATTING_BENCHMARK_REFERENCE = "isnet-general-use"  # Heavy model the others are compared against
+    MATTING_BENCHMARK_IMAGES = 16  # Sample images timed per option
+    
+    # PNG Encoding
+    PNG_FILTERS = ["none", "sub", "up", "average", "paeth", "adaptive"]  # Row filter choices searched per image
+    PNG_SEARCH_LEVEL = 1  # zlib level the filter choices are ranked at (fast; ranks like level 9)
+    PNG_ZLIB_LEVEL = 9  # zlib level of the written file
+    PNG_ZLIB_STRATEGIES = ["filtered"]  # zlib strategies tried for the written file ("default", "filtered", "rle")
+    PNG_PALETTE_HEADSHOTS = False  # Try a (lossy) palette of up to 256 colours for headshots (--palette-headshots)
+    PNG_PALETTE_MIN_PSNR = 40.0  # A palette is used only at or above this PSNR (dB) against the original
+    PNG_BYTE_BUDGET = 0  # Max bytes per image (0 = none); images over it try a palette too
+    PACK_BYTE_BUDGET = 0  # Max bytes per pack (0 = none); reported per session, --optimize-pack spreads it
+    
+    # Solid-Background Keying (tried before the matting model)
+    KEYING_ENABLED = True  # Key near-uniform backdrops, matting model only where the key is unsure
+    KEYING_TOLERANCE = 18  # Max channel difference from the fitted backdrop counted as background
+    KEYING_SOFTNESS = 24  # Difference over which edge alpha ramps from 0 to 255
+    KEYING_FEATHER = 1.0  # Gaussian radius applied to the keyed alpha
+    KEYING_MIN_BORDER_AGREEMENT = 0.9  # Share of border pixels that must match the backdrop
+    KEYING_COVERAGE = (0.05, 0.85)  # Foreground share of the image a key may produce
+    KEYING_EDGE_CONTRAST = 48  # Difference a subject edge must reach within 2 px of the key boundary
+    KEYING_MIN_EDGE_CONSISTENCY = 0.9  # Share of edge pixels that must reach KEYING_EDGE_CONTRAST
+    KEYING_MAX_ENCLOSED = 0.02  # Backdrop-coloured pockets inside the subject (e.g. between arm and body)
+    
+    # Response Decoding
+    STREAM_DECODE = True  # Decode images while the response streams in
+    STREAM_CHUNK_SIZE = 256 * 1024
+    
+    # Render Cache (raw txt2img outputs keyed by prompt, settings, seed and checkpoint hash)
+    RENDER_CACHE = True
+    RENDER_CACHE_DIR = os.getenv("RENDER_CACHE_DIR", "")  # "" = .render_cache in the output dir
+    RENDER_CACHE_MAX_MB = 4096  # Least recently used entries are evicted above this size
+    
+    # Multi-prompt Settings ("prompts from file or textbox" script)
+    BATCH_JOBS = True  # Send the reveal variants of a pose as one multi-prompt request (fewer requests, same GPU time)
+    MULTI_PROMPT_JOBS = False  # Pack distinct prompts with shared settings across poses and characters
+    MULTI_PROMPT_MAX = 16  # Prompt lines per request
+    PROMPTS_FROM_FILE_SCRIPT = "prompts from file or textbox"
     
     # Quality Settings
     BASE_PROMPT_QUALITY = "masterpiece, best quality, high resolution, detailed, realistic, photorealistic"
@@ -125,6 +244,9 @@ class PoseConfig:
         "preg": {"reveal_variants": [0, 1, 2], "required": False, "description": "pregnant", "female_only": True},
     }
     
+    # Poses generated when none are given; female_only poses are skipped for men
+    DEFAULT_POSES = ["head", "cas", "uw", "nude", "bc", "fun", "tl", "ss", "s1"]
+    
     # Alias mappings for pose compatibility
     POSE_ALIAS_MAP = {
         "business": "biz",
@@ -3,52 +3,275 @@ Main character image generator
 """
 import os
 import json
+import asyncio
 import hashlib
-import random
+import socket
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import replace
 from datetime import datetime
 from pathlib import Path
-from typing import List, Dict, Optional, Tuple
+from typing import List, Dict, Optional, Set, Tuple
 
-from .models import CharacterAttributes, GenerationSettings, GenerationResult
+from PIL import Image
+
+from .models import CharacterAttributes, GenerationSettings, GenerationResult, GenerationJob, RunPlan
 from .config import Config, PoseConfig
 from .prompt_generator import PromptGenerator
 from .sd_client import StableDiffusionClient
-from .image_processor import ImageProcessor
+from .backend_pool import BackendPool
+from .async_client import AsyncStableDiffusionClient, AsyncGenerationLoop
+from .pipeline import ImagePipeline, resolved
+from .job_store import JobStore, DONE, FAILED, PENDING
+from .work_queue import SharedWorkQueue
+from .render_cache import RenderCache
+from .character_ids import CharacterIdRegistry, character_key, preset_ids
+from .timing_history import TimingHistory
+from .planner import JobFilter, default_poses, derives_headshot, plan_tiers, render_key
+from .scheduler import JobScheduler, order_by_checkpoint
+from .batching import group_multi_prompt_jobs, group_pose_variants
 
 class CharacterImageGenerator:
     """Main character image generator class"""
     
-    def __init__(self, output_dir: str = None, modkey: str = None):
+    def __init__(self, output_dir: str = None, modkey: str = None, max_in_flight: int = None,
+                 webui_urls: List[str] = None, multi_prompt: bool = None,
+                 stall_timeout: float = None, checkpoint: str = None,
+                 postprocess_workers: int = None, resume_session: str = None,
+                 render_cache: bool = None, work_queue: str = None,
+                 job_filter: JobFilter = None, palette_headshots: bool = None):
         self.config = Config()
+        if checkpoint:
+            self.config.SD_MODEL_CHECKPOINT = checkpoint
+        if palette_headshots is not None:
+            self.config.PNG_PALETTE_HEADSHOTS = palette_headshots
+        if stall_timeout is not None:
+            # 0 disables progress watching
+            self.config.WATCH_PROGRESS = stall_timeout > 0
+            self.config.STALL_TIMEOUT = stall_timeout or self.config.STALL_TIMEOUT
         self.pose_config = PoseConfig()
         self.modkey = modkey or self.config.DEFAULT_MODKEY
         self.output_dir = output_dir or self.config.DEFAULT_OUTPUT_DIR
+        self.max_in_flight = max_in_flight or self.config.MAX_IN_FLIGHT
+        self.multi_prompt = self.config.MULTI_PROMPT_JOBS if multi_prompt is None else multi_prompt
+        self.job_filter = job_filter or JobFilter()
         
         # Initialize components
         self.prompt_generator = PromptGenerator()
-        self.sd_client = StableDiffusionClient(self.config)
-        self.image_processor = ImageProcessor(self.config)
+        self.webui_urls = webui_urls or self.config.WEBUI_URLS
+        if len(self.webui_urls) > 1:
+            self.sd_client = BackendPool(self.webui_urls, self.config)
+        else:
+            self.sd_client = StableDiffusionClient(self.config, self.webui_urls[0])
+        # GPU time and file sizes per resolution, accumulated across runs for --plan
+        self.timing_history = TimingHistory(Path(self.output_dir) / self.config.TIMING_HISTORY)
+        self.scheduler = JobScheduler(self.config, len(self.webui_urls), self.timing_history)
+        
+        # Checkpoints pinned by preflight (title of the model, per-pose overrides)
+        self.checkpoint: Optional[str] = None
+        self.checkpoint_overrides: Dict[str, str] = {}
+        self._last_checkpoint: Optional[str] = None
+        self.checkpoint_hashes: Dict[Optional[str], str] = {}
+        
+        # Create session directory, or reopen an interrupted one; with a shared
+        # work queue the queue's directory is the session and every node's output
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+        if work_queue:
+            self.session_dir = Path(work_queue)
+            self.session_dir.mkdir(parents=True, exist_ok=True)
+            self.job_store = SharedWorkQueue(self.session_dir / self.config.QUEUE_DB_NAME,
+                                             self.config)
+        else:
+            if resume_session:
+                self.session_dir = self._resume_session_directory(resume_session)
+            else:
+                self.session_dir = self._create_session_directory()
+            self.job_store = JobStore(self.session_dir / self.config.SESSION_DB_NAME)
+        self._character_occurrences: Dict[str, int] = {}
         
-        # Create session directory
-        self.session_dir = self._create_session_directory()
+        # Preset -> character ID, avoiding IDs used in the output tree or game folder
+        scan_dirs = [Path(self.output_dir)]
+        if self.config.GAME_CHARACTER_DIR:
+            scan_dirs.append(Path(self.config.GAME_CHARACTER_DIR))
+        self.id_registry = CharacterIdRegistry(
+            Path(self.output_dir) / self.config.CHARACTER_ID_REGISTRY, scan_dirs
+        )
+        # With --shard, IDs of the whole preset list, the same on every machine
+        self._preset_ids: Optional[Dict[str, str]] = None
+        
+        # Raw renders are reused across runs when prompt, settings, seed and model match
+        if self.config.RENDER_CACHE if render_cache is None else render_cache:
+            cache_dir = self.config.RENDER_CACHE_DIR or Path(self.output_dir) / ".render_cache"
+            self.render_cache = RenderCache(cache_dir, self.config.RENDER_CACHE_MAX_MB * 1024 * 1024)
+        else:
+            self.render_cache = None
+        
+        # Background removal, resize, encode and save run here, overlapping generation
+        self.pipeline = ImagePipeline(self.session_dir, self.config, postprocess_workers)
+        
+        # HEADSHOT_MODE "body": headshot jobs waiting for their body render (by the
+        # body's filename), and the results of those handed to the pipeline
+        self._derived_heads: Dict[str, GenerationJob] = {}
+        self._derived_results: Dict[str, Future] = {}
+        self._headshots: Optional[ThreadPoolExecutor] = None
+        
+        # Filenames the pipeline has already recorded in the job store this run
+        self._recorded: Set[str] = set()
         
         print(f"📁 Session: {self.session_dir.name}")
     
     def check_webui_connection(self) -> bool:
         """Check WebUI connection"""
-        if self.sd_client.check_connection():
-            print(f"Connected to WebUI: {self.config.WEBUI_URL}")
-            return True
+        if isinstance(self.sd_client, BackendPool):
+            healthy = self.sd_client.check_health()
+            for backend in self.sd_client.backends:
+                status = "Connected to" if backend.healthy else "❌ Cannot connect to"
+                print(f"{status} WebUI: {backend.url}")
+            if healthy:
+                return self.run_preflight()
+        elif self.sd_client.check_connection():
+            print(f"Connected to WebUI: {self.sd_client.base_url}")
+            return self.run_preflight()
         else:
-            print(f"❌ Cannot connect to WebUI at {self.config.WEBUI_URL}")
-            print("Make sure Stable Diffusion WebUI is running with --api flag")
+            print(f"❌ Cannot connect to WebUI at {self.sd_client.base_url}")
+        print("Make sure Stable Diffusion WebUI is running with --api flag")
+        return False
+    
+    def run_preflight(self) -> bool:
+        """Check checkpoint and sampler once, and pin the checkpoint for all jobs"""
+        report = self.sd_client.preflight(
+            self.config.SD_MODEL_CHECKPOINT or None,
+            self.config.DEFAULT_SAMPLER,
+            self.config.CHECKPOINT_OVERRIDES
+        )
+        if not report.ok:
+            for error in report.errors:
+                print(f"❌ Preflight: {error}")
             return False
+        
+        print(f"🧩 Checkpoint: {report.checkpoint}, sampler: {self.config.DEFAULT_SAMPLER}")
+        self.checkpoint_hashes = dict(report.checkpoint_hashes)
+        if self.config.PIN_CHECKPOINT:
+            self.checkpoint = report.checkpoint
+            self.checkpoint_overrides = report.checkpoint_overrides
+            self._last_checkpoint = report.loaded_checkpoint
+        elif report.loaded_checkpoint in report.checkpoint_hashes:
+            # Unpinned jobs render with whatever model is loaded
+            self.checkpoint_hashes[None] = report.checkpoint_hashes[report.loaded_checkpoint]
+        return True
+    
+    def _checkpoint_for(self, pose: str) -> Optional[str]:
+        """Pinned checkpoint for a pose"""
+        return self.checkpoint_overrides.get(pose, self.checkpoint)
+    
+    @property
+    def total_in_flight(self) -> int:
+        """Requests kept queued across all healthy backends"""
+        if isinstance(self.sd_client, BackendPool):
+            return self.max_in_flight * max(1, sum(b.healthy for b in self.sd_client.backends))
+        return self.max_in_flight
     
     def generate_character_images(self, character: CharacterAttributes, 
                                 poses: List[str] = None) -> Dict[str, List[GenerationResult]]:
-        """Generate all images for a character"""
-        char_id = self._generate_character_id(character)
+        """Generate all images for a character
+        
+        A character started in an earlier run of this session keeps its ID and
+        only its jobs without output are rendered again.
+        """
+        char_id, pose_jobs, done = self._plan_character(character, poses)
+        if char_id is None:
+            return {}
+        
+        if self.total_in_flight > 1 or derives_headshot("head", self.config):
+            results = self._generate_poses_async(pose_jobs)
+        else:
+            results = {}
+            # Run poses grouped by checkpoint, starting with the one already loaded
+            ordered_poses = order_by_checkpoint(
+                list(pose_jobs), lambda p: pose_jobs[p][0].settings.checkpoint,
+                self._last_checkpoint
+            )
+            pending = {}
+            for pose in ordered_poses:
+                self._last_checkpoint = pose_jobs[pose][0].settings.checkpoint
+                pending[pose] = self._submit_jobs(pose_jobs[pose])
+            
+            # Post-processing of earlier poses overlapped the later requests
+            for pose, futures in pending.items():
+                results[pose] = [future.result() for future in futures]
+                for result in results[pose]:
+                    self._report_result(result)
+        
+        for result in done:
+            results.setdefault(result.pose, []).append(result)
+        
+        total_images = 0
+        for pose, pose_results in results.items():
+            successful_results = [r for r in pose_results if r.success]
+            total_images += len(successful_results)
+            print(f"    ✅ Created {len(successful_results)} variants for pose {pose}")
+        
+        print(f"✓ Generated {total_images} images ({len(results)} poses)")
+        return results
+    
+    def plan_run(self, characters: List[CharacterAttributes]) -> RunPlan:
+        """Build every job of a run up front, ordered by priority then resolution"""
+        plan = RunPlan()
+        jobs = []
+        for character in characters:
+            char_id, pose_jobs, done = self._plan_character(character)
+            if char_id is None:
+                continue
+            plan.char_ids.append(char_id)
+            plan.done[char_id] = done
+            jobs.extend(job for jobs_for_pose in pose_jobs.values() for job in jobs_for_pose)
+        
+        plan.tiers = plan_tiers(jobs, self.config, self.pose_config)
+        print(f"\n🗺️ Planned {plan.total_jobs} jobs for {len(plan.char_ids)} characters "
+              f"({sum(len(done) for done in plan.done.values())} already saved)")
+        for priority, tier_jobs in plan.tiers:
+            sizes = sorted({render_key(job, self.config) for job in tier_jobs})
+            print(f"   Tier {priority}: {len(tier_jobs)} jobs, "
+                  f"{', '.join(f'{w}x{h}@{steps}' for w, h, steps in sizes)}")
+        return plan
+    
+    def run_plan(self, plan: RunPlan) -> Dict[str, List[GenerationResult]]:
+        """Run a plan tier by tier; returns results per character ID
+        
+        Each tier completes before the next starts, so the required core pack
+        is finished first in a long run.
+        """
+        results = {char_id: list(plan.done.get(char_id, [])) for char_id in plan.char_ids}
+        
+        for priority, tier_jobs in plan.tiers:
+            print(f"\n🎯 Tier {priority}: {len(tier_jobs)} jobs")
+            tier_results = self.run_jobs(tier_jobs)
+            for job, result in zip(tier_jobs, tier_results):
+                results[job.char_id].append(result)
+            print(f"✅ Tier {priority} complete: "
+                  f"{sum(r.success for r in tier_results)}/{len(tier_jobs)} images")
+        return results
+    
+    def _plan_character(self, character: CharacterAttributes, poses: List[str] = None
+                        ) -> Tuple[str, Dict[str, List[GenerationJob]], List[GenerationResult]]:
+        """Jobs still to render for a character: (char_id, jobs per pose, saved results)
+        
+        A character started in an earlier run of this session keeps its ID and
+        only its jobs without output are planned again. New jobs are limited
+        to those selected by the job filter; char_id is None for a character
+        the filter skips.
+        """
+        char_key = character_key(character, self._character_occurrences)
+        char_id = self.job_store.character_id(char_key)
+        known_id = char_id or (self._preset_ids or {}).get(char_key) or self.id_registry.get(char_key)
+        if not self.job_filter.selects_character(character, known_id):
+            print(f"⏭️ Skipping character {character.name} (not selected)")
+            return None, {}, []
+        resumed = char_id is not None and self.job_store.has_jobs(char_id)
+        if char_id is None:
+            char_id = self._generate_character_id(character, char_key)
+            self.job_store.set_character_id(char_key, character, char_id)
         char_seed = self._generate_character_seed(char_id)
         base_prompt = self.prompt_generator.build_base_prompt(character)
         
@@ -56,26 +279,262 @@ class CharacterImageGenerator:
         print(f"  Attributes: gender={character.gender}, age_group={character.age_group}, ethnicity={character.ethnicity}")
         print(f"  Variety via clothing per reveal level")
         
-        # Use provided poses or get default poses
-        if poses is None:
-            poses = self._get_default_poses(character.gender)
+        pose_jobs: Dict[str, List[GenerationJob]] = {}
+        if resumed:
+            done = self.job_store.done_results(char_id)
+            for job in self.job_store.pending_jobs(char_id, character):
+                pose_jobs.setdefault(job.pose, []).append(job)
+            print(f"  ⏭️ Resuming: {len(done)} images already saved, "
+                  f"{sum(len(jobs) for jobs in pose_jobs.values())} to generate")
+        else:
+            done = []
+            # Use provided poses or get default poses
+            if poses is None:
+                poses = self._get_default_poses(character.gender)
+            for pose in poses:
+                print(f"  Pose: {pose}")
+                jobs = [job for job in self._build_pose_jobs(character, char_id, char_seed, base_prompt, pose)
+                        if self.job_filter.selects(char_key, job.pose, job.reveal_level)]
+                if jobs:
+                    pose_jobs[pose] = jobs
+            self.job_store.add_jobs([job for jobs in pose_jobs.values() for job in jobs])
         
-        results = {}
-        total_images = 0
+        return char_id, pose_jobs, done
+    
+    def register_characters(self, characters: List[CharacterAttributes]):
+        """Record the run's characters so an interrupted session can be resumed"""
+        occurrences: Dict[str, int] = {}
+        keyed = [(character_key(character, occurrences), character) for character in characters]
+        self.job_store.add_characters(keyed)
+        if self.job_filter.shard is not None:
+            # Local registry and disk differ between machines; the preset list does not
+            self._preset_ids = preset_ids(keyed)
+    
+    def load_session_characters(self) -> List[CharacterAttributes]:
+        """Characters registered in this session (for --resume)"""
+        return self.job_store.load_characters()
+    
+    def run_worker(self) -> int:
+        """Render jobs leased from the shared work queue until none are left
+        
+        Leases are renewed in the background while a batch renders. When all
+        remaining jobs are leased by other nodes, polls until they finish or
+        their leases expire. Returns the number of images this node rendered.
+        """
+        queue = self.job_store
+        if not isinstance(queue, SharedWorkQueue):
+            raise RuntimeError("run_worker needs a generator created with work_queue")
         
-        for pose in poses:
-            print(f"  Pose: {pose}")
-            pose_results = self._generate_pose_variants(
-                character, char_id, char_seed, base_prompt, pose
+        print(f"👷 Worker {self.worker_id} on queue {self.session_dir}")
+        rendered = 0
+        while True:
+            jobs = queue.lease(self.worker_id, self.config.QUEUE_LEASE_BATCH)
+            if not jobs:
+                outstanding = queue.outstanding()
+                if outstanding == 0:
+                    break
+                print(f"⏳ {outstanding} jobs leased by other nodes, "
+                      f"checking again in {self.config.QUEUE_POLL_INTERVAL}s")
+                time.sleep(self.config.QUEUE_POLL_INTERVAL)
+                continue
+            
+            stop = threading.Event()
+            heartbeat = threading.Thread(
+                target=self._renew_leases, args=(jobs, stop), name="queue-heartbeat", daemon=True
             )
-            results[pose] = pose_results
-            successful_results = [r for r in pose_results if r.success]
-            total_images += len(successful_results)
-            print(f"    ✅ Created {len(successful_results)} variants for pose {pose}")
+            heartbeat.start()
+            try:
+                results = self.run_jobs(jobs)
+            except BaseException:
+                queue.release(self.worker_id)
+                raise
+            finally:
+                stop.set()
+                heartbeat.join()
+            rendered += sum(result.success for result in results)
+        
+        print(f"👷 Worker {self.worker_id} finished: {rendered} images rendered here")
+        return rendered
+    
+    def _renew_leases(self, jobs: List[GenerationJob], stop: threading.Event):
+        """Keep this node's leases alive until stop is set"""
+        while not stop.wait(self.config.QUEUE_LEASE_SECONDS / 3):
+            try:
+                self.job_store.renew(self.worker_id, jobs)
+            except Exception as e:
+                print(f"⚠️ Could not renew queue leases: {e}")
+    
+    def report_session(self):
+        """Print job counts of the session and how to resume it"""
+        counts = self.job_store.counts()
+        done = counts.get(DONE, 0)
+        missing = counts.get(PENDING, 0) + counts.get(FAILED, 0)
+        print(f"🗂️ Session jobs: {done} done, {missing} missing")
+        if isinstance(self.job_store, SharedWorkQueue):
+            if missing:
+                print(f"   {self.job_store.outstanding()} still queued; run more workers with: "
+                      f"python main.py --queue {self.session_dir}")
+        elif missing:
+            print(f"   Resume with: python main.py --resume {self.session_dir.name} "
+                  f"--output-dir {self.output_dir}")
+        
+        pack_bytes = sum(path.stat().st_size for path in self.session_dir.glob("*.png"))
+        print(f"📦 Pack size: {pack_bytes / 1e6:.1f} MB")
+        if self.config.PACK_BYTE_BUDGET and pack_bytes > self.config.PACK_BYTE_BUDGET:
+            print(f"⚠️ {(pack_bytes - self.config.PACK_BYTE_BUDGET) / 1e6:.1f} MB over PACK_BYTE_BUDGET; "
+                  f"shrink it with: python main.py --optimize-pack {self.session_dir}")
+    
+    def close(self):
+        """Wait for queued post-processing and stop the pipeline workers"""
+        if self._headshots is not None:
+            self._headshots.shutdown(wait=True)
+        self.pipeline.close()
+        self.job_store.close()
+        self.timing_history.save()
+    
+    def report_cache(self):
+        """Print render cache statistics"""
+        if self.render_cache is not None:
+            print(f"♻️ Render cache: {self.render_cache.summary()}")
+    
+    def report_pacing(self):
+        """Print how long submissions were held back by the pacer"""
+        print(f"🚦 Pacing: {self.scheduler.pacer.summary()}")
+    
+    def report_step_timings(self):
+        """Print sampling speed observed by the progress watchers"""
+        clients = ([b.client for b in self.sd_client.backends]
+                   if isinstance(self.sd_client, BackendPool) else [self.sd_client])
+        for client in clients:
+            watcher = client.progress_watcher
+            if watcher is None or not watcher.timings:
+                continue
+            sizes = sorted({(t.width, t.height) for t in watcher.timings})
+            speeds = []
+            for width, height in sizes:
+                mean = watcher.mean_step_seconds(width, height)
+                if mean is not None:
+                    speeds.append(f"{width}x{height}: {mean:.2f}s/step")
+            print(f"⏱️ {client.base_url}: {', '.join(speeds) or 'no step data'}"
+                  f" ({len(watcher.timings)} jobs, {watcher.interrupts} interrupted)")
+    
+    def run_jobs(self, jobs: List[GenerationJob], derive_heads: bool = True) -> List[GenerationResult]:
+        """Run jobs keeping up to max_in_flight txt2img requests queued per backend
+        
+        Jobs are submitted grouped by checkpoint so backends don't swap models
+        mid-run; results are returned in the order of jobs. With HEADSHOT_MODE
+        "body", headshots whose body render is among the jobs are cropped
+        from it instead of being rendered.
+        """
+        derived = self._derive_headshots(jobs) if derive_heads else []
+        derived_ids = {id(job) for job in derived}
+        rendered = [job for job in jobs if id(job) not in derived_ids]
+        ordered = order_by_checkpoint(rendered, lambda job: job.settings.checkpoint,
+                                      self._last_checkpoint)
+        cached, ordered = self._take_cached(ordered)
+        ordered_results = asyncio.run(self._run_jobs_async(ordered))
+        if ordered:
+            self._last_checkpoint = ordered[-1].settings.checkpoint
         
-        print(f"✓ Generated {total_images} images ({len(poses)} poses)")
+        by_job = {id(job): result for job, result in zip(ordered, ordered_results)}
+        for job, future in cached:
+            by_job[id(job)] = future.result()
+            self._report_result(by_job[id(job)])
+        # Only failed requests; images that reached the pipeline were recorded by it
+        for job in ordered:
+            if not by_job[id(job)].success and job.filename not in self._recorded:
+                self.job_store.record_result(job, by_job[id(job)])
+        
+        # A headshot whose body render failed is rendered on its own
+        fallback = []
+        for head in derived:
+            self._derived_heads.pop(self._headshot_source(head), None)
+            future = self._derived_results.pop(head.filename, None)
+            if future is None:
+                fallback.append(head)
+            else:
+                by_job[id(head)] = future.result()
+                self._report_result(by_job[id(head)])
+        if fallback:
+            print(f"      ↪️ Rendering {len(fallback)} headshot(s) without a body render")
+            for job, result in zip(fallback, self.run_jobs(fallback, derive_heads=False)):
+                by_job[id(job)] = result
+        self._recorded.difference_update(job.filename for job in jobs)
+        return [by_job[id(job)] for job in jobs]
+    
+    def _derive_headshots(self, jobs: List[GenerationJob]) -> List[GenerationJob]:
+        """Headshot jobs to crop from a body render among jobs (HEADSHOT_MODE "body")"""
+        if not derives_headshot("head", self.config):
+            return []
+        filenames = {job.filename for job in jobs}
+        derived = []
+        for job in jobs:
+            source = self._headshot_source(job) if job.pose == "head" else None
+            if source in filenames:
+                self._derived_heads[source] = job
+                derived.append(job)
+        return derived
+    
+    def _headshot_source(self, head: GenerationJob) -> str:
+        """Filename of the body render a headshot is cropped from"""
+        pose = self.pose_config.POSE_ALIAS_MAP.get(self.config.HEADSHOT_SOURCE_POSE,
+                                                   self.config.HEADSHOT_SOURCE_POSE)
+        return self._generate_filename(head.character, head.char_id, pose, 0)
+    
+    def _submit_headshot(self, head: GenerationJob, crop: Future) -> Future:
+        """Save a headshot once its crop from the body render is ready (refined first with HEADSHOT_REFINE)"""
+        if self._headshots is None:
+            # img2img refinement goes to the WebUI one crop at a time
+            workers = 1 if self.config.HEADSHOT_REFINE else self.pipeline.workers
+            self._headshots = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="headshot")
+        future = self._headshots.submit(self._finish_headshot, head, crop)
+        future.add_done_callback(lambda done: self._record_saved(head, done.result()))
+        return future
+    
+    def _finish_headshot(self, head: GenerationJob, crop: Future) -> GenerationResult:
+        """Optionally img2img the crop at low denoise, then process like a rendered headshot"""
+        try:
+            image = crop.result()
+            if self.config.HEADSHOT_REFINE:
+                settings = replace(head.settings, steps=self.config.HEADSHOT_REFINE_STEPS)
+                refined = self.sd_client.refine_image(
+                    image.resize((settings.width, settings.height), Image.Resampling.LANCZOS),
+                    head.prompt, head.negative_prompt, settings, self.config.HEADSHOT_REFINE_DENOISE,
+                    self.scheduler.timeout_for(settings, 1)
+                )
+                if refined is None:
+                    print(f"⚠️ Headshot refinement failed for {head.filename}, keeping the crop")
+                else:
+                    image = refined
+            return self.pipeline.submit(head, image).result()
+        except Exception as e:
+            return GenerationResult.failed(head, str(e))
+    
+    async def _run_jobs_async(self, jobs: List[GenerationJob]) -> List[GenerationResult]:
+        """Drive jobs through the async generation loop"""
+        client = AsyncStableDiffusionClient(self.config, self.total_in_flight, self.sd_client)
+        try:
+            loop = AsyncGenerationLoop(client, self._submit_image, self.total_in_flight,
+                                       batcher=self._batch_jobs, scheduler=self.scheduler)
+            results = await loop.run(jobs)
+        finally:
+            client.close()
+        
+        for result in results:
+            self._report_result(result)
         return results
     
+    def _generate_poses_async(self, pose_jobs: Dict[str, List[GenerationJob]]) -> Dict[str, List[GenerationResult]]:
+        """Generate all poses for a character through the async loop"""
+        jobs = []
+        pose_slices = []
+        for pose, jobs_for_pose in pose_jobs.items():
+            pose_slices.append((pose, len(jobs), len(jobs) + len(jobs_for_pose)))
+            jobs.extend(jobs_for_pose)
+        
+        job_results = self.run_jobs(jobs)
+        return {pose: job_results[start:end] for pose, start, end in pose_slices}
+    
     def load_characters_from_config(self, config_file: str) -> List[CharacterAttributes]:
         """Load characters from configuration file"""
         try:
@@ -105,20 +564,20 @@ class CharacterImageGenerator:
         session_path.mkdir(parents=True, exist_ok=True)
         return session_path
     
-    def _generate_character_id(self, character: CharacterAttributes) -> str:
-        """Generate unique character ID"""
-        # Create timestamp-based random ID
-        timestamp = int(time.time() * 1000) % 100000  # Last 5 digits of timestamp
-        random_part = random.randint(0, 9999)
-        
-        if character.gender == "f":
-            # Female IDs: 0-49999
-            char_id = (timestamp + random_part) % 50000
-        else:
-            # Male IDs: 10000-19999  
-            char_id = 10000 + ((timestamp + random_part) % 10000)
-            
-        return f"{char_id:05d}"
+    def _resume_session_directory(self, session: str) -> Path:
+        """Find an existing session directory by name or path"""
+        session_path = Path(session)
+        if not session_path.is_dir():
+            session_path = Path(self.output_dir) / session
+        if not (session_path / self.config.SESSION_DB_NAME).is_file():
+            raise FileNotFoundError(f"No resumable session at {session_path}")
+        return session_path
+    
+    def _generate_character_id(self, character: CharacterAttributes, char_key: str) -> str:
+        """Stable character ID for a preset (female IDs: 0-49999, male IDs: 10000-19999)"""
+        if self._preset_ids is not None and char_key in self._preset_ids:
+            return self.id_registry.assign(char_key, self._preset_ids[char_key])
+        return self.id_registry.allocate(char_key, character)
     
     def _generate_character_seed(self, char_id: str) -> int:
         """Generate consistent seed for character"""
@@ -128,21 +587,35 @@ class CharacterImageGenerator:
     
     def _get_default_poses(self, gender: str) -> List[str]:
         """Get default poses for gender"""
-        poses = ["head", "cas", "uw", "nude", "bc", "fun"]
+        return default_poses(gender, self.pose_config)
+    
+    def _submit_jobs(self, jobs: List[GenerationJob]) -> List[Future]:
+        """Generate the jobs of a pose; returns futures of their results"""
+        cached, jobs = self._take_cached(jobs)
+        results = [future for _, future in cached]
         
-        if gender == "f":
-            poses.extend(["tl", "ss", "s1"])
+        for group in self._batch_jobs(jobs):
+            # Generate images
+            results.extend(self._generate_job_group(group))
         
-        return poses
+        return results
     
-    def _generate_pose_variants(self, character: CharacterAttributes, char_id: str, 
-                               char_seed: int, base_prompt: str, pose: str) -> List[GenerationResult]:
-        """Generate all variants for a pose"""
+    def _batch_jobs(self, jobs: List[GenerationJob]) -> List[List[GenerationJob]]:
+        """Group jobs into multi-prompt txt2img requests (fewer requests, each still rendered one by one)"""
+        if self.multi_prompt:
+            return group_multi_prompt_jobs(jobs, self.config.MULTI_PROMPT_MAX)
+        if not self.config.BATCH_JOBS:
+            return [[job] for job in jobs]
+        return group_pose_variants(jobs, self.config.MULTI_PROMPT_MAX)
+    
+    def _build_pose_jobs(self, character: CharacterAttributes, char_id: str,
+                         char_seed: int, base_prompt: str, pose: str) -> List[GenerationJob]:
+        """Build generation jobs for all variants of a pose"""
         effective_pose = self.pose_config.POSE_ALIAS_MAP.get(pose, pose)
         pose_config = self.pose_config.POSES_CONFIG.get(effective_pose, {})
         reveal_variants = pose_config.get("reveal_variants", [0])
         
-        results = []
+        jobs = []
         
         for i, reveal_level in enumerate(reveal_variants):
             variant_idx = i + 1
@@ -168,89 +641,160 @@ class CharacterImageGenerator:
             print(f"      📝 NEGATIVE PROMPT:")
             print(f"         {negative_prompt}")
             
-            # Generate image
-            result = self._generate_single_image(
-                character, char_id, char_seed, effective_pose, reveal_level,
-                full_prompt, negative_prompt, clothing_desc
-            )
-            
-            results.append(result)
-            
-            if result.success:
-                print(f"      Saved: {result.filename}")
-            else:
-                print(f"      ❌ Failed: {result.error}")
-            
-            # Delay between generations
-            if self.config.DELAY_BETWEEN_GENERATIONS > 0:
-                time.sleep(self.config.DELAY_BETWEEN_GENERATIONS)
+            jobs.append(GenerationJob(
+                character=character,
+                char_id=char_id,
+                pose=effective_pose,
+                reveal_level=reveal_level,
+                variant_index=i,
+                prompt=full_prompt,
+                negative_prompt=negative_prompt,
+                settings=self._build_generation_settings(effective_pose, char_seed),
+                filename=self._generate_filename(character, char_id, effective_pose, reveal_level),
+                clothing_description=clothing_desc
+            ))
         
-        return results
+        return jobs
+    
+    def _build_generation_settings(self, pose: str, char_seed: int) -> GenerationSettings:
+        """Determine image settings for a pose"""
+        if pose == "head":
+            return GenerationSettings(
+                steps=self.config.HEADSHOT_STEPS,
+                cfg_scale=self.config.HEADSHOT_CFG_SCALE,
+                sampler=self.config.DEFAULT_SAMPLER,
+                seed=char_seed,
+                width=self.config.HEAD_GENERATION_SIZE[0],
+                height=self.config.HEAD_GENERATION_SIZE[1],
+                checkpoint=self._checkpoint_for(pose)
+            )
+        return GenerationSettings(
+            steps=self.config.DEFAULT_STEPS,
+            cfg_scale=self.config.DEFAULT_CFG_SCALE,
+            sampler=self.config.DEFAULT_SAMPLER,
+            seed=char_seed,
+            width=self.config.BODY_GENERATION_SIZE[0],
+            height=self.config.BODY_GENERATION_SIZE[1],
+            checkpoint=self._checkpoint_for(pose)
+        )
     
-    def _generate_single_image(self, character: CharacterAttributes, char_id: str, 
-                              char_seed: int, pose: str, reveal_level: int,
-                              prompt: str, negative_prompt: str, 
-                              clothing_desc: str) -> GenerationResult:
-        """Generate a single image"""
+    def _report_result(self, result: GenerationResult):
+        """Print the outcome of a single job"""
+        if result.success:
+            print(f"      Saved: {result.filename}")
+        else:
+            print(f"      ❌ Failed: {result.error}")
+    
+    def _generate_job_group(self, jobs: List[GenerationJob], attempt: int = 0) -> List[Future]:
+        """Generate a group of jobs in one request, retrying failures
+        
+        Generated images go to the post-processing pipeline; returns futures
+        of the jobs' results.
+        """
+        # Hold submissions while the backend's circuit breaker is open
+        delay = self.sd_client.retry_after()
+        while delay > 0:
+            time.sleep(delay)
+            delay = self.sd_client.retry_after()
+        
+        # Only throttle while the WebUI is saturated
+        settings = jobs[0].settings
+        self.scheduler.pacer.wait(settings)
+        
+        started = time.monotonic()
         try:
-            # Determine image settings
-            is_headshot = (pose == "head")
-            if is_headshot:
-                settings = GenerationSettings(
-                    steps=self.config.HEADSHOT_STEPS,
-                    cfg_scale=self.config.HEADSHOT_CFG_SCALE,
-                    sampler=self.config.DEFAULT_SAMPLER,
-                    seed=char_seed,
-                    width=self.config.HEAD_GENERATION_SIZE[0],
-                    height=self.config.HEAD_GENERATION_SIZE[1]
-                )
-            else:
-                settings = GenerationSettings(
-                    steps=self.config.DEFAULT_STEPS,
-                    cfg_scale=self.config.DEFAULT_CFG_SCALE,
-                    sampler=self.config.DEFAULT_SAMPLER,
-                    seed=char_seed,
-                    width=self.config.BODY_GENERATION_SIZE[0],
-                    height=self.config.BODY_GENERATION_SIZE[1]
+            images = self.sd_client.generate_jobs(jobs, self.scheduler.timeout_for(settings, len(jobs)))
+        except Exception as e:
+            print(f"❌ Generation error: {e}")
+            images = [None] * len(jobs)
+        
+        failed = [job for job, image in zip(jobs, images) if image is None]
+        if len(failed) < len(jobs):
+            self.scheduler.record_success(settings, time.monotonic() - started, len(jobs) - len(failed))
+        
+        results = {id(job): self._submit_image(job, image)
+                   for job, image in zip(jobs, images) if image is not None}
+        
+        if failed and self.scheduler.should_retry(attempt):
+            delay = self.scheduler.backoff(attempt + 1)
+            self.scheduler.record_retry(len(failed))
+            print(f"      🔁 Retrying {len(failed)} job(s) in {delay:.1f}s "
+                  f"(retry {attempt + 1}/{self.scheduler.max_retries})")
+            time.sleep(delay)
+            # One job per retry, so a prompt the WebUI rejects fails alone
+            for job in failed:
+                results[id(job)] = self._generate_job_group([job], attempt + 1)[0]
+        elif failed:
+            self.scheduler.record_give_up(len(failed))
+            for job in failed:
+                result = GenerationResult.failed(
+                    job, f"Failed to generate image after {attempt + 1} attempts"
                 )
-            
-            # Generate image
-            image = self.sd_client.generate_image(prompt, negative_prompt, settings)
+                self.job_store.record_result(job, result)
+                results[id(job)] = resolved(result)
+        
+        return [results[id(job)] for job in jobs]
+    
+    def _cache_key(self, job: GenerationJob) -> Optional[str]:
+        """Render cache key of a job (None when it can't be cached)"""
+        if self.render_cache is None or job.settings.seed < 0:
+            return None
+        checkpoint_hash = self.checkpoint_hashes.get(job.settings.checkpoint)
+        if not checkpoint_hash:
+            return None
+        return RenderCache.key(job.prompt, job.negative_prompt, job.settings, checkpoint_hash)
+    
+    def _take_cached(self, jobs: List[GenerationJob]) -> Tuple[List[Tuple[GenerationJob, Future]], List[GenerationJob]]:
+        """Send jobs with a cached render straight to the pipeline; returns (cached, to render)"""
+        cached = []
+        remaining = []
+        for job in jobs:
+            key = self._cache_key(job)
+            image = self.render_cache.get(key) if key else None
             if image is None:
-                return GenerationResult(
-                    success=False,
-                    error="Failed to generate image",
-                    pose=pose,
-                    reveal_level=reveal_level
-                )
-            
-            # Process image
-            if is_headshot:
-                processed_image = self.image_processor.process_headshot(image)
+                remaining.append(job)
             else:
-                processed_image = self.image_processor.process_body_image(image)
-            
-            # Generate filename
-            filename = self._generate_filename(character, char_id, pose, reveal_level)
-            filepath = self.session_dir / filename
-            
-            # Save image
-            processed_image.save(filepath, "PNG", optimize=True)
-            
-            return GenerationResult(
-                success=True,
-                filename=filename,
-                pose=pose,
-                reveal_level=reveal_level
-            )
-            
-        except Exception as e:
-            return GenerationResult(
-                success=False,
-                error=str(e),
-                pose=pose,
-                reveal_level=reveal_level
-            )
+                cached.append((job, self._submit_image(job, image, from_cache=True)))
+        
+        if cached:
+            print(f"      ♻️ {len(cached)} image(s) from render cache")
+        return cached, remaining
+    
+    def _submit_image(self, job: GenerationJob, image: Image.Image,
+                      from_cache: bool = False) -> Future:
+        """Hand an image to the pipeline and record the job once it is saved"""
+        key = None if from_cache else self._cache_key(job)
+        if key:
+            try:
+                self.render_cache.put(key, image)
+            except OSError as e:
+                print(f"⚠️ Render cache write failed: {e}")
+        
+        head = self._derived_heads.pop(job.filename, None)
+        if head is None:
+            future = self.pipeline.submit(job, image)
+        else:
+            # The headshot is cropped using this render's own background removal
+            future, crop = self.pipeline.submit_with_headshot(job, image)
+            self._derived_results[head.filename] = self._submit_headshot(head, crop)
+        future.add_done_callback(lambda done: self._record_saved(job, done.result()))
+        return future
+    
+    def _record_saved(self, job: GenerationJob, result: GenerationResult):
+        """Record a finished image in the job store and timing history"""
+        output_path = self.session_dir / job.filename
+        self._recorded.add(job.filename)
+        self.job_store.record_result(job, result, output_path)
+        if result.success:
+            settings = job.settings
+            if derives_headshot(job.pose, self.config):
+                # Filed under the cropped size, as --plan estimates derived headshots
+                width, height = self.config.HEAD_TARGET_SIZE
+                settings = replace(settings, width=width, height=height, steps=0)
+            try:
+                self.timing_history.record_output(settings, output_path.stat().st_size)
+            except OSError:
+                pass
     
     def _generate_filename(self, character: CharacterAttributes, char_id: str, 
                           pose: str, reveal_level: int) -> str:
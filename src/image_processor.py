@@ -1,35 +1,234 @@
 """
 Image processing utilities
 """
+import io
+import math
+import numpy as np
 from PIL import Image, ImageOps
 from rembg import remove
-from typing import Tuple
+from typing import Dict, List, Optional, Tuple
 from .config import Config
+from .keying import key_background
+from .matting import BatchMatting, apply_masks, guided_upsample, mask_iou, rembg_session
+from .models import EncodedPng, KeyingCheck
+from .png_encoder import encode_png
+
+def thumbnail_size(size: Tuple[int, int], target_size: Tuple[int, int]) -> Tuple[int, int]:
+    """Size Image.thumbnail() shrinks an image of size to when fitting it into target_size"""
+    width, height = size
+    x, y = target_size
+    if x >= width and y >= height:
+        return size
+    
+    def round_aspect(number: float, key) -> int:
+        return max(min(math.floor(number), math.ceil(number), key=key), 1)
+    
+    aspect = width / height
+    if x / y >= aspect:
+        x = round_aspect(y * aspect, key=lambda n: abs(aspect - n / y))
+    else:
+        y = round_aspect(x / aspect, key=lambda n: 0 if n == 0 else abs(aspect - x / n))
+    return x, y
+
+def head_crop_box(alpha: np.ndarray, config: Config) -> Optional[Tuple[float, float, float, float]]:
+    """3:4 headshot box (left, top, right, bottom) in a body render from its subject mask
+    
+    The head is the top HEADSHOT_HEAD_FRACTION of the subject's height,
+    centred on the mask's columns there; the box spans HEADSHOT_CROP_HEADS
+    head lengths from HEADSHOT_CROP_MARGIN above it, kept inside the image.
+    None when the mask holds no subject.
+    """
+    height, width = alpha.shape
+    solid = alpha >= 128
+    rows = np.nonzero(solid.sum(axis=1) >= max(2, width // 100))[0]
+    if not len(rows):
+        return None
+    top = rows[0]
+    head_length = max(1.0, (rows[-1] - top + 1) * config.HEADSHOT_HEAD_FRACTION)
+    head_columns = np.nonzero(solid[top:top + int(np.ceil(head_length))])[1]
+    centre = head_columns.mean() if len(head_columns) else width / 2
+    
+    crop_height = min(head_length * config.HEADSHOT_CROP_HEADS, height, width * 4 / 3)
+    crop_width = crop_height * 3 / 4
+    crop_top = min(max(top - head_length * config.HEADSHOT_CROP_MARGIN, 0), height - crop_height)
+    crop_left = min(max(centre - crop_width / 2, 0), width - crop_width)
+    return crop_left, crop_top, crop_left + crop_width, crop_top + crop_height
+
+def _array_image(array: np.ndarray) -> Image.Image:
+    """PIL view of a contiguous RGB/RGBA array (no copy)"""
+    mode = 'RGBA' if array.shape[2] == 4 else 'RGB'
+    array = np.ascontiguousarray(array)
+    return Image.frombuffer(mode, (array.shape[1], array.shape[0]), array, 'raw', mode, 0, 1)
 
 class ImageProcessor:
-    """Handles image processing operations"""
+    """Handles image processing operations
+    
+    POSTPROCESS_MODE selects how images move through the stages: "pil"
+    creates a PIL image per step, "numpy" keeps pixels in arrays from the
+    decoded render to the encoder, resizes through views of them and
+    centres the result in a canvas reused for every image of that size.
+    Both produce the same pixels (see check_parity).
+    """
     
     def __init__(self, config: Config = None):
         self.config = config or Config()
+        self._rembg_session = None
+        self._batch_matting = None
+        self._canvases: Dict[Tuple[int, int], np.ndarray] = {}
+    
+    @property
+    def rembg_session(self):
+        """rembg/ONNX session, created on first use and kept for every later image"""
+        if self._rembg_session is None:
+            self._rembg_session = rembg_session(self.config)
+        return self._rembg_session
     
     def remove_background(self, image: Image.Image) -> Image.Image:
         """Remove background from image"""
         try:
-            # Convert to bytes for rembg
-            import io
-            img_bytes = io.BytesIO()
-            image.save(img_bytes, format='PNG')
-            img_bytes.seek(0)
-            
-            # Remove background
-            result_bytes = remove(img_bytes.read())
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGB')
             
-            # Convert back to PIL Image
-            return Image.open(io.BytesIO(result_bytes))
+            # Pixels go to rembg and come back as arrays, no PNG encode/decode
+            result = remove(np.asarray(image), session=self.rembg_session)
+            return Image.fromarray(result)
         except Exception as e:
             print(f"⚠️ Background removal failed: {e}")
             return image
     
+    @property
+    def batch_matting(self) -> BatchMatting:
+        """Batched onnxruntime matting (MATTING_ENGINE = "batch"), created on first use"""
+        if self._batch_matting is None:
+            self._batch_matting = BatchMatting.from_config(self.config)
+        return self._batch_matting
+    
+    def remove_backgrounds(self, images: List[Image.Image]) -> List[Image.Image]:
+        """Remove the background of several images with the configured engine"""
+        return [Image.fromarray(pixels) for pixels in self.remove_backgrounds_arrays(images)]
+    
+    def remove_backgrounds_arrays(self, images: List[Image.Image]) -> List[np.ndarray]:
+        """Remove the background of several images, returning (H, W, 4) arrays
+        
+        Solid backdrops are keyed (KEYING_ENABLED); the rest go to the
+        matting model. An image whose background could not be removed comes
+        back as its own pixels, like remove_background does.
+        """
+        results, unkeyed = self.key_backgrounds(images)
+        for i, pixels in zip(unkeyed, self._matte_arrays([images[i] for i in unkeyed])):
+            results[i] = pixels
+        return results
+    
+    def key_backgrounds(self, images: List[Image.Image]) -> Tuple[List[Optional[np.ndarray]], List[int]]:
+        """Keyed RGBA cutouts of images on a solid backdrop (None for the others)
+        and the indexes of the images the key was not confident about"""
+        results: List[Optional[np.ndarray]] = [None] * len(images)
+        if not self.config.KEYING_ENABLED:
+            return results, list(range(len(images)))
+        
+        unkeyed = []
+        for i, image in enumerate(images):
+            rgb = np.asarray(image if image.mode == 'RGB' else image.convert('RGB'))
+            alpha, _ = key_background(rgb, self.config)
+            if alpha is None:
+                unkeyed.append(i)
+            else:
+                results[i] = apply_masks(rgb[None], alpha[None])[0]
+        return results, unkeyed
+    
+    def _matte_arrays(self, images: List[Image.Image]) -> List[np.ndarray]:
+        """Cutouts from the matting model of MATTING_ENGINE"""
+        if not images:
+            return []
+        if self.config.MATTING_ENGINE == "batch":
+            try:
+                return self.batch_matting.cutout_arrays(images)
+            except Exception as e:
+                print(f"⚠️ Batched background removal failed, using rembg: {e}")
+        
+        results = []
+        for image in images:
+            pixels = np.asarray(image if image.mode in ('RGB', 'RGBA') else image.convert('RGB'))
+            try:
+                results.append(remove(pixels, session=self.rembg_session))
+            except Exception as e:
+                print(f"⚠️ Background removal failed: {e}")
+                results.append(pixels)
+        return results
+    
+    def lowres_cutouts(self, images: List[Image.Image]) -> List[np.ndarray]:
+        """Body cutouts already shrunk to BODY_TARGET_SIZE (MATTING_LOWRES)
+        
+        Each render is shrunk first and keyed if its backdrop is solid;
+        for the others the model infers the mask at its own input size from
+        the small image, and the mask is upsampled to the shrunk size with a
+        guided filter before being applied there. No full-resolution mask or
+        cutout is ever made. Uses the onnxruntime session of the batch
+        engine, whatever MATTING_ENGINE is.
+        """
+        target_size = self.config.BODY_TARGET_SIZE
+        shrunk = []
+        for image in images:
+            image = image if image.mode == 'RGB' else image.convert('RGB')
+            size = thumbnail_size(image.size, target_size)
+            if size != image.size:
+                image = image.resize(size, Image.Resampling.LANCZOS, reducing_gap=2.0)
+            shrunk.append(image)
+        
+        cutouts, unkeyed = self.key_backgrounds(shrunk)
+        if unkeyed:
+            predictions = self.batch_matting.predictions([shrunk[i] for i in unkeyed])
+            for i, prediction in zip(unkeyed, predictions):
+                rgb = np.asarray(shrunk[i])
+                alpha = guided_upsample(prediction, rgb, self.config.MATTING_GUIDED_RADIUS,
+                                        self.config.MATTING_GUIDED_EPS)
+                cutouts[i] = apply_masks(rgb[None], alpha[None])[0]
+        return cutouts
+    
+    def _body_cutouts(self, images: List[Image.Image]) -> List[np.ndarray]:
+        """Background-free body arrays by the configured route (low-res or full-res)"""
+        if self.config.MATTING_LOWRES:
+            try:
+                return self.lowres_cutouts(images)
+            except Exception as e:
+                print(f"⚠️ Low-res matting failed, using full resolution: {e}")
+        return self.remove_backgrounds_arrays(images)
+    
+    def head_crop(self, image: Image.Image, cutout: np.ndarray) -> Image.Image:
+        """3:4 crop around the head of a body render, placed with the render's own cutout
+        
+        cutout is the body route's result for image (full size, or shrunk
+        with MATTING_LOWRES); only its alpha is used. The crop is taken from
+        the full render, backdrop included, like a rendered headshot.
+        """
+        image = image if image.mode == 'RGB' else image.convert('RGB')
+        box = head_crop_box(cutout[..., 3], self.config) if cutout.shape[2] == 4 else None
+        if box is None:
+            print("⚠️ No subject found for the headshot crop, using the top centre of the render")
+            left, top, height = (image.width - image.height * 3 / 16) / 2, 0, image.height / 4
+        else:
+            scale = image.width / cutout.shape[1]
+            left, top, height = box[0] * scale, box[1] * scale, (box[3] - box[1]) * scale
+        
+        # Whole multiples of 3x4 pixels, so the crop scales to HEAD_TARGET_SIZE without borders
+        unit = max(1, min(round(height / 4), image.height // 4, image.width // 3))
+        left = min(max(round(left), 0), image.width - 3 * unit)
+        top = min(max(round(top), 0), image.height - 4 * unit)
+        return image.crop((left, top, left + 3 * unit, top + 4 * unit))
+    
+    def body_png_and_head_crop(self, image: Image.Image) -> Tuple[bytes, Image.Image]:
+        """Body PNG of a render and its headshot crop (HEADSHOT_MODE "body")
+        
+        The background is removed once; the same cutout is encoded as the
+        body image and places the head crop.
+        """
+        cutout = self._body_cutouts([image])[0]
+        if self.config.POSTPROCESS_MODE == "numpy":
+            body = self.encode(self._fit_array(cutout, self.config.BODY_TARGET_SIZE))
+        else:
+            body = self.encode(self._finish_body(Image.fromarray(cutout)))
+        return body, self.head_crop(image, cutout)
+    
     def resize_image(self, image: Image.Image, target_size: Tuple[int, int], 
                     maintain_aspect: bool = True) -> Image.Image:
         """Resize image to target size"""
@@ -60,27 +259,130 @@ class ImageProcessor:
     
     def process_body_image(self, image: Image.Image, remove_bg: bool = True) -> Image.Image:
         """Process body image"""
-        processed = image
+        return self.process_body_images([image], remove_bg)[0]
+    
+    def process_body_images(self, images: List[Image.Image], remove_bg: bool = True) -> List[Image.Image]:
+        """Process several body images (one model run with the batch engine)"""
+        processed_images = images
         
         # Remove background if requested
-        if remove_bg:
-            processed = self.remove_background(processed)
+        if remove_bg and self.config.MATTING_LOWRES:
+            processed_images = [Image.fromarray(cutout) for cutout in self._body_cutouts(images)]
+        elif remove_bg:
+            processed_images = self.remove_backgrounds(processed_images)
         
+        return [self._finish_body(processed) for processed in processed_images]
+    
+    def _finish_body(self, processed: Image.Image) -> Image.Image:
+        """Resize a background-free body image to the target size as RGBA"""
         # Resize to target body size
         processed = self.resize_image(processed, self.config.BODY_TARGET_SIZE)
         
         # Ensure proper format
         if processed.mode != 'RGBA':
             processed = processed.convert('RGBA')
-            
         return processed
     
-    def optimize_for_game(self, image: Image.Image) -> Image.Image:
-        """Optimize image for game use"""
-        # Convert to RGBA if needed
+    def headshot_png(self, image: Image.Image) -> bytes:
+        """Process a headshot and encode it"""
+        return self._headshot_png(image, self.config.POSTPROCESS_MODE == "numpy")
+    
+    def body_pngs(self, images: List[Image.Image], remove_bg: bool = True) -> List[bytes]:
+        """Process body images (one model run with the batch engine) and encode them"""
+        return self._body_pngs(images, remove_bg, self.config.POSTPROCESS_MODE == "numpy")
+    
+    def _headshot_png(self, image: Image.Image, use_arrays: bool) -> bytes:
+        if use_arrays:
+            return self.encode(self._fit_array(np.asarray(image), self.config.HEAD_TARGET_SIZE),
+                               headshot=True)
+        return self.encode(self.process_headshot(image), headshot=True)
+    
+    def _body_pngs(self, images: List[Image.Image], remove_bg: bool, use_arrays: bool) -> List[bytes]:
+        if not use_arrays:
+            return [self.encode(processed) for processed in self.process_body_images(images, remove_bg)]
+        
+        arrays = (self._body_cutouts(images) if remove_bg
+                  else [np.asarray(image) for image in images])
+        # Each result is encoded before the shared canvas is reused
+        return [self.encode(self._fit_array(array, self.config.BODY_TARGET_SIZE)) for array in arrays]
+    
+    def encode(self, image: Image.Image, headshot: bool = False) -> bytes:
+        """PNG bytes of a processed image"""
+        return self.optimize_for_game(image, headshot).data
+    
+    def check_parity(self, image: Image.Image, pose: str) -> int:
+        """Largest per-channel difference between the pil and numpy modes for one render"""
+        outputs = []
+        for use_arrays in (False, True):
+            if pose == "head":
+                encoded = self._headshot_png(image.copy(), use_arrays)
+            else:
+                encoded = self._body_pngs([image.copy()], True, use_arrays)[0]
+            outputs.append(np.asarray(Image.open(io.BytesIO(encoded)).convert('RGBA'), dtype=np.int16))
+        if outputs[0].shape != outputs[1].shape:
+            return 255
+        return int(np.abs(outputs[0] - outputs[1]).max())
+    
+    def check_lowres_alpha(self, image: Image.Image) -> Tuple[float, float]:
+        """Mean absolute alpha difference (0-255) and mask IoU of low-res vs full-res matting"""
+        full = self._fit_array(self.remove_backgrounds_arrays([image])[0], self.config.BODY_TARGET_SIZE)
+        full_alpha = np.asarray(full)[..., 3].astype(np.int16)
+        low = self._fit_array(self.lowres_cutouts([image])[0], self.config.BODY_TARGET_SIZE)
+        low_alpha = np.asarray(low)[..., 3].astype(np.int16)
+        return float(np.abs(full_alpha - low_alpha).mean()), mask_iou(low_alpha, full_alpha)
+    
+    def check_keying(self, image: Image.Image) -> Tuple[KeyingCheck, Optional[float]]:
+        """Keying confidence for one render, and the mask IoU against the matting model if it keyed"""
+        rgb = np.asarray(image.convert('RGB'))
+        alpha, check = key_background(rgb, self.config)
+        if alpha is None:
+            return check, None
+        matted = self._matte_arrays([image])[0]
+        if matted.shape[2] != 4:
+            return check, None
+        return check, mask_iou(alpha, matted[..., 3])
+    
+    def _canvas(self, size: Tuple[int, int]) -> np.ndarray:
+        """Cleared RGBA canvas of a target size, reused across images"""
+        canvas = self._canvases.get(size)
+        if canvas is None:
+            canvas = self._canvases[size] = np.zeros((size[1], size[0], 4), dtype=np.uint8)
+        else:
+            canvas.fill(0)
+        return canvas
+    
+    def _fit_array(self, pixels: np.ndarray, target_size: Tuple[int, int]) -> Image.Image:
+        """Shrink like resize_image and centre on the reused canvas
+        
+        Returns a view of the canvas, valid until the next call for the same size.
+        """
+        height, width = pixels.shape[:2]
+        size = thumbnail_size((width, height), target_size)
+        if size != (width, height):
+            pixels = np.asarray(_array_image(pixels).resize(
+                size, Image.Resampling.LANCZOS, reducing_gap=2.0
+            ))
+        
+        canvas = self._canvas(target_size)
+        x = (target_size[0] - size[0]) // 2
+        y = (target_size[1] - size[1]) // 2
+        region = canvas[y:y + size[1], x:x + size[0]]
+        if pixels.shape[2] == 4:
+            region[:] = pixels
+        else:
+            region[..., :3] = pixels
+            region[..., 3] = 255
+        return _array_image(canvas)
+    
+    def optimize_for_game(self, image: Image.Image, headshot: bool = False,
+                          budget: int = None) -> EncodedPng:
+        """Smallest PNG of an image within the quality and byte budget settings
+        
+        Lossless filter/zlib search for every image; headshots
+        (PNG_PALETTE_HEADSHOTS) and images over budget (PNG_BYTE_BUDGET
+        unless given) may become palette images, see encode_png.
+        """
         if image.mode != 'RGBA':
             image = image.convert('RGBA')
-        
-        # Optimize file size while maintaining quality
-        # This could include palette optimization for smaller files
-        return image
+        return encode_png(image, self.config, headshot and self.config.PNG_PALETTE_HEADSHOTS,
+                          self.config.PNG_BYTE_BUDGET if budget is None else budget)
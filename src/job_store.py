@@ -0,0 +1,182 @@
+"""
+Persistent job state for resumable generation sessions
+"""
+import json
+import sqlite3
+import threading
+import time
+from dataclasses import asdict
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from .models import CharacterAttributes, GenerationJob, GenerationResult, GenerationSettings
+
+PENDING = "pending"
+DONE = "done"
+FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS characters (
+    char_key TEXT PRIMARY KEY,
+    position INTEGER NOT NULL,
+    attributes TEXT NOT NULL,
+    char_id TEXT
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    filename TEXT PRIMARY KEY,
+    char_id TEXT NOT NULL,
+    pose TEXT NOT NULL,
+    reveal_level INTEGER NOT NULL,
+    variant_index INTEGER NOT NULL,
+    prompt TEXT NOT NULL,
+    negative_prompt TEXT NOT NULL,
+    settings TEXT NOT NULL,
+    clothing_description TEXT NOT NULL DEFAULT '',
+    status TEXT NOT NULL DEFAULT 'pending',
+    output_path TEXT,
+    error TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_by_character ON jobs (char_id, status);
+"""
+
+class JobStore:
+    """SQLite record of every job in a session (SESSION_DB_NAME in the session directory)
+
+    Characters are stored with their attributes and assigned ID, jobs with
+    everything needed to render them again plus their status and output
+    path, so a resumed session reads only the jobs that are still missing.
+    Safe to use from the generator, async loop and pipeline threads.
+    """
+
+    JOURNAL_MODE = "WAL"
+    SCHEMA = _SCHEMA
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._conn = sqlite3.connect(str(self.path), timeout=60, check_same_thread=False)
+        self._conn.execute(f"PRAGMA journal_mode={self.JOURNAL_MODE}")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+        self._lock = threading.Lock()
+
+    def add_characters(self, keyed: List[Tuple[str, CharacterAttributes]]):
+        """Register the run's characters in order (existing ones are kept)"""
+        with self._lock, self._conn:
+            start = self._conn.execute("SELECT COUNT(*) FROM characters").fetchone()[0]
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO characters (char_key, position, attributes) VALUES (?, ?, ?)",
+                [(key, start + i, json.dumps(character.to_dict()))
+                 for i, (key, character) in enumerate(keyed)]
+            )
+
+    def load_characters(self) -> List[CharacterAttributes]:
+        """Characters of the session in registration order"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT attributes FROM characters ORDER BY position"
+            ).fetchall()
+        return [CharacterAttributes.from_dict(json.loads(attributes)) for (attributes,) in rows]
+
+    def character_id(self, char_key: str) -> Optional[str]:
+        """ID assigned to a character, if it was started before"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT char_id FROM characters WHERE char_key = ?", (char_key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_character_id(self, char_key: str, character: CharacterAttributes, char_id: str):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO characters (char_key, position, attributes) "
+                "VALUES (?, (SELECT COUNT(*) FROM characters), ?)",
+                (char_key, json.dumps(character.to_dict()))
+            )
+            self._conn.execute("UPDATE characters SET char_id = ? WHERE char_key = ?",
+                               (char_id, char_key))
+
+    def has_jobs(self, char_id: str) -> bool:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM jobs WHERE char_id = ? LIMIT 1", (char_id,)
+            ).fetchone()
+        return row is not None
+
+    def add_jobs(self, jobs: List[GenerationJob]):
+        """Record newly planned jobs as pending"""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO jobs (filename, char_id, pose, reveal_level, variant_index, "
+                "prompt, negative_prompt, settings, clothing_description, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(job.filename, job.char_id, job.pose, job.reveal_level, job.variant_index,
+                  job.prompt, job.negative_prompt, json.dumps(asdict(job.settings)),
+                  job.clothing_description, now) for job in jobs]
+            )
+
+    def pending_jobs(self, char_id: str, character: CharacterAttributes) -> List[GenerationJob]:
+        """Jobs of a character that have no output yet, in planning order"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT filename, pose, reveal_level, variant_index, prompt, negative_prompt, "
+                "settings, clothing_description FROM jobs "
+                "WHERE char_id = ? AND status != ? ORDER BY rowid",
+                (char_id, DONE)
+            ).fetchall()
+        return [self._job_from_row(row, char_id, character) for row in rows]
+
+    def done_results(self, char_id: str) -> List[GenerationResult]:
+        """Results of a character's jobs that already have output"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT filename, pose, reveal_level FROM jobs "
+                "WHERE char_id = ? AND status = ? ORDER BY rowid",
+                (char_id, DONE)
+            ).fetchall()
+        return [GenerationResult(success=True, filename=filename, pose=pose,
+                                 reveal_level=reveal_level)
+                for filename, pose, reveal_level in rows]
+
+    def record_result(self, job: GenerationJob, result: GenerationResult,
+                      output_path: Optional[Path] = None):
+        """Store the outcome of a job"""
+        status = DONE if result.success else FAILED
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, output_path = ?, error = ?, updated_at = ? "
+                "WHERE filename = ?",
+                (status, str(output_path) if result.success and output_path else None,
+                 result.error, time.time(), job.filename)
+            )
+
+    def counts(self) -> Dict[str, int]:
+        """Number of jobs per status"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT status, COUNT(*) FROM jobs GROUP BY status"
+            ).fetchall()
+        return dict(rows)
+
+    @staticmethod
+    def _job_from_row(row: tuple, char_id: str, character: CharacterAttributes) -> GenerationJob:
+        """Rebuild a job from (filename, pose, reveal_level, variant_index, prompt,
+        negative_prompt, settings, clothing_description)"""
+        (filename, pose, reveal_level, variant_index, prompt, negative_prompt,
+         settings, clothing_description) = row
+        return GenerationJob(
+            character=character,
+            char_id=char_id,
+            pose=pose,
+            reveal_level=reveal_level,
+            variant_index=variant_index,
+            prompt=prompt,
+            negative_prompt=negative_prompt,
+            settings=GenerationSettings(**json.loads(settings)),
+            filename=filename,
+            clothing_description=clothing_description
+        )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,150 @@
+"""
+Solid-background keying for renders on a near-uniform backdrop
+"""
+from typing import Optional, Tuple
+import numpy as np
+from PIL import Image, ImageFilter
+from .config import Config
+from .models import KeyingCheck
+
+_BORDER_WIDTH = 4  # Pixels of each image edge used to fit the backdrop
+
+def key_background(rgb: np.ndarray, config: Config) -> Tuple[Optional[np.ndarray], KeyingCheck]:
+    """8-bit alpha keying out the backdrop of an (H, W, 3) render, if the key is confident
+
+    The backdrop is fitted to the border pixels as a linear gradient (so
+    soft studio falloff still keys), every pixel within KEYING_TOLERANCE of
+    it that is connected to the image border is background, and alpha
+    ramps over KEYING_SOFTNESS along the subject's edge before a light
+    feather. The alpha is None when the check fails: backdrop not uniform
+    along the border, implausible coverage, soft or low-contrast subject
+    edges, or backdrop-coloured pockets the fill cannot reach.
+    """
+    height, width = rgb.shape[:2]
+    check = KeyingCheck()
+    coefficients, check.border_agreement = _fit_backdrop(rgb, config.KEYING_TOLERANCE)
+    if check.border_agreement < config.KEYING_MIN_BORDER_AGREEMENT:
+        return None, check
+
+    # Largest channel difference from the backdrop, one channel plane at a time
+    columns = np.arange(width, dtype=np.float32) / width
+    rows = np.arange(height, dtype=np.float32)[:, None] / height
+    distance = np.zeros((height, width), dtype=np.float32)
+    for channel in range(3):
+        constant, x_slope, y_slope = coefficients[:, channel]
+        plane = (constant + x_slope * columns) + y_slope * rows
+        np.maximum(distance, np.abs(rgb[..., channel] - plane), out=distance)
+    candidate = distance <= config.KEYING_TOLERANCE
+    seeds = np.zeros_like(candidate)
+    seeds[0, :] = seeds[-1, :] = seeds[:, 0] = seeds[:, -1] = True
+    background = _flood(candidate, seeds & candidate)
+
+    foreground_pixels = height * width - int(background.sum())
+    check.coverage = foreground_pixels / (height * width)
+    low, high = config.KEYING_COVERAGE
+    if not low <= check.coverage <= high:
+        return None, check
+    check.enclosed = float((candidate & ~background).sum()) / foreground_pixels
+
+    edge = _max_filter(background, 1) & ~background
+    contrast = _max_filter(np.minimum(distance, 255).astype(np.uint8), 2)
+    check.edge_consistency = (
+        float((contrast[edge] >= config.KEYING_EDGE_CONTRAST).mean()) if edge.any() else 0.0
+    )
+    check.keyed = (check.edge_consistency >= config.KEYING_MIN_EDGE_CONSISTENCY
+                   and check.enclosed <= config.KEYING_MAX_ENCLOSED)
+    if not check.keyed:
+        return None, check
+
+    # Opaque subject, transparent backdrop, a ramp on the pixels next to it
+    near = _max_filter(background, 2) & ~background
+    alpha = np.full((height, width), 255, dtype=np.uint8)
+    alpha[background] = 0
+    ramp = (distance[near] - config.KEYING_TOLERANCE) / max(config.KEYING_SOFTNESS, 1)
+    alpha[near] = (np.clip(ramp, 0.0, 1.0) * 255 + 0.5).astype(np.uint8)
+    if config.KEYING_FEATHER > 0:
+        # Only the subject's bounding box (plus the blur's reach) can change
+        margin = int(np.ceil(config.KEYING_FEATHER * 3)) + 1
+        ys, xs = np.nonzero(~background)
+        top, bottom = max(ys.min() - margin, 0), min(ys.max() + margin + 1, height)
+        left, right = max(xs.min() - margin, 0), min(xs.max() + margin + 1, width)
+        region = Image.fromarray(alpha[top:bottom, left:right])
+        alpha[top:bottom, left:right] = np.asarray(
+            region.filter(ImageFilter.GaussianBlur(config.KEYING_FEATHER))
+        )
+    return alpha, check
+
+def _fit_backdrop(rgb: np.ndarray, tolerance: float) -> Tuple[np.ndarray, float]:
+    """Backdrop fitted to the border, and the share of border pixels matching it
+
+    Colour is modelled as c + cx * x / W + cy * y / H by least squares
+    (rows of the returned (3, 3) coefficients: c, cx, cy), refitted
+    once on the pixels within tolerance so a subject touching the border
+    does not pull the fit.
+    """
+    height, width = rgb.shape[:2]
+    rows, columns = np.arange(height), np.arange(width)
+    edge_rows = np.r_[rows[:_BORDER_WIDTH], rows[-_BORDER_WIDTH:]]
+    edge_columns = np.r_[columns[:_BORDER_WIDTH], columns[-_BORDER_WIDTH:]]
+    inner_rows = rows[_BORDER_WIDTH:-_BORDER_WIDTH]
+    ys = np.r_[np.repeat(edge_rows, width), np.repeat(inner_rows, len(edge_columns))]
+    xs = np.r_[np.tile(columns, len(edge_rows)), np.tile(edge_columns, len(inner_rows))]
+    design = np.stack([np.ones(len(xs)), xs / width, ys / height], axis=1)
+    colours = rgb[ys, xs, :3].astype(np.float64)
+
+    inliers = np.ones(len(xs), dtype=bool)
+    for _ in range(2):
+        coefficients = np.linalg.lstsq(design[inliers], colours[inliers], rcond=None)[0]
+        inliers = np.abs(design @ coefficients - colours).max(axis=1) <= tolerance
+        if not inliers.any():
+            return coefficients.astype(np.float32), 0.0
+    return coefficients.astype(np.float32), float(inliers.mean())
+
+def _flood(candidate: np.ndarray, seeds: np.ndarray) -> np.ndarray:
+    """Pixels of candidate 4-connected to seeds
+
+    Alternating row and column sweeps: every run of candidate pixels in a
+    row (then column) that holds a filled pixel is filled whole, until a
+    pass of both adds nothing. A handful of passes covers a backdrop
+    around a figure.
+    """
+    row_runs, row_count = _run_ids(candidate)
+    column_runs, column_count = _run_ids(candidate.T)
+    filled = seeds
+    count = -1
+    while True:
+        filled = _spread(row_runs, row_count, filled)
+        filled = _spread(column_runs, column_count, filled.T).T
+        new_count = int(filled.sum())
+        if new_count == count:
+            return filled
+        count = new_count
+
+def _run_ids(mask: np.ndarray) -> Tuple[np.ndarray, int]:
+    """Number each horizontal run of True pixels from 1 (0 = not in mask), and the run count"""
+    starts = mask.copy()
+    starts[:, 1:] &= ~mask[:, :-1]
+    ids = np.cumsum(starts.ravel(), dtype=np.int32).reshape(mask.shape)
+    count = int(ids[-1, -1])
+    ids[~mask] = 0
+    return ids, count
+
+def _spread(run_ids: np.ndarray, count: int, filled: np.ndarray) -> np.ndarray:
+    hit = np.zeros(count + 1, dtype=bool)
+    hit[run_ids[filled]] = True
+    hit[0] = False
+    return hit[run_ids]
+
+def _max_filter(values: np.ndarray, radius: int) -> np.ndarray:
+    """Maximum over (2r+1)x(2r+1) windows (bool or uint8), separable over shifted slices"""
+    result = values.copy()
+    for axis in (0, 1):
+        source = result.copy()
+        length = source.shape[axis]
+        for offset in range(1, radius + 1):
+            ahead = [slice(None), slice(None)]
+            behind = [slice(None), slice(None)]
+            ahead[axis], behind[axis] = slice(offset, length), slice(0, length - offset)
+            np.maximum(result[tuple(behind)], source[tuple(ahead)], out=result[tuple(behind)])
+            np.maximum(result[tuple(ahead)], source[tuple(behind)], out=result[tuple(ahead)])
+    return result
@@ -0,0 +1,228 @@
+"""
+Batched background removal through onnxruntime
+"""
+import os
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import onnxruntime as ort
+from PIL import Image
+from .config import Config
+from .models import MattingBenchmark
+
+# Model input size and normalization, as rembg feeds these models
+_MODEL_INPUTS: Dict[str, Tuple[Tuple[int, int], Tuple[float, ...], Tuple[float, ...]]] = {
+    "u2net": ((320, 320), (0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
+    "u2netp": ((320, 320), (0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
+    "u2net_human_seg": ((320, 320), (0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
+    "silueta": ((320, 320), (0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
+    "isnet-general-use": ((1024, 1024), (0.5, 0.5, 0.5), (1.0, 1.0, 1.0)),
+}
+
+def model_path(model: str) -> Path:
+    """Where rembg keeps a model's ONNX file (downloaded by rembg on first use)"""
+    home = os.getenv("U2NET_HOME", os.path.join(os.getenv("XDG_DATA_HOME", "~"), ".u2net"))
+    return Path(home).expanduser() / f"{model}.onnx"
+
+def session_options(intra_op_threads: int = 0, inter_op_threads: int = 0) -> ort.SessionOptions:
+    """onnxruntime options; 0 threads = onnxruntime's default"""
+    options = ort.SessionOptions()
+    if intra_op_threads > 0:
+        options.intra_op_num_threads = intra_op_threads
+    if inter_op_threads > 0:
+        options.inter_op_num_threads = inter_op_threads
+    return options
+
+def intra_op_threads(config: Config) -> int:
+    """Configured intra-op threads, or the CPU cores shared among post-processing workers"""
+    return config.MATTING_INTRA_OP_THREADS or max(
+        1, (os.cpu_count() or 1) // max(1, config.POSTPROCESS_WORKERS)
+    )
+
+def rembg_session(config: Config):
+    """rembg session for REMBG_MODEL with the configured threads and providers"""
+    from rembg import new_session
+    options = session_options(intra_op_threads(config), config.MATTING_INTER_OP_THREADS)
+    providers = config.MATTING_PROVIDERS or None
+    try:
+        from rembg.sessions import sessions_class
+    except ImportError:
+        # Older rembg: no way to pass session options
+        return new_session(config.REMBG_MODEL)
+    for session_class in sessions_class:
+        if session_class.name() == config.REMBG_MODEL:
+            return session_class(config.REMBG_MODEL, options, providers)
+    return new_session(config.REMBG_MODEL, providers=providers)
+
+class BatchMatting:
+    """Runs a rembg segmentation model on stacked batches of images
+
+    Images are resized to the model's input size and normalized together,
+    the model runs once per batch, and the predicted masks are scaled back
+    and applied with NumPy. Output matches rembg's default cutout (alpha =
+    mask, colour premultiplied by it). Models exported with a fixed batch
+    size of 1 run image by image through the same session.
+    """
+
+    def __init__(self, model: str, path: Path = None, intra_op_threads: int = 0,
+                 inter_op_threads: int = 0, providers: List[str] = None):
+        if model not in _MODEL_INPUTS:
+            raise ValueError(f"No input settings for matting model '{model}'")
+        self.model = model
+        self.input_size, mean, std = _MODEL_INPUTS[model]
+        self.mean = np.array(mean, dtype=np.float32)
+        self.std = np.array(std, dtype=np.float32)
+
+        path = Path(path) if path else model_path(model)
+        if not path.is_file():
+            # Let rembg download the model the first time
+            from rembg import new_session
+            new_session(model)
+
+        self.session = ort.InferenceSession(
+            str(path), sess_options=session_options(intra_op_threads, inter_op_threads),
+            providers=providers or ort.get_available_providers()
+        )
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.batch_limit: Optional[int] = (
+            model_input.shape[0] if isinstance(model_input.shape[0], int) else None
+        )
+
+    @classmethod
+    def from_config(cls, config: Config) -> 'BatchMatting':
+        return cls(config.REMBG_MODEL, config.MATTING_MODEL_PATH or None, intra_op_threads(config),
+                   config.MATTING_INTER_OP_THREADS, config.MATTING_PROVIDERS or None)
+
+    def masks(self, images: List[Image.Image]) -> List[np.ndarray]:
+        """8-bit masks (HxW) for images of any size"""
+        if not images:
+            return []
+        predictions = (self.predictions(images) * 255).astype(np.uint8)
+        return [
+            np.asarray(Image.fromarray(prediction).resize(image.size, Image.Resampling.LANCZOS))
+            for prediction, image in zip(predictions, images)
+        ]
+
+    def predictions(self, images: List[Image.Image]) -> np.ndarray:
+        """Raw masks at the model's input size, (N, h, w) floats scaled to 0..1"""
+        inputs = np.stack([
+            np.asarray(image.convert("RGB").resize(self.input_size, Image.Resampling.LANCZOS))
+            for image in images
+        ]).astype(np.float32)
+        inputs /= np.maximum(inputs.max(axis=(1, 2, 3), keepdims=True), 1e-6)
+        inputs = ((inputs - self.mean) / self.std).transpose(0, 3, 1, 2)
+
+        if self.batch_limit is None:
+            predictions = self.session.run(None, {self.input_name: inputs})[0]
+        else:
+            predictions = np.concatenate([
+                self.session.run(None, {self.input_name: inputs[i:i + self.batch_limit]})[0]
+                for i in range(0, len(inputs), self.batch_limit)
+            ])
+
+        predictions = predictions[:, 0]
+        low = predictions.min(axis=(1, 2), keepdims=True)
+        high = predictions.max(axis=(1, 2), keepdims=True)
+        return (predictions - low) / np.maximum(high - low, 1e-6)
+
+    def cutout(self, images: List[Image.Image]) -> List[Image.Image]:
+        """RGBA cutouts of images, one model run per batch"""
+        return [Image.fromarray(rgba) for rgba in self.cutout_arrays(images)]
+
+    def cutout_arrays(self, images: List[Image.Image]) -> List[np.ndarray]:
+        """RGBA cutouts as (H, W, 4) arrays"""
+        masks = self.masks(images)
+        if len({image.size for image in images}) == 1:
+            # Same-size renders: apply all masks in one vectorized step
+            rgb = np.stack([np.asarray(image.convert("RGB")) for image in images])
+            return list(apply_masks(rgb, np.stack(masks)))
+        return [apply_masks(np.asarray(image.convert("RGB"))[None], mask[None])[0]
+                for image, mask in zip(images, masks)]
+
+def guided_upsample(mask: np.ndarray, guide: np.ndarray, radius: int, eps: float) -> np.ndarray:
+    """Upsample a low-resolution 0..1 mask to the guide image's size along its edges
+
+    Fast guided filter (He & Sun): the linear coefficients relating the
+    mask to the guide's luminance are fitted at the mask's resolution, then
+    upsampled and applied to the full-size luminance, so the alpha edge
+    follows the edges of the image rather than the blur of the small mask.
+    radius is in guide pixels. Returns an 8-bit mask.
+    """
+    height, width = guide.shape[:2]
+    low_height, low_width = mask.shape
+    gray = Image.fromarray(np.ascontiguousarray(guide[..., :3])).convert("L")
+    luminance = np.asarray(gray, dtype=np.float32) / 255
+    low_luminance = np.asarray(gray.resize((low_width, low_height), Image.Resampling.BILINEAR),
+                               dtype=np.float32) / 255
+    low_radius = max(1, round(radius * low_width / width))
+
+    mean_i = _box_mean(low_luminance, low_radius)
+    mean_p = _box_mean(mask, low_radius)
+    covariance = _box_mean(low_luminance * mask, low_radius) - mean_i * mean_p
+    variance = _box_mean(low_luminance * low_luminance, low_radius) - mean_i * mean_i
+    a = covariance / (variance + eps)
+    b = mean_p - a * mean_i
+
+    a = _resize_float(_box_mean(a, low_radius), (width, height))
+    b = _resize_float(_box_mean(b, low_radius), (width, height))
+    return (np.clip(a * luminance + b, 0.0, 1.0) * 255 + 0.5).astype(np.uint8)
+
+def _resize_float(values: np.ndarray, size: Tuple[int, int]) -> np.ndarray:
+    return np.asarray(Image.fromarray(values.astype(np.float32)).resize(size, Image.Resampling.BILINEAR))
+
+def _box_mean(values: np.ndarray, radius: int) -> np.ndarray:
+    """Mean over (2r+1)x(2r+1) windows (edges replicated), via cumulative sums"""
+    size = 2 * radius + 1
+    padded = np.pad(values, radius, mode="edge")
+    sums = np.cumsum(padded, axis=0, dtype=np.float64)
+    sums = np.concatenate([np.zeros((1, sums.shape[1])), sums], axis=0)
+    rows = sums[size:] - sums[:-size]
+    sums = np.cumsum(rows, axis=1)
+    sums = np.concatenate([np.zeros((sums.shape[0], 1)), sums], axis=1)
+    return ((sums[:, size:] - sums[:, :-size]) / (size * size)).astype(np.float32)
+
+def apply_masks(rgb: np.ndarray, masks: np.ndarray) -> np.ndarray:
+    """(N, H, W, 3) colours and (N, H, W) masks -> premultiplied (N, H, W, 4) RGBA"""
+    alpha = masks[..., None].astype(np.uint16)
+    colour = (rgb.astype(np.uint16) * alpha + 127) // 255
+    return np.concatenate([colour, alpha], axis=-1).astype(np.uint8)
+
+def mask_iou(mask: np.ndarray, reference: np.ndarray) -> float:
+    """Intersection over union of two 8-bit masks thresholded at half opacity"""
+    mask, reference = mask >= 128, reference >= 128
+    union = np.logical_or(mask, reference).sum()
+    return float(np.logical_and(mask, reference).sum() / union) if union else 1.0
+
+def benchmark(images: List[Image.Image], models: List[str], thread_counts: List[int],
+              batch_sizes: List[int], reference_model: str,
+              providers: List[str] = None) -> List[MattingBenchmark]:
+    """Throughput and mask agreement of each model/provider/threads/batch option
+
+    Agreement is the mean IoU against the masks of reference_model (the
+    heavy model whose quality is the target). Each session gets one
+    warm-up run before it is timed.
+    """
+    reference = BatchMatting(reference_model).masks(images)
+    results = []
+    for provider in providers or ort.get_available_providers():
+        for model in models:
+            for threads in thread_counts:
+                matting = BatchMatting(model, intra_op_threads=threads, providers=[provider])
+                matting.masks(images[:1])
+                for batch_size in batch_sizes:
+                    started = time.perf_counter()
+                    masks = []
+                    for i in range(0, len(images), batch_size):
+                        masks.extend(matting.masks(images[i:i + batch_size]))
+                    elapsed = time.perf_counter() - started
+                    results.append(MattingBenchmark(
+                        model=model,
+                        provider=provider,
+                        intra_op_threads=threads,
+                        batch_size=batch_size,
+                        images_per_second=len(images) / max(elapsed, 1e-9),
+                        iou=float(np.mean([mask_iou(m, r) for m, r in zip(masks, reference)]))
+                    ))
+    return results
@@ -1,8 +1,8 @@
 """
 Data models for SCW Character Image Generator
 """
-from dataclasses import dataclass
-from typing import Optional, List, Dict, Any
+from dataclasses import dataclass, field
+from typing import Optional, List, Dict, Any, Tuple
 
 @dataclass
 class CharacterAttributes:
@@ -74,6 +74,7 @@ class GenerationSettings:
     seed: int = -1
     width: int = 512
     height: int = 800
+    checkpoint: Optional[str] = None  # Pinned sd_model_checkpoint title
     
 @dataclass
 class PoseVariant:
@@ -93,3 +94,85 @@ class GenerationResult:
     error: Optional[str] = None
     pose: Optional[str] = None
     reveal_level: Optional[int] = None
+    
+    @classmethod
+    def failed(cls, job: 'GenerationJob', error: str) -> 'GenerationResult':
+        """Create a failed result for a job"""
+        return cls(success=False, error=error, pose=job.pose, reveal_level=job.reveal_level)
+
+@dataclass
+class GenerationJob:
+    """A single (character, pose, reveal level) render job"""
+    character: CharacterAttributes
+    char_id: str
+    pose: str
+    reveal_level: int
+    variant_index: int
+    prompt: str
+    negative_prompt: str
+    settings: GenerationSettings
+    filename: str
+    clothing_description: str = ""
+
+@dataclass
+class PreflightReport:
+    """Capabilities of a WebUI backend checked before a run"""
+    loaded_checkpoint: Optional[str] = None
+    checkpoint: Optional[str] = None
+    checkpoint_hash: Optional[str] = None
+    checkpoint_overrides: Dict[str, str] = field(default_factory=dict)
+    checkpoint_hashes: Dict[str, str] = field(default_factory=dict)  # title -> sha256/short hash
+    errors: List[str] = field(default_factory=list)
+    
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+@dataclass
+class RunPlan:
+    """Every job of a run, split into priority tiers"""
+    tiers: List[Tuple[int, List[GenerationJob]]] = field(default_factory=list)
+    char_ids: List[str] = field(default_factory=list)
+    done: Dict[str, List[GenerationResult]] = field(default_factory=dict)  # Saved earlier, per char_id
+    
+    @property
+    def total_jobs(self) -> int:
+        return sum(len(jobs) for _, jobs in self.tiers)
+
+@dataclass
+class ResolutionEstimate:
+    """Estimated cost of a run's jobs at one resolution and step count"""
+    width: int
+    height: int
+    steps: int
+    jobs: int = 0
+    gpu_seconds: float = 0.0
+    output_bytes: float = 0.0
+    from_history: bool = False  # False = rough defaults, no earlier runs at this size
+
+@dataclass
+class MattingBenchmark:
+    """Measured speed and quality of one background-removal option"""
+    model: str
+    provider: str
+    intra_op_threads: int
+    batch_size: int
+    images_per_second: float
+    iou: float  # Mean mask IoU against the reference model
+
+@dataclass
+class KeyingCheck:
+    """Confidence measures of a solid-background key"""
+    border_agreement: float = 0.0  # Border pixels matching the fitted backdrop
+    coverage: float = 0.0  # Foreground share of the image
+    edge_consistency: float = 0.0  # Subject edge pixels with a clear step from the backdrop
+    enclosed: float = 0.0  # Backdrop-coloured area the fill could not reach, relative to the foreground
+    keyed: bool = False  # True = confident enough to use instead of the matting model
+
+@dataclass
+class EncodedPng:
+    """An encoded image and how it was encoded"""
+    data: bytes
+    filter: str  # Row filter choice that won the search
+    palette_colors: int = 0  # 0 = lossless truecolour
+    psnr: Optional[float] = None  # Palette images: dB against the original
@@ -0,0 +1,235 @@
+"""
+Post-processing pipeline between txt2img responses and files on disk
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Optional, Tuple
+from PIL import Image
+from .config import Config
+from .image_processor import ImageProcessor
+from .models import GenerationJob, GenerationResult
+
+# One ImageProcessor per worker, so rembg loads its model once per process
+_processor: Optional[ImageProcessor] = None
+
+def _init_worker(config: Config):
+    global _processor
+    _processor = ImageProcessor(config)
+
+def _process_image(pose: str, image: Image.Image) -> bytes:
+    """CPU stage: remove background, resize and encode to PNG bytes"""
+    if pose == "head":
+        return _processor.headshot_png(image)
+    return _processor.body_pngs([image])[0]
+
+def _process_body_and_head(image: Image.Image) -> Tuple[bytes, Image.Image]:
+    """CPU stage for a body render a headshot is cropped from (one background removal)"""
+    return _processor.body_png_and_head_crop(image)
+
+def _process_body_batch(images: List[Image.Image]) -> List[bytes]:
+    """CPU stage for a batch of body images (one matting model run)"""
+    return _processor.body_pngs(images)
+
+def resolved(result: GenerationResult) -> Future:
+    """Future that already holds a result (e.g. a job that failed to generate)"""
+    future: Future = Future()
+    future.set_result(result)
+    return future
+
+class ImagePipeline:
+    """Processes and saves generated images while the next request renders
+
+    Stages: generate (caller, image decoded as the response streams in) ->
+    worker pool: background removal, resize and PNG encode -> writer thread:
+    write the file. The CPU stages run in POSTPROCESS_WORKERS processes
+    (or threads with POSTPROCESS_PROCESSES = False). At most
+    PIPELINE_QUEUE_SIZE images sit between generation and disk; submit()
+    blocks once the pipeline is full, which holds back the next txt2img
+    request rather than piling up images in memory.
+
+    With MATTING_ENGINE = "batch", body images are collected into batches of
+    MATTING_BATCH_SIZE (or whatever arrived within MATTING_BATCH_WAIT
+    seconds) and each batch goes to one worker as a unit.
+    """
+
+    def __init__(self, output_dir: Path, config: Config = None, workers: int = None,
+                 queue_size: int = None, use_processes: bool = None):
+        self.config = config or Config()
+        self.output_dir = Path(output_dir)
+        self.workers = max(1, workers or self.config.POSTPROCESS_WORKERS)
+        self.queue_size = max(self.workers, queue_size or self.config.PIPELINE_QUEUE_SIZE)
+        if use_processes is None:
+            use_processes = self.config.POSTPROCESS_PROCESSES
+
+        executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        self._executor = executor_class(max_workers=self.workers, initializer=_init_worker,
+                                        initargs=(self.config,))
+        self._slots = threading.BoundedSemaphore(self.queue_size)
+        self._writes: queue.Queue = queue.Queue(maxsize=self.queue_size)
+        self._writer = threading.Thread(target=self._write_loop, daemon=True,
+                                        name="pipeline-writer")
+        self._writer.start()
+        self.blocked_seconds = 0.0
+
+        # Body images waiting to be processed together
+        self.batch_size = (max(1, self.config.MATTING_BATCH_SIZE)
+                           if self.config.MATTING_ENGINE == "batch" else 1)
+        self._batch: List[Tuple[GenerationJob, Image.Image, Future]] = []
+        self._batch_lock = threading.Lock()
+        self._batch_timer: Optional[threading.Timer] = None
+
+    def submit(self, job: GenerationJob, image: Image.Image) -> Future:
+        """Queue an image for processing and saving
+
+        Returns a future for the job's GenerationResult. Blocks while
+        PIPELINE_QUEUE_SIZE images are already in the pipeline.
+        """
+        started = time.monotonic()
+        self._slots.acquire()
+        self.blocked_seconds += time.monotonic() - started
+
+        result: Future = Future()
+        if job.pose != "head" and self.batch_size > 1:
+            self._add_to_batch(job, image, result)
+            return result
+
+        try:
+            processing = self._executor.submit(_process_image, job.pose, image)
+        except Exception as e:
+            self._slots.release()
+            result.set_result(GenerationResult.failed(job, str(e)))
+            return result
+
+        # Never blocks: each queued write holds one of queue_size slots
+        processing.add_done_callback(lambda done: self._writes.put((job, done, result)))
+        return result
+
+    def submit_with_headshot(self, job: GenerationJob, image: Image.Image) -> Tuple[Future, Future]:
+        """Queue a body render that a headshot is cropped from (HEADSHOT_MODE "body")
+
+        Returns a future for the body job's GenerationResult and a future for
+        the head crop, placed with the mask of the body's own background
+        removal. The crop is not saved; submit it as the headshot job.
+        Bypasses body batching.
+        """
+        started = time.monotonic()
+        self._slots.acquire()
+        self.blocked_seconds += time.monotonic() - started
+
+        result: Future = Future()
+        crop: Future = Future()
+        try:
+            processing = self._executor.submit(_process_body_and_head, image)
+        except Exception as e:
+            self._slots.release()
+            result.set_result(GenerationResult.failed(job, str(e)))
+            crop.set_exception(e)
+            return result, crop
+
+        def split(done: Future):
+            body: Future = Future()
+            try:
+                body_png, head = done.result()
+                body.set_result(body_png)
+                crop.set_result(head)
+            except Exception as e:
+                body.set_exception(e)
+                crop.set_exception(e)
+            self._writes.put((job, body, result))
+
+        processing.add_done_callback(split)
+        return result, crop
+
+    def process(self, job: GenerationJob, image: Image.Image) -> GenerationResult:
+        """Process and save one image, waiting for the result"""
+        return self.submit(job, image).result()
+
+    def close(self):
+        """Finish queued images and stop the workers"""
+        self._flush_batch()
+        self._executor.shutdown(wait=True)
+        self._writes.put(None)
+        self._writer.join()
+
+    def __enter__(self) -> 'ImagePipeline':
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _add_to_batch(self, job: GenerationJob, image: Image.Image, result: Future):
+        with self._batch_lock:
+            self._batch.append((job, image, result))
+            if len(self._batch) >= self.batch_size:
+                batch = self._take_batch()
+            else:
+                batch = None
+                if self._batch_timer is None:
+                    self._batch_timer = threading.Timer(self.config.MATTING_BATCH_WAIT,
+                                                        self._flush_batch)
+                    self._batch_timer.daemon = True
+                    self._batch_timer.start()
+        if batch:
+            self._submit_batch(batch)
+
+    def _take_batch(self) -> List[Tuple[GenerationJob, Image.Image, Future]]:
+        """Detach the collected batch (call with _batch_lock held)"""
+        batch, self._batch = self._batch, []
+        if self._batch_timer is not None:
+            self._batch_timer.cancel()
+            self._batch_timer = None
+        return batch
+
+    def _flush_batch(self):
+        """Send a partial batch on (timer expired or pipeline closing)"""
+        with self._batch_lock:
+            batch = self._take_batch()
+        if batch:
+            self._submit_batch(batch)
+
+    def _submit_batch(self, batch: List[Tuple[GenerationJob, Image.Image, Future]]):
+        try:
+            processing = self._executor.submit(_process_body_batch,
+                                               [image for _, image, _ in batch])
+        except Exception as e:
+            for job, _, result in batch:
+                self._slots.release()
+                result.set_result(GenerationResult.failed(job, str(e)))
+            return
+
+        def split(done: Future):
+            # One write per image, each holding its own slot
+            for index, (job, _, result) in enumerate(batch):
+                item: Future = Future()
+                try:
+                    item.set_result(done.result()[index])
+                except Exception as e:
+                    item.set_exception(e)
+                self._writes.put((job, item, result))
+
+        processing.add_done_callback(split)
+
+    def _write_loop(self):
+        """I/O stage: write encoded images in completion order"""
+        while True:
+            item = self._writes.get()
+            if item is None:
+                return
+
+            job, processing, result = item
+            try:
+                (self.output_dir / job.filename).write_bytes(processing.result())
+                outcome = GenerationResult(
+                    success=True,
+                    filename=job.filename,
+                    pose=job.pose,
+                    reveal_level=job.reveal_level
+                )
+            except Exception as e:
+                outcome = GenerationResult.failed(job, str(e))
+            finally:
+                self._slots.release()
+            result.set_result(outcome)
@@ -0,0 +1,211 @@
+"""
+Run-wide job planning: selection, priority tiers grouped by resolution, estimates
+"""
+import hashlib
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set, Tuple
+from .config import Config, PoseConfig
+from .character_ids import CharacterIdRegistry, character_key, preset_ids
+from .models import CharacterAttributes, GenerationJob, ResolutionEstimate
+from .timing_history import TimingHistory
+
+@dataclass
+class JobFilter:
+    """Subset of a run's jobs to render (None = no restriction)
+
+    A shard (k, n) keeps the jobs whose stable hash of preset key, pose and
+    reveal level falls in partition k of n, so n machines given the same
+    characters render disjoint parts of the pack without coordinating.
+    """
+    poses: Optional[Set[str]] = None
+    reveal_levels: Optional[Set[int]] = None
+    characters: Optional[Set[str]] = None  # Preset names or character IDs
+    shard: Optional[Tuple[int, int]] = None  # (k, n), k from 1 to n
+
+    def selects_character(self, character: CharacterAttributes, char_id: Optional[str] = None) -> bool:
+        return (self.characters is None or character.name in self.characters
+                or (char_id is not None and char_id in self.characters))
+
+    def selects(self, char_key: str, pose: str, reveal_level: int) -> bool:
+        if self.poses is not None and pose not in self.poses:
+            return False
+        if self.reveal_levels is not None and reveal_level not in self.reveal_levels:
+            return False
+        return self.in_shard(f"{char_key}/{pose}/{reveal_level}")
+
+    def in_shard(self, key: str) -> bool:
+        """Whether a stable key hashes into this machine's shard"""
+        if self.shard is None:
+            return True
+        k, n = self.shard
+        return int(hashlib.sha1(key.encode()).hexdigest(), 16) % n == k - 1
+
+def parse_job_filter(shard: str = None, poses: str = None, reveal: str = None,
+                     characters: str = None, pose_config: PoseConfig = None) -> JobFilter:
+    """Build a filter from CLI values: "K/N", "cas,uw", "0-2,9", "name1,12345"
+
+    Pose aliases are resolved; raises ValueError for malformed or unknown values.
+    """
+    pose_config = pose_config or PoseConfig()
+    job_filter = JobFilter()
+    if shard:
+        try:
+            k, n = (int(part) for part in shard.split("/"))
+        except ValueError:
+            raise ValueError(f"Shard must look like K/N, got '{shard}'")
+        if not 1 <= k <= n:
+            raise ValueError(f"Shard {shard}: K must be between 1 and N")
+        job_filter.shard = (k, n)
+    if poses:
+        job_filter.poses = set()
+        for pose in _split(poses):
+            effective_pose = pose_config.POSE_ALIAS_MAP.get(pose, pose)
+            if effective_pose not in pose_config.POSES_CONFIG:
+                raise ValueError(f"Unknown pose '{pose}'")
+            job_filter.poses.add(effective_pose)
+    if reveal:
+        job_filter.reveal_levels = parse_ranges(reveal)
+    if characters:
+        job_filter.characters = set(_split(characters))
+    return job_filter
+
+def parse_ranges(values: str) -> Set[int]:
+    """Numbers from a list like "0,3-5" """
+    numbers: Set[int] = set()
+    for part in _split(values):
+        try:
+            first, _, last = part.partition("-")
+            numbers.update(range(int(first), int(last or first) + 1))
+        except ValueError:
+            raise ValueError(f"Expected numbers or ranges like 0,3-5, got '{part}'")
+    return numbers
+
+def _split(values: str) -> List[str]:
+    return [value.strip() for value in values.split(",") if value.strip()]
+
+def pose_priority(pose: str, config: Config = None, pose_config: PoseConfig = None) -> int:
+    """Priority tier of a pose (lower runs first)
+
+    Config.POSE_PRIORITY overrides; otherwise required poses are tier 0 and
+    everything else tier 1.
+    """
+    config = config or Config()
+    pose_config = pose_config or PoseConfig()
+    if pose in config.POSE_PRIORITY:
+        return config.POSE_PRIORITY[pose]
+    return 0 if pose_config.POSES_CONFIG.get(pose, {}).get("required", False) else 1
+
+def resolution_key(job: GenerationJob) -> Tuple[int, int, int]:
+    return (job.settings.width, job.settings.height, job.settings.steps)
+
+def derives_headshot(pose: str, config: Config = None) -> bool:
+    """True for a headshot cropped from a body render (HEADSHOT_MODE "body")"""
+    return pose == "head" and (config or Config()).HEADSHOT_MODE == "body"
+
+def render_key(job: GenerationJob, config: Config = None) -> Tuple[int, int, int]:
+    """(width, height, steps) of the render a job's image comes from
+
+    A derived headshot comes from its character's body render, so it is
+    grouped with the body jobs rather than with txt2img headshots.
+    """
+    if derives_headshot(job.pose, config):
+        return generation_key(config.HEADSHOT_SOURCE_POSE, config)
+    return resolution_key(job)
+
+def group_by_resolution(jobs: List[GenerationJob], config: Config = None) -> List[GenerationJob]:
+    """Stable-order jobs so each (width, height, steps) group runs back to back
+
+    Groups keep the order in which they first appear, and jobs keep their
+    order within a group, so a character's variants stay adjacent for
+    batching.
+    """
+    config = config or Config()
+    first_seen: Dict[Tuple[int, int, int], int] = {}
+    for job in jobs:
+        first_seen.setdefault(render_key(job, config), len(first_seen))
+    return sorted(jobs, key=lambda job: first_seen[render_key(job, config)])
+
+def plan_tiers(jobs: List[GenerationJob], config: Config = None,
+               pose_config: PoseConfig = None) -> List[Tuple[int, List[GenerationJob]]]:
+    """Split a run's jobs into priority tiers, each grouped by resolution"""
+    tiers: Dict[int, List[GenerationJob]] = {}
+    for job in jobs:
+        tiers.setdefault(pose_priority(job.pose, config, pose_config), []).append(job)
+    return [(priority, group_by_resolution(tiers[priority], config)) for priority in sorted(tiers)]
+
+def default_poses(gender: str, pose_config: PoseConfig = None) -> List[str]:
+    """Poses generated for a gender when none are given"""
+    pose_config = pose_config or PoseConfig()
+    return [pose for pose in pose_config.DEFAULT_POSES
+            if gender == "f" or not pose_config.POSES_CONFIG.get(pose, {}).get("female_only", False)]
+
+def expand_poses(character: CharacterAttributes, poses: List[str] = None,
+                 pose_config: PoseConfig = None) -> List[Tuple[str, int]]:
+    """(pose, reveal level) of every image of a character, aliases resolved"""
+    pose_config = pose_config or PoseConfig()
+    if poses is None:
+        poses = default_poses(character.gender, pose_config)
+    variants = []
+    for pose in poses:
+        effective_pose = pose_config.POSE_ALIAS_MAP.get(pose, pose)
+        pose_settings = pose_config.POSES_CONFIG.get(effective_pose, {})
+        if pose_settings.get("female_only", False) and character.gender != "f":
+            continue
+        variants.extend((effective_pose, reveal_level)
+                        for reveal_level in pose_settings.get("reveal_variants", [0]))
+    return variants
+
+def generation_key(pose: str, config: Config = None) -> Tuple[int, int, int]:
+    """(width, height, steps) a pose is rendered at (0 steps: cropped, not rendered)"""
+    config = config or Config()
+    if derives_headshot(pose, config):
+        return tuple(config.HEAD_TARGET_SIZE) + (0,)
+    if pose == "head":
+        return config.HEAD_GENERATION_SIZE + (config.HEADSHOT_STEPS,)
+    return config.BODY_GENERATION_SIZE + (config.DEFAULT_STEPS,)
+
+def estimate_run(characters: List[CharacterAttributes], config: Config = None,
+                 pose_config: PoseConfig = None, history: Optional[TimingHistory] = None,
+                 job_filter: Optional[JobFilter] = None,
+                 registry: Optional[CharacterIdRegistry] = None) -> List[ResolutionEstimate]:
+    """Job count, GPU seconds and output bytes of a run per resolution
+
+    Uses the timing history of earlier runs where available, otherwise
+    ESTIMATE_SECONDS_PER_MPX_STEP and ESTIMATE_BYTES_PER_PIXEL. Character
+    IDs for the filter are looked up in the registry when one is given
+    (with a shard, derived from the preset list as the run does).
+    """
+    config = config or Config()
+    job_filter = job_filter or JobFilter()
+    estimates: Dict[Tuple[int, int, int], ResolutionEstimate] = {}
+    occurrences: Dict[str, int] = {}
+    keyed = [(character_key(character, occurrences), character) for character in characters]
+    shard_ids = preset_ids(keyed) if job_filter.shard is not None else {}
+    for char_key, character in keyed:
+        char_id = shard_ids.get(char_key) or (registry.get(char_key) if registry is not None else None)
+        if not job_filter.selects_character(character, char_id):
+            continue
+        for pose, reveal_level in expand_poses(character, None, pose_config):
+            if not job_filter.selects(char_key, pose, reveal_level):
+                continue
+            key = generation_key(pose, config)
+            if key not in estimates:
+                width, height, steps = key
+                target = config.HEAD_TARGET_SIZE if pose == "head" else config.BODY_TARGET_SIZE
+                gpu_seconds = history.gpu_seconds(*key) if history else None
+                output_bytes = history.output_bytes(*key) if history else None
+                estimates[key] = ResolutionEstimate(
+                    width, height, steps,
+                    gpu_seconds=gpu_seconds if gpu_seconds is not None else
+                    width * height / 1e6 * steps * config.ESTIMATE_SECONDS_PER_MPX_STEP,
+                    output_bytes=output_bytes if output_bytes is not None else
+                    target[0] * target[1] * config.ESTIMATE_BYTES_PER_PIXEL,
+                    from_history=(gpu_seconds is not None or steps == 0) and output_bytes is not None
+                )
+            estimates[key].jobs += 1
+
+    # Per-image figures become totals for the run
+    for estimate in estimates.values():
+        estimate.gpu_seconds *= estimate.jobs
+        estimate.output_bytes *= estimate.jobs
+    return [estimates[key] for key in sorted(estimates)]
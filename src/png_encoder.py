@@ -0,0 +1,173 @@
+"""
+PNG encoding tuned for pack size
+"""
+import os
+import struct
+import zlib
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from PIL import Image
+from .config import Config
+from .models import EncodedPng
+
+_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+_FILTER_TYPES = {"none": 0, "sub": 1, "up": 2, "average": 3, "paeth": 4}
+_STRATEGIES = {"default": zlib.Z_DEFAULT_STRATEGY, "filtered": zlib.Z_FILTERED, "rle": zlib.Z_RLE}
+_COLOUR_TYPES = {3: 2, 4: 6}  # Bytes per pixel -> PNG colour type (RGB, RGBA)
+
+def encode_png(image: Image.Image, config: Config, palette: bool = False,
+               budget: int = 0) -> EncodedPng:
+    """Smallest PNG of an image found by the configured search
+
+    Fully transparent pixels are cleared to black first (invisible, but
+    they compress better). Every PNG_FILTERS row-filter choice is ranked
+    at PNG_SEARCH_LEVEL and the best one is written at PNG_ZLIB_LEVEL with
+    each of PNG_ZLIB_STRATEGIES. With palette (headshots) or when the
+    lossless result is over budget bytes, a quantized palette image is
+    tried as well and used if it is smaller and its PSNR against the
+    original is at least PNG_PALETTE_MIN_PSNR; over budget, fewer colours
+    are tried until one fits.
+    """
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA')
+    pixels = clear_transparent(np.asarray(image))
+    best = _lossless(pixels, config)
+
+    if palette or (budget and len(best.data) > budget):
+        for colours in (256, 128, 64):
+            candidate = _palette(pixels, colours, config)
+            if candidate is None:
+                break
+            if len(candidate.data) < len(best.data):
+                best = candidate
+            if not budget or len(best.data) <= budget:
+                break
+    return best
+
+def clear_transparent(pixels: np.ndarray) -> np.ndarray:
+    """Pixels with the colour of fully transparent pixels set to 0 (copied only if needed)"""
+    if pixels.shape[2] != 4:
+        return pixels
+    hidden = (pixels[..., 3] == 0) & pixels[..., :3].any(axis=2)
+    if not hidden.any():
+        return pixels
+    pixels = pixels.copy()
+    pixels[hidden] = 0
+    return pixels
+
+def filtered_rows(rows: np.ndarray, bpp: int) -> Dict[str, np.ndarray]:
+    """Each PNG row filter applied to (H, stride) uint8 scanlines, plus the
+    per-row "adaptive" choice (smallest sum of bytes read as signed values),
+    as (H, 1 + stride) arrays starting with the filter type byte"""
+    height, stride = rows.shape
+    a = np.zeros_like(rows)
+    a[:, bpp:] = rows[:, :-bpp]
+    b = np.zeros_like(rows)
+    b[1:] = rows[:-1]
+    c = np.zeros_like(rows)
+    c[1:, bpp:] = rows[:-1, :-bpp]
+
+    # Paeth predictor, the only one that needs signed arithmetic
+    a16, b16, c16 = a.astype(np.int16), b.astype(np.int16), c.astype(np.int16)
+    pa = np.abs(b16 - c16)
+    pb = np.abs(a16 - c16)
+    pc = np.abs(a16 + b16 - 2 * c16)
+    paeth = np.where((pa <= pb) & (pa <= pc), a, np.where(pb <= pc, b, c))
+
+    # uint8 subtraction wraps modulo 256, as the filters are defined
+    filtered = np.empty((len(_FILTER_TYPES), height, 1 + stride), dtype=np.uint8)
+    for filter_type in _FILTER_TYPES.values():
+        filtered[filter_type, :, 0] = filter_type
+    filtered[0, :, 1:] = rows
+    np.subtract(rows, a, out=filtered[1, :, 1:])
+    np.subtract(rows, b, out=filtered[2, :, 1:])
+    np.subtract(rows, (a >> 1) + (b >> 1) + (a & b & 1), out=filtered[3, :, 1:])
+    np.subtract(rows, paeth, out=filtered[4, :, 1:])
+
+    cost = np.abs(filtered[:, :, 1:].view(np.int8).astype(np.int16)).sum(axis=2)
+    results = {name: filtered[filter_type] for name, filter_type in _FILTER_TYPES.items()}
+    results["adaptive"] = filtered[cost.argmin(axis=0), np.arange(height)]
+    return results
+
+def png_bytes(header: bytes, idat: bytes, extra: List[Tuple[bytes, bytes]] = None) -> bytes:
+    """Assemble a PNG file from its IHDR payload, compressed image data and
+    chunks that go before it (PLTE, tRNS)"""
+    chunks = [(b"IHDR", header)] + (extra or []) + [(b"IDAT", idat), (b"IEND", b"")]
+    return _SIGNATURE + b"".join(
+        struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+        for tag, data in chunks
+    )
+
+def psnr(pixels: np.ndarray, reference: np.ndarray) -> float:
+    """Peak signal-to-noise ratio of two 8-bit arrays in dB (inf when identical)"""
+    error = np.mean((pixels.astype(np.float32) - reference.astype(np.float32)) ** 2)
+    return float("inf") if error == 0 else float(10 * np.log10(255.0 ** 2 / error))
+
+def _lossless(pixels: np.ndarray, config: Config) -> EncodedPng:
+    height, width, bpp = pixels.shape
+    header = struct.pack(">IIBBBBB", width, height, 8, _COLOUR_TYPES[bpp], 0, 0, 0)
+    data, filter_name = _search(pixels.reshape(height, width * bpp), bpp, config)
+    return EncodedPng(data=png_bytes(header, data), filter=filter_name)
+
+def _palette(pixels: np.ndarray, colours: int, config: Config) -> Optional[EncodedPng]:
+    """Quantized encoding, or None if it misses PNG_PALETTE_MIN_PSNR"""
+    height, width, bpp = pixels.shape
+    mode = 'RGBA' if bpp == 4 else 'RGB'
+    quantized = Image.fromarray(pixels).quantize(
+        colours, method=Image.Quantize.FASTOCTREE, dither=Image.Dither.NONE
+    )
+    quality = psnr(np.asarray(quantized.convert(mode)), pixels)
+    if quality < config.PNG_PALETTE_MIN_PSNR:
+        return None
+
+    indices = np.asarray(quantized)
+    used = int(indices.max()) + 1
+    entries = np.array(quantized.getpalette(mode), dtype=np.uint8).reshape(-1, bpp)[:used]
+    extra = [(b"PLTE", entries[:, :3].tobytes())]
+    if bpp == 4:
+        # tRNS may stop at the last entry that is not opaque
+        translucent = np.nonzero(entries[:, 3] != 255)[0]
+        if len(translucent):
+            extra.append((b"tRNS", entries[:translucent[-1] + 1, 3].tobytes()))
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 3, 0, 0, 0)
+    data, filter_name = _search(indices, 1, config)
+    return EncodedPng(data=png_bytes(header, data, extra), filter=filter_name,
+                      palette_colors=used, psnr=quality)
+
+def _search(rows: np.ndarray, bpp: int, config: Config) -> Tuple[bytes, str]:
+    """Compressed image data of the best row filter and zlib strategy, and the filter's name"""
+    filtered = filtered_rows(rows, bpp)
+    candidates = {name: filtered[name].tobytes() for name in config.PNG_FILTERS}
+    if len(candidates) > 1:
+        best_name = min(candidates, key=lambda name: len(
+            zlib.compress(candidates[name], config.PNG_SEARCH_LEVEL)
+        ))
+    else:
+        best_name = next(iter(candidates))
+
+    best = None
+    for strategy in config.PNG_ZLIB_STRATEGIES:
+        compressor = zlib.compressobj(config.PNG_ZLIB_LEVEL, zlib.DEFLATED, 15, 9,
+                                      _STRATEGIES[strategy])
+        data = compressor.compress(candidates[best_name]) + compressor.flush()
+        if best is None or len(data) < len(best):
+            best = data
+    return best, best_name
+
+def optimize_file(path: Path, config: Config, budget: int = 0) -> Tuple[int, EncodedPng]:
+    """Re-encode a pack PNG in place if that makes it smaller; returns its old size and the encoding
+
+    Headshots are recognised by the -head.png suffix of pack filenames.
+    """
+    path = Path(path)
+    before = path.stat().st_size
+    with Image.open(path) as image:
+        encoded = encode_png(image.convert('RGBA'), config,
+                             path.name.endswith("-head.png") and config.PNG_PALETTE_HEADSHOTS, budget)
+    if len(encoded.data) < before:
+        temp_path = path.with_name(path.name + ".tmp")
+        temp_path.write_bytes(encoded.data)
+        os.replace(temp_path, path)
+    return before, encoded
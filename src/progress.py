@@ -0,0 +1,156 @@
+"""
+Progress polling and stall detection for running generations
+"""
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, List, Optional, Tuple
+from .config import Config
+
+@dataclass
+class StepTiming:
+    """Per-step timing of one WebUI job"""
+    job_timestamp: str
+    sampling_steps: int = 0
+    step_seconds: List[float] = field(default_factory=list)
+    width: int = 0
+    height: int = 0
+    interrupted: bool = False
+
+    @property
+    def mean_step_seconds(self) -> Optional[float]:
+        if not self.step_seconds:
+            return None
+        return sum(self.step_seconds) / len(self.step_seconds)
+
+class ProgressWatcher:
+    """Polls /sdapi/v1/progress while requests to one backend are in flight
+
+    A stall is no change in job or sampling step for stall_timeout seconds
+    while the WebUI reports a running job; the watcher then calls
+    /sdapi/v1/interrupt so the backend moves on, and the request that
+    receives the interrupted (partial) image is reported as failed so the
+    scheduler can requeue it. Step timings are recorded per WebUI job and
+    handed to requests in completion order.
+    """
+
+    def __init__(self, client, config: Config = None, stall_timeout: float = None):
+        self.client = client
+        self.config = config or Config()
+        self.poll_interval = self.config.PROGRESS_POLL_INTERVAL
+        self.stall_timeout = stall_timeout or self.config.STALL_TIMEOUT
+        self.timings: List[StepTiming] = []
+        self.interrupts = 0
+        self._finished: Deque[StepTiming] = deque(maxlen=64)
+        self._current: Optional[StepTiming] = None
+        self._signature: Optional[Tuple] = None
+        self._last_change = time.monotonic()
+        self._last_step: Tuple[int, float] = (0, time.monotonic())
+        self._active = 0
+        self._pending_interrupts = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._thread: Optional[threading.Thread] = None
+
+    def request_started(self):
+        """Register a request and make sure the poller is running"""
+        with self._lock:
+            self._active += 1
+            if self._active == 1:
+                self._last_change = time.monotonic()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._poll_loop, daemon=True,
+                                                name="sd-progress")
+                self._thread.start()
+            self._wake.notify()
+
+    def request_finished(self, payload: Dict[str, Any]) -> Tuple[bool, Optional[StepTiming]]:
+        """Unregister a request; returns (was_interrupted, step timing)"""
+        with self._lock:
+            self._active -= 1
+            if self._active == 0 and self._current is not None:
+                self._finish_current()
+
+            timing = self._finished.popleft() if self._finished else None
+            if timing is not None:
+                timing.width = payload.get("width", 0)
+                timing.height = payload.get("height", 0)
+                self.timings.append(timing)
+
+            interrupted = self._pending_interrupts > 0
+            if interrupted:
+                self._pending_interrupts -= 1
+                if timing is not None:
+                    timing.interrupted = True
+            return interrupted, timing
+
+    def mean_step_seconds(self, width: int, height: int) -> Optional[float]:
+        """Average seconds per sampling step observed at a resolution"""
+        steps = [s for t in self.timings
+                 if (t.width, t.height) == (width, height) and not t.interrupted
+                 for s in t.step_seconds]
+        return sum(steps) / len(steps) if steps else None
+
+    def _poll_loop(self):
+        while True:
+            with self._lock:
+                while self._active == 0:
+                    if not self._wake.wait(timeout=30):
+                        if self._active == 0:
+                            self._thread = None
+                            return
+
+            progress = self.client.get_progress()
+            if progress:
+                self._observe(progress)
+            time.sleep(self.poll_interval)
+
+    def _observe(self, progress: Dict[str, Any]):
+        """Update step timings and detect stalls from one progress sample"""
+        state = progress.get("state") or {}
+        job = state.get("job_timestamp") or ""
+        running = bool(state.get("job"))
+        step = int(state.get("sampling_step") or 0)
+        now = time.monotonic()
+        interrupt = False
+
+        with self._lock:
+            if self._active == 0:
+                return
+
+            if running and (self._current is None or self._current.job_timestamp != job):
+                if self._current is not None:
+                    self._finish_current()
+                self._current = StepTiming(job_timestamp=job,
+                                           sampling_steps=int(state.get("sampling_steps") or 0))
+                self._last_step = (step, now)
+
+            if self._current is not None and running:
+                last_step, last_time = self._last_step
+                if step > last_step:
+                    per_step = (now - last_time) / (step - last_step)
+                    self._current.step_seconds.extend([per_step] * (step - last_step))
+                    self._last_step = (step, now)
+                elif step < last_step:
+                    # Next image of a batch starts sampling again from step 0
+                    self._last_step = (step, now)
+
+            signature = (job, state.get("job_no"), step)
+            if signature != self._signature:
+                self._signature = signature
+                self._last_change = now
+            elif running and now - self._last_change > self.stall_timeout:
+                interrupt = True
+                self._last_change = now
+                self._pending_interrupts += 1
+                self.interrupts += 1
+
+        if interrupt:
+            print(f"⚠️ Generation stalled for {self.stall_timeout:.0f}s at step {step} "
+                  f"on {self.client.base_url}, interrupting")
+            self.client.interrupt()
+
+    def _finish_current(self):
+        self._finished.append(self._current)
+        self._current = None
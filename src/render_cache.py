@@ -0,0 +1,117 @@
+"""
+Content-addressed on-disk cache of raw txt2img outputs
+"""
+import hashlib
+import io
+import json
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import asdict
+from pathlib import Path
+from typing import Optional
+from PIL import Image
+from .models import GenerationSettings
+
+class RenderCache:
+    """Raw WebUI images keyed by everything that determines them
+
+    The key hashes the prompt, negative prompt, generation settings (seed
+    included) and the checkpoint's hash, so after a template change only
+    images whose inputs actually changed miss the cache. Entries are PNG
+    files under directory/<2 hex>/<key>.png; when their total size exceeds
+    max_bytes the least recently used ones are evicted. Recency survives
+    restarts through the files' modification times.
+    """
+
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        # key -> size in bytes, least recently used first
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._load_index()
+
+    @staticmethod
+    def key(prompt: str, negative_prompt: str, settings: GenerationSettings,
+            checkpoint_hash: str) -> str:
+        """Cache key of one render"""
+        inputs = asdict(settings)
+        inputs["checkpoint"] = checkpoint_hash
+        inputs["prompt"] = prompt
+        inputs["negative_prompt"] = negative_prompt
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Image.Image]:
+        """Cached image for a key, or None"""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+
+        path = self._path(key)
+        try:
+            image = Image.open(path)
+            image.load()
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self._size -= self._entries.pop(key, 0)
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return image
+
+    def put(self, key: str, image: Image.Image):
+        """Store a raw image (fast PNG compression; evicts LRU entries as needed)"""
+        buffer = io.BytesIO()
+        image.save(buffer, "PNG", compress_level=1)
+        data = buffer.getvalue()
+
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        temp_path = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+        temp_path.write_bytes(data)
+        os.replace(temp_path, path)
+
+        with self._lock:
+            self._size += len(data) - self._entries.get(key, 0)
+            self._entries[key] = len(data)
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def summary(self) -> str:
+        return (f"{self.hits} hits, {self.misses} misses, {self.evictions} evicted, "
+                f"{len(self._entries)} entries ({self._size / 1024 / 1024:.1f} MB)")
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.png"
+
+    def _load_index(self):
+        """Rebuild the LRU order from files on disk"""
+        files = []
+        for path in self.directory.glob("*/*.png"):
+            stat = path.stat()
+            files.append((stat.st_mtime, path.stem, stat.st_size))
+        for _, key, size in sorted(files):
+            self._entries[key] = size
+            self._size += size
+        self._evict()
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._size -= size
+            self.evictions += 1
+            try:
+                self._path(key).unlink()
+            except OSError:
+                pass
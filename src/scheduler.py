@@ -0,0 +1,272 @@
+"""
+Retry, timeout and circuit-breaker policy for generation jobs
+"""
+import math
+import random
+import statistics
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple, TypeVar
+from .config import Config
+from .models import GenerationSettings
+from .timing_history import TimingHistory
+
+T = TypeVar("T")
+
+class CircuitBreaker:
+    """Stops sending work to a backend that keeps failing
+
+    closed: requests flow normally. After failure_threshold consecutive
+    failures the breaker opens and rejects work for reset_timeout seconds,
+    then half-opens to let a single trial request through. A failed trial
+    re-opens it with a doubled timeout (up to max_reset_timeout); a success
+    closes it.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float, max_reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.base_reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: Config) -> 'CircuitBreaker':
+        return cls(config.BREAKER_FAILURE_THRESHOLD, config.BREAKER_RESET_TIMEOUT,
+                   config.BREAKER_MAX_RESET_TIMEOUT)
+
+    def allow(self) -> bool:
+        """Check whether a request may be sent now"""
+        with self._lock:
+            if self.state == self.OPEN and self.retry_after() <= 0:
+                self.state = self.HALF_OPEN
+                self._trial_in_flight = False
+            if self.state == self.HALF_OPEN:
+                if self._trial_in_flight:
+                    return False
+                self._trial_in_flight = True
+                return True
+            return self.state == self.CLOSED
+
+    def retry_after(self) -> float:
+        """Seconds until an open breaker half-opens"""
+        if self.state != self.OPEN:
+            return 0.0
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def record_success(self):
+        """Close the breaker after a successful request"""
+        with self._lock:
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self.reset_timeout = self.base_reset_timeout
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        """Count a failure, opening the breaker once the threshold is reached"""
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == self.HALF_OPEN:
+                self.reset_timeout = min(self.reset_timeout * 2, self.max_reset_timeout)
+                self._open()
+            elif self.state == self.CLOSED and self.consecutive_failures >= self.failure_threshold:
+                self._open()
+
+    def trip(self):
+        """Open the breaker immediately (e.g. failed health check)"""
+        with self._lock:
+            if self.state != self.OPEN:
+                self._open()
+            else:
+                self.opened_at = time.monotonic()
+
+    def half_open(self):
+        """Allow a trial request right away (e.g. health check recovered)"""
+        with self._lock:
+            if self.state == self.OPEN:
+                self.state = self.HALF_OPEN
+                self._trial_in_flight = False
+
+    def _open(self):
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+        self.trips += 1
+        self._trial_in_flight = False
+
+class LatencyTracker:
+    """Learns per-image request latency for each resolution and step count"""
+
+    def __init__(self, config: Config = None):
+        self.config = config or Config()
+        # key -> (samples, mean, variance)
+        self._stats: Dict[Tuple[int, int, int], Tuple[int, float, float]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(settings: GenerationSettings) -> Tuple[int, int, int]:
+        return (settings.width, settings.height, settings.steps)
+
+    def record(self, settings: GenerationSettings, seconds: float, images: int = 1):
+        """Record the latency of a successful request"""
+        per_image = seconds / max(1, images)
+        alpha = self.config.LATENCY_EWMA_ALPHA
+        with self._lock:
+            samples, mean, variance = self._stats.get(self.key(settings), (0, per_image, 0.0))
+            if samples:
+                delta = per_image - mean
+                mean += alpha * delta
+                variance = (1 - alpha) * (variance + alpha * delta * delta)
+            self._stats[self.key(settings)] = (samples + 1, mean, variance)
+
+    def expected(self, settings: GenerationSettings) -> Optional[float]:
+        """Typical per-image latency, or None before enough samples"""
+        samples, mean, _ = self._stats.get(self.key(settings), (0, 0.0, 0.0))
+        if samples < self.config.LATENCY_MIN_SAMPLES:
+            return None
+        return mean
+
+    def timeout_for(self, settings: GenerationSettings, images: int = 1) -> float:
+        """Request timeout learned from observed latency"""
+        samples, mean, variance = self._stats.get(self.key(settings), (0, 0.0, 0.0))
+        if samples < self.config.LATENCY_MIN_SAMPLES:
+            return float(self.config.REQUEST_TIMEOUT)
+        high = mean + 4 * math.sqrt(variance)
+        timeout = self.config.TIMEOUT_FACTOR * high * max(1, images)
+        return max(float(self.config.MIN_REQUEST_TIMEOUT), timeout)
+
+class Pacer:
+    """Delays submissions only while the WebUI shows it is saturated
+
+    Every successful request yields a per-image service time: its latency
+    divided by the images it rendered and by the requests queued on the
+    backend alongside it (the API exposes no queue length, so queue depth is
+    our own outstanding requests). When the median of the last
+    PACER_WINDOW service times at a resolution/step count rises above
+    PACER_LATENCY_FACTOR times the best one seen, the backend is slowing
+    down under load and the next submission waits for the excess (capped at
+    PACER_MAX_DELAY). Otherwise there is no delay at all.
+    """
+
+    def __init__(self, config: Config = None):
+        self.config = config or Config()
+        self._best: Dict[Tuple[int, int, int], float] = {}
+        self._recent: Dict[Tuple[int, int, int], Deque[float]] = {}
+        self._lock = threading.Lock()
+        self.throttles = 0
+        self.throttled_seconds = 0.0
+
+    def record(self, settings: GenerationSettings, seconds: float, images: int = 1,
+               queue_depth: int = 1):
+        """Record the latency of a successful request"""
+        service = seconds / max(1, images) / max(1, queue_depth)
+        key = LatencyTracker.key(settings)
+        with self._lock:
+            self._best[key] = min(self._best.get(key, service), service)
+            self._recent.setdefault(key, deque(maxlen=self.config.PACER_WINDOW)).append(service)
+
+    def delay(self, settings: GenerationSettings) -> float:
+        """Seconds to hold the next submission (0 = backend keeps up)"""
+        key = LatencyTracker.key(settings)
+        with self._lock:
+            recent = list(self._recent.get(key, ()))
+            best = self._best.get(key)
+        if len(recent) < self.config.LATENCY_MIN_SAMPLES:
+            return 0.0
+
+        typical = statistics.median(recent)
+        if typical <= self.config.PACER_LATENCY_FACTOR * best:
+            return 0.0
+        return min(self.config.PACER_MAX_DELAY, typical - best)
+
+    def record_throttle(self, seconds: float):
+        with self._lock:
+            self.throttles += 1
+            self.throttled_seconds += seconds
+
+    def wait(self, settings: GenerationSettings):
+        """Block while the backend is saturated"""
+        delay = self.delay(settings)
+        if delay > 0:
+            time.sleep(delay)
+            self.record_throttle(delay)
+
+    def summary(self) -> str:
+        if not self.throttles:
+            return "no throttling needed"
+        return (f"throttled {self.throttles} submission(s) for "
+                f"{self.throttled_seconds:.1f}s in total")
+
+class JobScheduler:
+    """Retry policy shared by the serial and async generation paths
+
+    Failed jobs are requeued up to MAX_RETRIES times with exponential
+    backoff, each request gets a timeout learned from earlier latency at the
+    same resolution, and a pacer holds submissions while the backend is
+    saturated. Whether a backend is up at all is its client's circuit
+    breaker's business (StableDiffusionClient.retry_after), so a job the
+    WebUI rejects never pauses the others.
+    """
+
+    def __init__(self, config: Config = None, backends: int = 1,
+                 history: Optional[TimingHistory] = None):
+        self.config = config or Config()
+        self.history = history
+        self.max_retries = self.config.MAX_RETRIES
+        self.backends = max(1, backends)
+        self.latency = LatencyTracker(self.config)
+        self.pacer = Pacer(self.config)
+        self.retries = 0
+        self.gave_up = 0
+
+    def timeout_for(self, settings: GenerationSettings, images: int = 1) -> float:
+        return self.latency.timeout_for(settings, images)
+
+    def should_retry(self, attempt: int) -> bool:
+        """Check whether a job that failed on this attempt gets another one"""
+        return attempt < self.max_retries
+
+    def backoff(self, attempt: int) -> float:
+        """Delay before retry number attempt (1-based), with jitter"""
+        delay = min(self.config.RETRY_BACKOFF_MAX,
+                    self.config.RETRY_BACKOFF_BASE * (2 ** (attempt - 1)))
+        return delay * random.uniform(0.5, 1.0)
+
+    def record_success(self, settings: GenerationSettings, seconds: float, images: int = 1,
+                       in_flight: int = 1):
+        """Record a successful request; in_flight counts requests outstanding at submission"""
+        queue_depth = math.ceil(in_flight / self.backends)
+        self.latency.record(settings, seconds, images)
+        self.pacer.record(settings, seconds, images, queue_depth)
+        if self.history is not None:
+            self.history.record_render(settings, seconds / max(1, images) / queue_depth, images)
+
+    def record_retry(self, jobs: int):
+        self.retries += jobs
+
+    def record_give_up(self, jobs: int):
+        self.gave_up += jobs
+
+def order_by_checkpoint(items: List[T], checkpoint_of: Callable[[T], Optional[str]],
+                        current: Optional[str] = None) -> List[T]:
+    """Stable-order items so each checkpoint's work runs back to back
+
+    Items for the currently loaded checkpoint go first, then the remaining
+    checkpoints in order of first appearance, so a run swaps models at most
+    once per distinct checkpoint.
+    """
+    first_seen: Dict[Optional[str], int] = {}
+    for item in items:
+        first_seen.setdefault(checkpoint_of(item), len(first_seen))
+    if current in first_seen:
+        first_seen[current] = -1
+    return sorted(items, key=lambda item: first_seen[checkpoint_of(item)])
@@ -4,30 +4,52 @@ Stable Diffusion WebUI API client
 import requests
 import base64
 import io
+import shlex
+import threading
 from PIL import Image
-from typing import Optional, Tuple
+from typing import Optional, Tuple, Dict, Any, List
 from .config import Config
-from .models import GenerationSettings
+from .models import GenerationSettings, GenerationJob, PreflightReport
+from .stream_decoder import decode_response_stream
+from .progress import ProgressWatcher
+from .scheduler import CircuitBreaker
 
 class StableDiffusionClient:
     """Client for Stable Diffusion WebUI API"""
     
-    def __init__(self, config: Config = None):
+    def __init__(self, config: Config = None, base_url: str = None, watch_progress: bool = None,
+                 breaker: CircuitBreaker = None):
         self.config = config or Config()
+        self.base_url = (base_url or self.config.WEBUI_URL).rstrip("/")
+        self.api_url = f"{self.base_url}/sdapi/v1"
         self.session = requests.Session()
-        self.session.timeout = 300  # 5 minutes timeout
+        self.session.timeout = self.config.REQUEST_TIMEOUT
+        # Opened by transport errors, timeouts and HTTP 5xx only; a request the
+        # WebUI answers (even without images) says nothing about its health
+        self.breaker = breaker or CircuitBreaker.from_config(self.config)
+        self._outcome = threading.local()
+        if watch_progress is None:
+            watch_progress = self.config.WATCH_PROGRESS
+        self.progress_watcher = ProgressWatcher(self, self.config) if watch_progress else None
+    
+    def set_pool_size(self, pool_size: int):
+        """Size the HTTP connection pool for concurrent callers"""
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
     
     def check_connection(self) -> bool:
         """Check if WebUI API is accessible"""
         try:
-            response = self.session.get(f"{self.config.WEBUI_URL}/internal/ping", timeout=10)
+            response = self.session.get(f"{self.base_url}/internal/ping", timeout=10)
             return response.status_code == 200
         except Exception:
             return False
     
-    def generate_image(self, prompt: str, negative_prompt: str, 
-                      settings: GenerationSettings) -> Optional[Image.Image]:
-        """Generate image using txt2img API"""
+    def build_payload(self, prompt: str, negative_prompt: str,
+                      settings: GenerationSettings) -> Dict[str, Any]:
+        """Build txt2img request payload"""
         payload = {
             "prompt": prompt,
             "negative_prompt": negative_prompt,
@@ -43,34 +65,243 @@ class StableDiffusionClient:
             "tiling": False,
             "enable_hr": False
         }
+        if settings.checkpoint:
+            # Pin the model; don't restore afterwards so the backend doesn't swap back
+            payload["override_settings"] = {"sd_model_checkpoint": settings.checkpoint}
+            payload["override_settings_restore_afterwards"] = False
+        return payload
+    
+    @staticmethod
+    def decode_image(image_b64: str) -> Image.Image:
+        """Decode a base64 image returned by the API"""
+        image_data = base64.b64decode(image_b64)
+        return Image.open(io.BytesIO(image_data))
+    
+    def generate_image(self, prompt: str, negative_prompt: str, 
+                      settings: GenerationSettings, timeout: float = None) -> Optional[Image.Image]:
+        """Generate image using txt2img API"""
+        payload = self.build_payload(prompt, negative_prompt, settings)
+        result = self._post_txt2img(payload, timeout)
+        if result and result.get("images"):
+            return result["images"][0]
+        return None
+    
+    def generate_jobs(self, jobs: List[GenerationJob],
+                      timeout: float = None) -> List[Optional[Image.Image]]:
+        """Generate a group of jobs in one request, one image per job"""
+        first = jobs[0]
+        if len(jobs) == 1:
+            return [self.generate_image(first.prompt, first.negative_prompt, first.settings, timeout)]
+        return self.generate_multi_prompt(jobs, timeout)
+    
+    def refine_image(self, image: Image.Image, prompt: str, negative_prompt: str,
+                     settings: GenerationSettings, denoising_strength: float,
+                     timeout: float = None) -> Optional[Image.Image]:
+        """Rework an image with img2img at the settings' size"""
+        payload = self.build_payload(prompt, negative_prompt, settings)
+        del payload["enable_hr"]
+        buffer = io.BytesIO()
+        image.save(buffer, "PNG")
+        payload["init_images"] = [base64.b64encode(buffer.getvalue()).decode()]
+        payload["denoising_strength"] = denoising_strength
+        result = self._post_txt2img(payload, timeout, endpoint="img2img")
+        if result and result.get("images"):
+            return result["images"][0]
+        return None
+    
+    def generate_multi_prompt(self, jobs: List[GenerationJob],
+                              timeout: float = None) -> List[Optional[Image.Image]]:
+        """Generate distinct prompts in one call via the prompts-from-file script
+        
+        Each job is one script line with its own prompt and seed; all jobs
+        must share size, steps, CFG, sampler and checkpoint. The lines render
+        one after another (batch size 1 each), so this saves requests, not
+        GPU time. Returns one image per job, in order.
+        """
+        payload = self.build_payload("", "", jobs[0].settings)
+        prompt_txt = "\n".join(self._script_line(job) for job in jobs)
+        payload["script_name"] = self.config.PROMPTS_FROM_FILE_SCRIPT
+        # iterate seed, same seed per batch, prompt position, prompt text
+        payload["script_args"] = [False, False, "start", prompt_txt]
+        
+        expected = len(jobs)
+        result = self._post_txt2img(payload, timeout)
+        if not result:
+            return [None] * expected
         
+        images = result.get("images", [])[-expected:]
+        if len(images) != expected:
+            print(f"⚠️ Multi-prompt request returned {len(images)}/{expected} images")
+            return [None] * expected
+        return images
+    
+    @staticmethod
+    def _script_line(job: GenerationJob) -> str:
+        """Build a prompts-from-file line for a job"""
+        return " ".join([
+            "--prompt", shlex.quote(job.prompt),
+            "--negative_prompt", shlex.quote(job.negative_prompt),
+            "--seed", str(job.settings.seed),
+        ])
+    
+    def _post_txt2img(self, payload: Dict[str, Any], timeout: float = None,
+                      endpoint: str = "txt2img") -> Optional[Dict[str, Any]]:
+        """Post a txt2img (or img2img) request and return the response with decoded images"""
+        if self.progress_watcher is None:
+            return self._send_txt2img(payload, timeout, endpoint)
+        
+        self.progress_watcher.request_started()
+        result = None
+        try:
+            result = self._send_txt2img(payload, timeout, endpoint)
+        finally:
+            interrupted, timing = self.progress_watcher.request_finished(payload)
+        
+        if interrupted:
+            print("❌ Generation was interrupted after stalling, discarding partial result")
+            return None
+        if result is not None:
+            result["timing"] = timing
+        return result
+    
+    def _send_txt2img(self, payload: Dict[str, Any], timeout: float = None,
+                      endpoint: str = "txt2img") -> Optional[Dict[str, Any]]:
+        """Send a txt2img (or img2img) request"""
+        self._outcome.unavailable = True
         try:
             response = self.session.post(
-                f"{self.config.WEBUI_API_URL}/txt2img", 
+                f"{self.api_url}/{endpoint}", 
                 json=payload,
-                timeout=300
+                timeout=timeout or self.config.REQUEST_TIMEOUT,
+                stream=self.config.STREAM_DECODE
             )
             
-            if response.status_code == 200:
-                result = response.json()
-                if result.get("images"):
-                    # Decode base64 image
-                    image_data = base64.b64decode(result["images"][0])
-                    return Image.open(io.BytesIO(image_data))
-            else:
+            with response:
+                self._outcome.unavailable = response.status_code >= 500
+                if response.status_code == 200:
+                    return self._decode_response(response)
                 print(f"❌ API Error {response.status_code}: {response.text}")
                 
         except requests.exceptions.Timeout:
             print("❌ Request timeout - generation took too long")
         except Exception as e:
+            # Connection errors and broken streams are the backend's; anything else is ours
+            self._outcome.unavailable = isinstance(e, requests.exceptions.RequestException)
             print(f"❌ Generation error: {e}")
+        finally:
+            self._record_outcome()
             
         return None
     
+    def _record_outcome(self):
+        """Feed the last request's outcome to the breaker"""
+        if not self._outcome.unavailable:
+            self.breaker.record_success()
+            return
+        was_open = self.breaker.state == CircuitBreaker.OPEN
+        self.breaker.record_failure()
+        if not was_open and self.breaker.state == CircuitBreaker.OPEN:
+            print(f"⚠️ WebUI {self.base_url} unavailable after "
+                  f"{self.breaker.consecutive_failures} failures, pausing it for "
+                  f"{self.breaker.reset_timeout:.0f}s")
+    
+    def last_request_unavailable(self) -> bool:
+        """Whether this thread's last request failed in transport, by timeout or with HTTP 5xx"""
+        return getattr(self._outcome, "unavailable", False)
+    
+    def retry_after(self) -> float:
+        """Seconds to wait before the next request (0 = go ahead)"""
+        if self.breaker.allow():
+            return 0.0
+        return max(self.breaker.retry_after(), 1.0)
+    
+    def _decode_response(self, response: requests.Response) -> Dict[str, Any]:
+        """Decode a txt2img response into PIL images and the info string"""
+        if self.config.STREAM_DECODE:
+            size_hint = int(response.headers.get("Content-Length") or 0)
+            return decode_response_stream(
+                response.iter_content(chunk_size=self.config.STREAM_CHUNK_SIZE), size_hint
+            )
+        
+        result = response.json()
+        return {
+            "images": [self.decode_image(image_b64) for image_b64 in result.get("images", [])],
+            "info": result.get("info"),
+        }
+    
+    def get_progress(self) -> Dict[str, Any]:
+        """Get progress of the currently running generation"""
+        try:
+            response = self.session.get(f"{self.api_url}/progress",
+                                        params={"skip_current_image": "true"}, timeout=10)
+            if response.status_code == 200:
+                return response.json()
+        except Exception as e:
+            print(f"❌ Error getting progress: {e}")
+        return {}
+    
+    def interrupt(self) -> bool:
+        """Interrupt the currently running generation"""
+        try:
+            response = self.session.post(f"{self.api_url}/interrupt", timeout=10)
+            return response.status_code == 200
+        except Exception as e:
+            print(f"❌ Error interrupting generation: {e}")
+        return False
+    
+    def get_options(self) -> Dict[str, Any]:
+        """Get current WebUI options (including the loaded checkpoint)"""
+        try:
+            response = self.session.get(f"{self.api_url}/options", timeout=30)
+            if response.status_code == 200:
+                return response.json()
+        except Exception as e:
+            print(f"❌ Error getting options: {e}")
+        return {}
+    
+    def preflight(self, checkpoint: str = None, sampler: str = None,
+                  overrides: Dict[str, str] = None) -> PreflightReport:
+        """Check the checkpoint(s) and sampler once before queueing jobs"""
+        report = PreflightReport()
+        models = self.get_models()
+        samplers = self.get_samplers()
+        report.loaded_checkpoint = self.get_options().get("sd_model_checkpoint")
+        
+        if not models:
+            report.errors.append(f"{self.base_url}: no checkpoints reported by /sd-models")
+            return report
+        
+        loaded = resolve_checkpoint(report.loaded_checkpoint, models)
+        if loaded is not None:
+            report.checkpoint_hashes[loaded["title"]] = loaded.get("sha256") or loaded.get("hash")
+        
+        model = resolve_checkpoint(checkpoint or report.loaded_checkpoint, models)
+        if model is None:
+            report.errors.append(f"{self.base_url}: checkpoint '{checkpoint or report.loaded_checkpoint}' not available")
+        else:
+            report.checkpoint = model["title"]
+            report.checkpoint_hash = model.get("sha256") or model.get("hash")
+            report.checkpoint_hashes[model["title"]] = report.checkpoint_hash
+        
+        for pose, name in (overrides or {}).items():
+            override = resolve_checkpoint(name, models)
+            if override is None:
+                report.errors.append(f"{self.base_url}: checkpoint '{name}' for pose '{pose}' not available")
+            else:
+                report.checkpoint_overrides[pose] = override["title"]
+                report.checkpoint_hashes[override["title"]] = override.get("sha256") or override.get("hash")
+        
+        sampler = sampler or self.config.DEFAULT_SAMPLER
+        names = {name for s in samplers for name in [s.get("name")] + list(s.get("aliases") or [])}
+        if sampler not in names:
+            report.errors.append(f"{self.base_url}: sampler '{sampler}' not available")
+        
+        return report
+    
     def get_models(self) -> list:
         """Get available models"""
         try:
-            response = self.session.get(f"{self.config.WEBUI_API_URL}/sd-models")
+            response = self.session.get(f"{self.api_url}/sd-models")
             if response.status_code == 200:
                 return response.json()
         except Exception as e:
@@ -80,9 +311,22 @@ class StableDiffusionClient:
     def get_samplers(self) -> list:
         """Get available samplers"""
         try:
-            response = self.session.get(f"{self.config.WEBUI_API_URL}/samplers")
+            response = self.session.get(f"{self.api_url}/samplers")
             if response.status_code == 200:
                 return response.json()
         except Exception as e:
             print(f"❌ Error getting samplers: {e}")
         return []
+
+def resolve_checkpoint(name: Optional[str], models: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """Find a checkpoint by title, model name, filename or hash"""
+    if not name:
+        return None
+    for model in models:
+        candidates = (model.get("title"), model.get("model_name"), model.get("hash"),
+                      (model.get("filename") or "").replace("\\", "/").split("/")[-1])
+        if name in candidates:
+            return model
+        if model.get("sha256") and model["sha256"].startswith(name.lower()):
+            return model
+    return None
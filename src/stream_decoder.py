@@ -0,0 +1,208 @@
+"""
+Incremental decoding of txt2img API responses
+"""
+import binascii
+import io
+import json
+import re
+import threading
+from typing import Any, Dict, Iterable, List, Optional
+from PIL import Image
+
+_STRING_SPECIAL = re.compile(rb'["\\]')
+_buffers = threading.local()
+
+class BufferStream(io.RawIOBase):
+    """Read-only, seekable file object over a memoryview (no copy of the data)"""
+
+    def __init__(self, view: memoryview):
+        self._view = view
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, target) -> int:
+        size = min(len(target), len(self._view) - self._pos)
+        target[:size] = self._view[self._pos:self._pos + size]
+        self._pos += size
+        return size
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._pos = max(0, offset)
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+def _thread_buffer(size: int) -> bytearray:
+    """Per-thread decode buffer, grown on demand and reused across responses"""
+    buffer = getattr(_buffers, "data", None)
+    if buffer is None or len(buffer) < size:
+        buffer = bytearray(size)
+        _buffers.data = buffer
+    return buffer
+
+class StreamingResponseDecoder:
+    """Decodes a txt2img JSON body chunk by chunk
+
+    Image strings in the top-level "images" array are base64-decoded straight
+    into a reusable per-thread buffer and opened with PIL as soon as they end,
+    so the full JSON text, the base64 string and the PNG bytes are never held
+    as separate whole copies. The small "info" string is kept; everything else
+    (such as the echoed "parameters") is skipped.
+    """
+
+    def __init__(self, size_hint: int = 0):
+        self.images: List[Image.Image] = []
+        self.info: Optional[str] = None
+        self._buffer = _thread_buffer(max(size_hint * 3 // 4, 1 << 20))
+        self._stack: List[bytes] = []
+        self._expect_key = False
+        self._key: Optional[str] = None
+        # Current string: None, "key", "info", "skip" or "image"
+        self._string: Optional[str] = None
+        self._string_parts: List[bytes] = []
+        self._escape = False
+        self._b64_tail = b""
+        self._size = 0
+
+    def feed(self, data: bytes):
+        """Consume the next chunk of the response body"""
+        i, n = 0, len(data)
+        while i < n:
+            if self._string == "image":
+                i = self._feed_image(data, i)
+            elif self._string is not None:
+                i = self._feed_string(data, i)
+            else:
+                i = self._feed_structure(data, i)
+
+    def result(self) -> Dict[str, Any]:
+        """Decoded response in the same shape callers expect from the API"""
+        return {"images": self.images, "info": self.info}
+
+    def _feed_structure(self, data: bytes, i: int) -> int:
+        """Handle JSON punctuation outside of strings"""
+        char = data[i:i + 1]
+        if char == b'"':
+            self._start_string()
+        elif char in (b'{', b'['):
+            self._stack.append(char)
+            self._expect_key = char == b'{'
+        elif char in (b'}', b']'):
+            self._stack.pop()
+        elif char == b':':
+            self._expect_key = False
+        elif char == b',':
+            self._expect_key = bool(self._stack) and self._stack[-1] == b'{'
+        return i + 1
+
+    def _start_string(self):
+        """Classify a string by where it appears in the document"""
+        depth = len(self._stack)
+        if self._expect_key:
+            self._string = "key" if depth == 1 else "skip"
+        elif depth == 2 and self._stack[-1] == b'[' and self._key == "images":
+            self._string = "image"
+            self._size = 0
+            self._b64_tail = b""
+        elif depth == 1 and self._key == "info":
+            self._string = "info"
+        else:
+            self._string = "skip"
+        self._string_parts = []
+        self._escape = False
+
+    def _feed_string(self, data: bytes, i: int) -> int:
+        """Scan a non-image string up to its closing quote"""
+        while i < len(data):
+            if self._escape:
+                self._string_parts.append(data[i:i + 1])
+                self._escape = False
+                i += 1
+                continue
+
+            match = _STRING_SPECIAL.search(data, i)
+            end = match.start() if match else len(data)
+            if self._string != "skip":
+                self._string_parts.append(data[i:end])
+            if not match:
+                return len(data)
+
+            if data[end:end + 1] == b'\\':
+                if self._string != "skip":
+                    self._string_parts.append(b'\\')
+                self._escape = True
+                i = end + 1
+                continue
+
+            self._end_string()
+            return end + 1
+        return i
+
+    def _end_string(self):
+        """Store the value of a finished key or info string"""
+        if self._string in ("key", "info"):
+            value = json.loads(b'"' + b"".join(self._string_parts) + b'"')
+            if self._string == "key":
+                self._key = value
+            else:
+                self.info = value
+        self._string = None
+        self._string_parts = []
+
+    def _feed_image(self, data: bytes, i: int) -> int:
+        """Base64-decode image data into the buffer"""
+        end = data.find(b'"', i)
+        piece = data[i:end if end >= 0 else len(data)]
+        if b'\\' in piece:
+            # JSON may escape "/" as "\/"; base64 has no other escapable chars
+            piece = piece.replace(b'\\', b'')
+        piece = self._b64_tail + piece
+
+        usable = len(piece) - len(piece) % 4
+        self._b64_tail = piece[usable:]
+        if usable:
+            self._write(binascii.a2b_base64(piece[:usable]))
+
+        if end < 0:
+            return len(data)
+
+        if self._b64_tail:
+            self._write(binascii.a2b_base64(self._b64_tail + b"=" * (-len(self._b64_tail) % 4)))
+        self._finish_image()
+        return end + 1
+
+    def _write(self, decoded: bytes):
+        """Append decoded bytes to the buffer, growing it if needed"""
+        end = self._size + len(decoded)
+        if end > len(self._buffer):
+            self._buffer.extend(bytes(max(end - len(self._buffer), len(self._buffer) // 2)))
+            _buffers.data = self._buffer
+        self._buffer[self._size:end] = decoded
+        self._size = end
+
+    def _finish_image(self):
+        """Open the decoded image before the buffer is reused"""
+        with memoryview(self._buffer)[:self._size] as view:
+            image = Image.open(BufferStream(view))
+            image.load()
+        self.images.append(image)
+        self._string = None
+        self._size = 0
+        self._b64_tail = b""
+
+def decode_response_stream(chunks: Iterable[bytes], size_hint: int = 0) -> Dict[str, Any]:
+    """Decode a streamed txt2img response body"""
+    decoder = StreamingResponseDecoder(size_hint)
+    for chunk in chunks:
+        decoder.feed(chunk)
+    return decoder.result()
@@ -0,0 +1,78 @@
+"""
+Render time and output size history for run estimates
+"""
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Dict, Optional
+from .models import GenerationSettings
+
+def history_key(width: int, height: int, steps: int) -> str:
+    return f"{width}x{height}@{steps}"
+
+class TimingHistory:
+    """GPU seconds and output bytes per image, per resolution and step count
+
+    Kept as JSON in the output directory (TIMING_HISTORY) and accumulated
+    over every run, so --plan can estimate a run before it starts. GPU
+    seconds are the per-image service time measured by the scheduler
+    (latency divided by batch size and queue depth), bytes are the sizes of
+    the saved files.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._stats: Dict[str, Dict[str, float]] = {}
+        if self.path.is_file():
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self._stats = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"⚠️ Ignoring unreadable timing history {self.path}: {e}")
+        self._lock = threading.Lock()
+        self._dirty = False
+
+    def record_render(self, settings: GenerationSettings, seconds_per_image: float, images: int = 1):
+        """Record the GPU time of rendered images"""
+        self._add(settings, "images", images, "gpu_seconds", seconds_per_image * images)
+
+    def record_output(self, settings: GenerationSettings, size: int):
+        """Record the size of a saved image"""
+        self._add(settings, "outputs", 1, "bytes", size)
+
+    def gpu_seconds(self, width: int, height: int, steps: int) -> Optional[float]:
+        """Mean GPU seconds per image, or None without history"""
+        return self._mean(history_key(width, height, steps), "gpu_seconds", "images")
+
+    def output_bytes(self, width: int, height: int, steps: int) -> Optional[float]:
+        """Mean saved file size, or None without history"""
+        return self._mean(history_key(width, height, steps), "bytes", "outputs")
+
+    def save(self):
+        """Write the history atomically if anything was recorded"""
+        with self._lock:
+            if not self._dirty:
+                return
+            data = json.dumps(self._stats, indent=2, sort_keys=True)
+            self._dirty = False
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.path.with_name(self.path.name + ".tmp")
+        temp_path.write_text(data, encoding='utf-8')
+        os.replace(temp_path, self.path)
+
+    def _add(self, settings: GenerationSettings, count_field: str, count: int,
+             total_field: str, total: float):
+        key = history_key(settings.width, settings.height, settings.steps)
+        with self._lock:
+            stats = self._stats.setdefault(key, {})
+            stats[count_field] = stats.get(count_field, 0) + count
+            stats[total_field] = stats.get(total_field, 0.0) + total
+            self._dirty = True
+
+    def _mean(self, key: str, total_field: str, count_field: str) -> Optional[float]:
+        with self._lock:
+            stats = self._stats.get(key, {})
+            if not stats.get(count_field):
+                return None
+            return stats[total_field] / stats[count_field]
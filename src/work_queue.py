@@ -0,0 +1,132 @@
+"""
+Shared work queue for rendering one pack on several machines
+"""
+import json
+import time
+from pathlib import Path
+from typing import Dict, List
+from .config import Config, PoseConfig
+from .job_store import JobStore, DONE, _SCHEMA
+from .models import CharacterAttributes, GenerationJob, GenerationResult
+from .planner import pose_priority, render_key
+
+_QUEUE_SCHEMA = _SCHEMA + """
+CREATE TABLE IF NOT EXISTS leases (
+    filename TEXT PRIMARY KEY REFERENCES jobs (filename),
+    priority INTEGER NOT NULL,
+    resolution TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    worker TEXT,
+    expires REAL NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS leases_by_order ON leases (priority, resolution, position);
+"""
+
+class SharedWorkQueue(JobStore):
+    """Job store that several render nodes lease work from
+
+    Lives as an SQLite file in the pack directory on a shared filesystem
+    (rollback journal, since WAL needs shared memory between hosts). Each
+    worker leases a few jobs at a time in priority/resolution order, renews
+    its leases while rendering, and records the result, which releases the
+    lease. Leases of a dead worker expire after QUEUE_LEASE_SECONDS and the
+    jobs are leased again; failed jobs go back to the queue until they
+    reach QUEUE_MAX_ATTEMPTS. All workers write their images into the same
+    pack directory.
+    """
+
+    JOURNAL_MODE = "DELETE"
+    SCHEMA = _QUEUE_SCHEMA
+
+    def __init__(self, path: Path, config: Config = None):
+        super().__init__(path)
+        self.config = config or Config()
+        self.pose_config = PoseConfig()
+
+    def add_jobs(self, jobs: List[GenerationJob]):
+        """Queue newly planned jobs (jobs already in the queue are kept)"""
+        super().add_jobs(jobs)
+        with self._lock, self._conn:
+            start = self._conn.execute("SELECT COUNT(*) FROM leases").fetchone()[0]
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO leases (filename, priority, resolution, position) "
+                "VALUES (?, ?, ?, ?)",
+                [(job.filename, pose_priority(job.pose, self.config, self.pose_config),
+                  "%05dx%05d@%03d" % render_key(job, self.config), start + i)
+                 for i, job in enumerate(jobs)]
+            )
+
+    def lease(self, worker: str, limit: int) -> List[GenerationJob]:
+        """Lease up to limit unfinished jobs whose lease is free or expired"""
+        now = time.time()
+        with self._lock:
+            try:
+                self._conn.execute("BEGIN IMMEDIATE")
+                filenames = [row[0] for row in self._conn.execute(
+                    "SELECT leases.filename FROM leases JOIN jobs USING (filename) "
+                    "WHERE jobs.status != ? AND leases.attempts < ? "
+                    "AND (leases.worker IS NULL OR leases.expires < ?) "
+                    "ORDER BY leases.priority, leases.resolution, leases.position LIMIT ?",
+                    (DONE, self.config.QUEUE_MAX_ATTEMPTS, now, limit)
+                )]
+                self._conn.executemany(
+                    "UPDATE leases SET worker = ?, expires = ? WHERE filename = ?",
+                    [(worker, now + self.config.QUEUE_LEASE_SECONDS, filename)
+                     for filename in filenames]
+                )
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+
+            jobs = []
+            characters: Dict[str, CharacterAttributes] = {}
+            for filename in filenames:
+                row = self._conn.execute(
+                    "SELECT jobs.char_id, characters.attributes, filename, pose, reveal_level, "
+                    "variant_index, prompt, negative_prompt, settings, clothing_description "
+                    "FROM jobs JOIN characters USING (char_id) WHERE filename = ?",
+                    (filename,)
+                ).fetchone()
+                char_id, attributes = row[0], row[1]
+                if char_id not in characters:
+                    characters[char_id] = CharacterAttributes.from_dict(json.loads(attributes))
+                jobs.append(self._job_from_row(row[2:], char_id, characters[char_id]))
+        return jobs
+
+    def renew(self, worker: str, jobs: List[GenerationJob]):
+        """Extend this worker's leases on jobs that are still rendering"""
+        expires = time.time() + self.config.QUEUE_LEASE_SECONDS
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "UPDATE leases SET expires = ? WHERE filename = ? AND worker = ?",
+                [(expires, job.filename, worker) for job in jobs]
+            )
+
+    def release(self, worker: str):
+        """Hand a worker's unfinished leases back to the queue"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE leases SET worker = NULL, expires = 0 WHERE worker = ?", (worker,)
+            )
+
+    def record_result(self, job: GenerationJob, result: GenerationResult,
+                      output_path: Path = None):
+        """Store the outcome of a job and release its lease"""
+        super().record_result(job, result, output_path)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE leases SET worker = NULL, expires = 0, attempts = attempts + ? "
+                "WHERE filename = ?",
+                (0 if result.success else 1, job.filename)
+            )
+
+    def outstanding(self) -> int:
+        """Jobs that are neither done nor out of attempts (leased ones included)"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM leases JOIN jobs USING (filename) "
+                "WHERE jobs.status != ? AND leases.attempts < ?",
+                (DONE, self.config.QUEUE_MAX_ATTEMPTS)
+            ).fetchone()[0]
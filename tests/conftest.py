@@ -0,0 +1,33 @@
+"""
+Shared fixtures
+"""
+from typing import List
+
+import pytest
+
+from src.models import CharacterAttributes, GenerationJob, GenerationSettings
+
+@pytest.fixture
+def character() -> CharacterAttributes:
+    return CharacterAttributes(gender="f", age_group=2, ethnicity="w", name="test")
+
+@pytest.fixture
+def make_jobs(character):
+    """Build jobs for a character, one per (pose, reveal level)"""
+    def make(char_id: str, variants: List[tuple]) -> List[GenerationJob]:
+        return [
+            GenerationJob(
+                character=character,
+                char_id=char_id,
+                pose=pose,
+                reveal_level=level,
+                variant_index=level,
+                prompt=f"{pose} prompt {level}",
+                negative_prompt="blurry",
+                settings=GenerationSettings(seed=1234, width=512, height=768, checkpoint="model [abc]"),
+                filename=f"{char_id}-{pose}-{level}.png",
+                clothing_description=f"outfit {level}"
+            )
+            for pose, level in variants
+        ]
+    return make
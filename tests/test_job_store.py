@@ -0,0 +1,53 @@
+"""
+Resuming a session from its job store
+"""
+from src.job_store import DONE, FAILED, PENDING, JobStore
+from src.models import GenerationResult
+
+VARIANTS = [("cas", 0), ("cas", 1), ("cas", 2), ("head", 0)]
+
+def started_session(path, character, make_jobs):
+    """A session interrupted after one saved and one failed image"""
+    store = JobStore(path)
+    store.add_characters([("key-1", character)])
+    store.set_character_id("key-1", character, "00042")
+    jobs = make_jobs("00042", VARIANTS)
+    store.add_jobs(jobs)
+    store.record_result(jobs[0], GenerationResult(success=True, filename=jobs[0].filename),
+                        path.parent / jobs[0].filename)
+    store.record_result(jobs[2], GenerationResult.failed(jobs[2], "timeout"))
+    store.close()
+    return jobs
+
+def test_resume_skips_done_and_replans_failed(tmp_path, character, make_jobs):
+    path = tmp_path / "session.sqlite3"
+    jobs = started_session(path, character, make_jobs)
+
+    store = JobStore(path)
+    assert store.character_id("key-1") == "00042"
+    assert store.has_jobs("00042")
+    assert store.counts() == {DONE: 1, FAILED: 1, PENDING: 2}
+    assert [result.filename for result in store.done_results("00042")] == [jobs[0].filename]
+
+    pending = store.pending_jobs("00042", character)
+    # Failed and never-run jobs, in planning order, rebuilt as they were planned
+    assert pending == [jobs[1], jobs[2], jobs[3]]
+    store.close()
+
+def test_replanning_keeps_recorded_status(tmp_path, character, make_jobs):
+    path = tmp_path / "session.sqlite3"
+    jobs = started_session(path, character, make_jobs)
+
+    store = JobStore(path)
+    store.add_jobs(jobs)
+    assert store.counts() == {DONE: 1, FAILED: 1, PENDING: 2}
+    store.close()
+
+def test_characters_load_in_registration_order(tmp_path, character):
+    store = JobStore(tmp_path / "session.sqlite3")
+    other = type(character)(gender="m", age_group=3, ethnicity="a", name="other")
+    store.add_characters([("key-1", character), ("key-2", other)])
+    store.add_characters([("key-2", other)])
+    assert [c.name for c in store.load_characters()] == ["test", "other"]
+    assert store.character_id("key-2") is None
+    store.close()
@@ -0,0 +1,53 @@
+"""
+The "numpy" post-processing path must produce the same pixels as the "pil" path
+"""
+import numpy as np
+import pytest
+from PIL import Image
+
+pytest.importorskip("rembg")
+pytest.importorskip("onnxruntime")
+
+from src.config import Config
+from src.image_processor import ImageProcessor
+
+def synthetic_render(width: int, height: int, mode: str = "RGBA") -> Image.Image:
+    """A figure-like ellipse with shading on a soft grey studio backdrop"""
+    ys, xs = np.mgrid[0:height, 0:width].astype(np.float32)
+    pixels = np.empty((height, width, 4), dtype=np.float32)
+    pixels[..., :3] = 200 + 20 * ys[..., None] / height
+    pixels[..., 3] = 255
+    figure = ((xs - width / 2) / (width * 0.2)) ** 2 + ((ys - height / 2) / (height * 0.4)) ** 2 <= 1
+    pixels[figure, 0] = 160 + 60 * xs[figure] / width
+    pixels[figure, 1] = 90 + 40 * ys[figure] / height
+    pixels[figure, 2] = 70
+    return Image.fromarray(pixels.astype(np.uint8), "RGBA").convert(mode)
+
+@pytest.fixture
+def processor() -> ImageProcessor:
+    config = Config()
+    # The solid backdrop is keyed, so no matting model is needed
+    config.KEYING_ENABLED = True
+    config.MATTING_LOWRES = False
+    return ImageProcessor(config)
+
+@pytest.mark.parametrize("mode", ["RGBA", "RGB"])
+def test_body_parity(processor, mode):
+    assert processor.check_parity(synthetic_render(320, 512, mode), "cas") == 0
+
+def test_body_parity_lowres(processor):
+    processor.config.MATTING_LOWRES = True
+    assert processor.check_parity(synthetic_render(640, 1024), "cas") == 0
+
+@pytest.mark.parametrize("mode", ["RGBA", "RGB"])
+def test_headshot_parity(processor, mode):
+    assert processor.check_parity(synthetic_render(360, 480, mode), "head") == 0
+
+@pytest.mark.parametrize("mode", ["pil", "numpy"])
+def test_body_with_headshot_crop(processor, mode):
+    processor.config.POSTPROCESS_MODE = mode
+    render = synthetic_render(320, 512)
+    body, crop = processor.body_png_and_head_crop(render)
+    assert body == processor.body_pngs([render])[0]
+    assert crop.width * 4 == crop.height * 3
+    assert crop.getbbox() is not None and crop.height < render.height
@@ -0,0 +1,104 @@
+"""
+Circuit breaker states and the retry policy
+"""
+import pytest
+
+from src import scheduler
+from src.config import Config
+from src.scheduler import CircuitBreaker, JobScheduler
+
+class Clock:
+    """Stand-in for time.monotonic that only moves when told to"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(scheduler.time, "monotonic", clock)
+    return clock
+
+@pytest.fixture
+def breaker(clock) -> CircuitBreaker:
+    return CircuitBreaker(failure_threshold=3, reset_timeout=10, max_reset_timeout=30)
+
+def test_breaker_opens_after_threshold(breaker):
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED and breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+    assert breaker.retry_after() == 10
+    assert breaker.trips == 1
+
+def test_breaker_success_resets_failure_count(breaker):
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+def test_breaker_half_opens_for_one_trial(breaker, clock):
+    breaker.trip()
+    clock.now += 10
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    # Only the trial request goes through until it resolves
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+def test_breaker_failed_trial_doubles_timeout(breaker, clock):
+    breaker.trip()
+    for expected in (20, 30, 30):
+        clock.now += breaker.reset_timeout
+        assert breaker.allow()
+        breaker.record_failure()
+        assert breaker.state == CircuitBreaker.OPEN
+        assert breaker.retry_after() == expected
+
+def test_breaker_success_restores_base_timeout(breaker, clock):
+    breaker.trip()
+    clock.now += 10
+    breaker.allow()
+    breaker.record_failure()
+    clock.now += 20
+    breaker.allow()
+    breaker.record_success()
+    assert breaker.reset_timeout == 10
+
+def test_breaker_half_open_on_recovery(breaker):
+    breaker.trip()
+    breaker.half_open()
+    assert breaker.allow()
+
+def test_breaker_trip_while_open_restarts_timeout(breaker, clock):
+    breaker.trip()
+    clock.now += 6
+    breaker.trip()
+    assert breaker.retry_after() == 10
+    assert breaker.trips == 1
+
+@pytest.fixture
+def job_scheduler() -> JobScheduler:
+    config = Config()
+    config.MAX_RETRIES = 3
+    config.RETRY_BACKOFF_BASE = 2.0
+    config.RETRY_BACKOFF_MAX = 10.0
+    return JobScheduler(config)
+
+def test_should_retry_until_max_retries(job_scheduler):
+    assert [job_scheduler.should_retry(attempt) for attempt in range(5)] == [
+        True, True, True, False, False
+    ]
+
+@pytest.mark.parametrize("attempt, full_delay", [(1, 2.0), (2, 4.0), (3, 8.0), (4, 10.0), (9, 10.0)])
+def test_backoff_doubles_with_jitter_up_to_max(job_scheduler, attempt, full_delay):
+    for _ in range(20):
+        assert full_delay / 2 <= job_scheduler.backoff(attempt) <= full_delay
@@ -0,0 +1,61 @@
+"""
+Incremental txt2img response decoding across arbitrary chunk boundaries
+"""
+import base64
+import io
+import json
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from src.stream_decoder import decode_response_stream
+
+def png_base64(color) -> str:
+    buffer = io.BytesIO()
+    Image.new("RGB", (8, 6), color).save(buffer, "PNG")
+    return base64.b64encode(buffer.getvalue()).decode()
+
+IMAGES = [png_base64((255, 0, 0)), png_base64((0, 128, 255))]
+INFO = json.dumps({"all_seeds": [1, 2], "infotexts": ['a "quoted" prompt, \\ back\nslash é']})
+
+def response_body(escape_slashes: bool = False) -> bytes:
+    """A response whose skipped and kept strings hold escapes, brackets and braces"""
+    body = json.dumps({
+        "parameters": {"prompt": 'a [b] {c} "d", \\"e\\"', "script_args": [False, "x\"]}"]},
+        "images": IMAGES,
+        "info": INFO,
+    })
+    if escape_slashes:
+        body = body.replace("/", "\\/")
+    return body.encode()
+
+def assert_decoded(result):
+    assert result["info"] == INFO
+    assert len(result["images"]) == len(IMAGES)
+    for image, encoded in zip(result["images"], IMAGES):
+        expected = Image.open(io.BytesIO(base64.b64decode(encoded)))
+        assert image.size == expected.size
+        assert np.array_equal(np.asarray(image), np.asarray(expected))
+
+@pytest.mark.parametrize("escape_slashes", [False, True])
+def test_decodes_whole_body(escape_slashes):
+    assert_decoded(decode_response_stream([response_body(escape_slashes)]))
+
+@pytest.mark.parametrize("escape_slashes", [False, True])
+def test_decodes_every_two_chunk_split(escape_slashes):
+    body = response_body(escape_slashes)
+    for split in range(1, len(body)):
+        assert_decoded(decode_response_stream([body[:split], body[split:]]))
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 7])
+def test_decodes_small_chunks(chunk_size):
+    body = response_body(escape_slashes=True)
+    chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+    assert_decoded(decode_response_stream(chunks))
+
+def test_images_outside_top_level_are_skipped():
+    body = json.dumps({"parameters": {"images": [IMAGES[0]]}, "images": [IMAGES[1]], "info": "{}"})
+    result = decode_response_stream([body.encode()])
+    assert len(result["images"]) == 1
+    assert np.asarray(result["images"][0])[0, 0].tolist() == [0, 128, 255]
@@ -0,0 +1,84 @@
+"""
+Leasing jobs from the shared work queue
+"""
+import pytest
+
+from src import work_queue
+from src.config import Config
+from src.models import GenerationResult
+from src.work_queue import SharedWorkQueue
+
+class Clock:
+    """Stand-in for time.time that only moves when told to"""
+
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(work_queue.time, "time", clock)
+    return clock
+
+@pytest.fixture
+def queue(tmp_path, clock, character, make_jobs):
+    config = Config()
+    config.QUEUE_LEASE_SECONDS = 300
+    config.QUEUE_MAX_ATTEMPTS = 3
+    queue = SharedWorkQueue(tmp_path / "queue.sqlite3", config)
+    queue.add_characters([("key-1", character)])
+    queue.set_character_id("key-1", character, "00042")
+    queue.add_jobs(make_jobs("00042", [("cas", 0), ("cas", 1), ("cas", 2)]))
+    yield queue
+    queue.close()
+
+def filenames(jobs):
+    return [job.filename for job in jobs]
+
+def test_leased_jobs_are_not_handed_out_twice(queue):
+    first = queue.lease("a", 2)
+    assert len(first) == 2
+    assert filenames(queue.lease("b", 5)) == ["00042-cas-2.png"]
+    assert queue.lease("c", 5) == []
+    assert queue.outstanding() == 3
+
+def test_expired_lease_goes_to_another_worker(queue, clock):
+    leased = queue.lease("a", 5)
+    clock.now += 299
+    assert queue.lease("b", 5) == []
+    clock.now += 2
+    assert filenames(queue.lease("b", 5)) == filenames(leased)
+
+def test_renewed_lease_does_not_expire(queue, clock):
+    leased = queue.lease("a", 5)
+    clock.now += 200
+    queue.renew("a", leased)
+    clock.now += 200
+    assert queue.lease("b", 5) == []
+    # Only the holder can renew
+    queue.renew("b", leased)
+    clock.now += 101
+    assert len(queue.lease("b", 5)) == 3
+
+def test_release_returns_unfinished_jobs(queue):
+    queue.lease("a", 5)
+    queue.release("a")
+    assert len(queue.lease("b", 5)) == 3
+
+def test_done_jobs_leave_the_queue(queue):
+    job = queue.lease("a", 1)[0]
+    queue.record_result(job, GenerationResult(success=True, filename=job.filename))
+    assert queue.outstanding() == 2
+    assert job.filename not in filenames(queue.lease("b", 5))
+
+def test_failed_job_is_retried_until_max_attempts(queue):
+    for attempt in range(3):
+        jobs = [job for job in queue.lease("a", 5) if job.filename == "00042-cas-0.png"]
+        assert len(jobs) == 1, f"attempt {attempt + 1} not leased"
+        queue.record_result(jobs[0], GenerationResult.failed(jobs[0], "boom"))
+        queue.release("a")
+    assert "00042-cas-0.png" not in filenames(queue.lease("a", 5))
+    assert queue.outstanding() == 2